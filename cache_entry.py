@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Crash- and concurrency-safe entries of the ENSEMBL and HMM caches.
+#
+# An entry is one or more files (an ENSEMBL reply; a NumPy HMM fit; the five
+# output files of a fastPHASE run).  It is only trusted once the SHA-256 of
+# each of its files has been recorded in its checksum file ("<name>.sha256"),
+# which is written last, with write-then-rename.  So an entry that a crashed
+# or killed process left half-written has no checksum file (or one that does
+# not match) and is recomputed rather than silently trusted.
+#
+# Filling an entry is single-flight: the process that fills it holds a lock
+# on "<name>.lock" (see utils.file_lock()), and other processes that need the
+# same entry wait for the lock and then find it complete.
+#
+# Usage:
+#     with cache_entry.lock(entry_file):
+#         if not cache_entry.is_complete(entry_file, [entry_file]):
+#             cache_entry.discard(entry_file)
+#             cache_entry.atomic_write(entry_file, lambda fp: fp.write(data))
+#             cache_entry.commit(entry_file, [entry_file])
+
+import json
+import os
+import utils_snpko as utils
+import stage_cache
+
+logger = utils.logger
+
+CHECKSUM_SUFFIX = '.sha256'
+LOCK_SUFFIX = '.lock'
+
+
+def lock(name):
+    '''
+    Context manager holding the lock of the entry "name".
+    '''
+    return(utils.file_lock(name + LOCK_SUFFIX))
+
+
+def atomic_write(path, write):
+    '''
+    Call write(fp) on a new temporary file next to path, then rename it to
+    path, so that path is never seen half-written.
+    '''
+    tmp_name = '%s.tmp.%d' % (path, os.getpid())
+    try:
+        with open(tmp_name, 'wb') as fp:
+            write(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_name, path)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def commit(name, paths):
+    '''
+    Record the checksums of the files "paths" of the entry "name", marking it
+    complete.
+    '''
+    checksums = dict((os.path.basename(path), stage_cache.hash_path(path)) for path in paths)
+    atomic_write(name + CHECKSUM_SUFFIX,
+                 lambda fp: fp.write(json.dumps(checksums, sort_keys=True).encode('utf-8')))
+
+
+def has_checksum(name):
+    '''
+    Has the entry "name" been committed?  (Its files are not checked.)
+    '''
+    return(os.path.exists(name + CHECKSUM_SUFFIX))
+
+
+def is_complete(name, paths):
+    '''
+    Has the entry "name" been committed with the files "paths", and are they
+    unchanged since?
+    '''
+    try:
+        with open(name + CHECKSUM_SUFFIX) as fp:
+            checksums = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return(False)
+    for path in paths:
+        recorded = checksums.get(os.path.basename(path))
+        if recorded is None or stage_cache.hash_path(path) != recorded:
+            if os.path.exists(path):
+                logger.info('Cache file %s does not match its checksum; recomputing' % path)
+            return(False)
+    return(True)
+
+
+def discard(name):
+    '''
+    Mark the entry "name" incomplete, before (re)writing its files.
+    '''
+    if os.path.exists(name + CHECKSUM_SUFFIX):
+        os.remove(name + CHECKSUM_SUFFIX)
@@ -4,10 +4,17 @@ import numpy as np
 import os
 import pandas as pd
 import utils_snpko as utils
+import run_report
+import packed_genotypes
 import re
 
 logger = utils.logger
 
+# First three bytes of a PLINK .bed file in SNP-major mode.
+BED_MAGIC = b'\x6c\x1b\x01'
+# SNPs of a .bed file processed at a time.
+BED_BLOCK_SNPS = 4096
+
 
 def check_and_convert_input(args):
     '''
@@ -31,6 +38,44 @@ def check_and_convert_input(args):
     if not os.path.exists(args.input_file):
         logger.error("Failure to find input file %s" % (args.input_file))
         raise OSError
+    if (args.input_file).lower().endswith('.bed'):
+        (df, data_columns) = read_plink_input(args)
+    else:
+        (df, data_columns) = read_table_input(args)
+
+    # Confirm that data columns have binary (0/1) data
+    for f in data_columns:
+        if np.sum(df[f].values == 0) + np.sum(df[f].values == 1) != len(df):
+            logger.error('Field %s has non-binary data!' % f)
+            raise Exception
+
+    if len(df.columns) == 0:
+        logger.error('After dropping N/A columns, no SNPs are left!.')
+        raise Exception
+    if len(df) == 0:
+        logger.error('After dropping N/A rows, no patients are left!.')
+        raise Exception
+
+    num_na = df.isnull().sum(axis=1).sum()
+    logger.info("Detected %d N/A entries in input data" % num_na)
+    if num_na > 0 and args.never_na:
+        logger.error('Failing because of %d N/A values!' % num_na)
+        raise Exception
+
+    df.to_csv(sanitized_outfile, index=False)
+    run_report.add_counts(SNPs=len(df.columns), subjects=len(df))
+    logger.info('Detected %d SNPs and %d patients.' %
+                (len(df.columns), len(df)))
+    logger.info('Sanitized data rewritten as %s' % sanitized_outfile)
+    return
+
+
+def read_table_input(args):
+    '''
+    Read a CSV or XLSX input file with one genotype ("GT" or "G|T") per
+    cell, and drop the columns and rows with too many N/As.  Returns the
+    data frame and its data columns.
+    '''
     if args.skip_rows is not None:
         args.skip_rows = [int(x) for x in args.skip_rows.split(',')]
     if (args.input_file).lower().endswith('xlsx'):
@@ -79,6 +124,10 @@ def check_and_convert_input(args):
             {'SNP': SNP_list_1, 'wild_type': wild_type_list_1})
         df_wild.to_csv(os.path.join(args.working_dir,
                                     'wild_types.csv'), index=False)
+    elif os.path.exists(os.path.join(args.working_dir, 'wild_types.csv')):
+        # Left from an earlier input; download_SNPs() takes the wild types
+        # from ENSEMBL instead.
+        os.unlink(os.path.join(args.working_dir, 'wild_types.csv'))
 
     df.rename(columns=SNP_columns, inplace=True)
     SNP_columns = SNP_columns.values()
@@ -133,31 +182,147 @@ def check_and_convert_input(args):
     df.drop(labels=drop_row, inplace=True)
     logger.info('Dropping %d rows because of N/As:' % (len(drop_row)))
     logger.info(drop_row)
+    return(df, data_columns)
 
-    # Confirm that data columns have binary (0/1) data
-    for f in data_columns:
-        if np.sum(df[f].values == 0) + np.sum(df[f].values == 1) != len(df):
-            logger.error('Field %s has non-binary data!' % f)
-            raise Exception
 
-    if len(df.columns) == 0:
-        logger.error('After dropping N/A columns, no SNPs are left!.')
+def read_plink_input(args):
+    '''
+    Read a PLINK binary fileset (the .bed file given as --input_file, and the
+    .bim and .fam files next to it), with the dependent variables from
+    --phenotype_file, and drop the columns and rows with too many N/As as
+    read_table_input() does.  The genotypes stay packed (see
+    packed_genotypes.py; the .bed file uses the same layout) until the kept
+    SNPs and people are written out as "G|T" strings.  Returns the data frame
+    and its data columns.
+    '''
+    prefix = os.path.splitext(args.input_file)[0]
+    for suffix in ['.bim', '.fam']:
+        if not os.path.exists(prefix + suffix):
+            logger.error("Failure to find PLINK file %s" % (prefix + suffix))
+            raise OSError
+    if args.phenotype_file is None:
+        logger.info('PLINK input needs "--phenotype_file" with the dependent variables.')
         raise Exception
-    if len(df) == 0:
-        logger.error('After dropping N/A rows, no patients are left!.')
+    if not os.path.exists(args.phenotype_file):
+        logger.error("Failure to find phenotype file %s" % (args.phenotype_file))
+        raise OSError
+
+    df_bim = pd.read_csv(prefix + '.bim', sep=r'\s+', header=None, dtype=str,
+                         names=['chromosome', 'SNP', 'cM', 'position', 'allele_1', 'allele_2'])
+    df_fam = pd.read_csv(prefix + '.fam', sep=r'\s+', header=None, dtype=str,
+                         names=['family', 'sample', 'father', 'mother', 'sex', 'phenotype'])
+    num_SNPs = len(df_bim)
+    num_samples = len(df_fam)
+    width = packed_genotypes.packed_width(num_samples)
+    with open(args.input_file, 'rb') as fp:
+        magic = fp.read(len(BED_MAGIC))
+    if magic != BED_MAGIC:
+        logger.error('%s is not a SNP-major PLINK .bed file' % args.input_file)
+        raise Exception
+    if os.path.getsize(args.input_file) != len(BED_MAGIC) + num_SNPs * width:
+        logger.error('%s does not match its .bim and .fam files (%d SNPs, %d samples)' % (
+            args.input_file, num_SNPs, num_samples))
         raise Exception
+    packed = np.memmap(args.input_file, dtype=np.uint8, mode='r',
+                       offset=len(BED_MAGIC), shape=(num_SNPs, width))
 
-    num_na = df.isnull().sum(axis=1).sum()
-    logger.info("Detected %d N/A entries in input data" % num_na)
-    if num_na > 0 and args.never_na:
-        logger.error('Failing because of %d N/A values!' % num_na)
+    # Dependent variables, keyed by the sample ID (the .fam file's second
+    # column) in the first column.
+    if args.skip_rows is not None:
+        args.skip_rows = [int(x) for x in args.skip_rows.split(',')]
+    df_pheno = pd.read_csv(args.phenotype_file, skiprows=args.skip_rows)
+    df_pheno[df_pheno.columns[0]] = df_pheno[df_pheno.columns[0]].astype(str)
+    df_pheno = df_pheno.drop_duplicates(subset=df_pheno.columns[0]).set_index(
+        df_pheno.columns[0])
+    data_columns = [f for f in df_pheno.columns if f.startswith(args.data_prefix)]
+    if len(data_columns) == 0:
+        logger.error(
+            'Some data columns must begin with "%s" (set with --data_prefix); '
+            'none found.' % args.data_prefix)
         raise Exception
+    people = np.flatnonzero(df_fam['sample'].isin(df_pheno.index).values)
+    logger.info('%d of %d samples in %s have dependent variables in %s' % (
+        len(people), num_samples, args.input_file, args.phenotype_file))
+    df_labels = df_pheno.loc[df_fam['sample'].values[people], data_columns]
 
-    df.to_csv(sanitized_outfile, index=False)
-    logger.info('Detected %d SNPs and %d patients.' %
-                (len(df.columns), len(df)))
-    logger.info('Sanitized data rewritten as %s' % sanitized_outfile)
-    return
+    # SNPs are those with IDs of the form "rs12345*" (truncated to
+    # "rs12345") and single-base alleles.
+    p = re.compile(r'^rs\d+')
+    SNP_index = []
+    SNP_columns = []
+    bad_alleles = []
+    for (j, SNP) in enumerate(df_bim['SNP'].values):
+        x = p.match(SNP)
+        if x is None or SNP[:x.end()] in SNP_columns:
+            continue
+        if (df_bim['allele_1'].values[j] not in ['A', 'C', 'G', 'T'] or
+                df_bim['allele_2'].values[j] not in ['A', 'C', 'G', 'T']):
+            bad_alleles.append(SNP)
+            continue
+        SNP_index.append(j)
+        SNP_columns.append(SNP[:x.end()])
+    logger.info('Dropping %d SNPs without single-base alleles:' % len(bad_alleles))
+    logger.info(bad_alleles)
+    if len(SNP_columns) == 0:
+        logger.error(
+            'SNP IDs must be of form "rs12345"; no such SNPs found.')
+        raise Exception
+    SNP_index = np.array(SNP_index, dtype=int)
+    relevant_columns = SNP_columns + data_columns
+
+    # Drop columns with too many N/As, counting the missing genotypes of the
+    # selected people from the packed data.
+    in_study = np.zeros(num_samples, dtype=bool)
+    in_study[people] = True
+    called = np.zeros(len(SNP_index), dtype=int)
+    for start in xrange(0, len(SNP_index), BED_BLOCK_SNPS):
+        (_, called[start:start + BED_BLOCK_SNPS]) = packed_genotypes.carrier_counts(
+            packed[SNP_index[start:start + BED_BLOCK_SNPS]], in_study)
+    threshold = int((args.na_threshold) * len(people))
+    keep_SNP = (len(people) - called) <= threshold
+    keep_label = (df_labels.isnull().sum().values <= threshold)
+    drop_col = ([SNP for (SNP, keep) in zip(SNP_columns, keep_SNP) if not keep] +
+                [f for (f, keep) in zip(data_columns, keep_label) if not keep])
+    logger.info('Dropping %d columns because of N/As:' % (len(drop_col)))
+    logger.info(drop_col)
+    SNP_index = SNP_index[keep_SNP]
+    SNP_columns = [SNP for (SNP, keep) in zip(SNP_columns, keep_SNP) if keep]
+    df_labels = df_labels[[f for (f, keep) in zip(data_columns, keep_label) if keep]]
+
+    # Drop rows with too many N/As
+    missing = df_labels.isnull().sum(axis=1).values.astype(int)
+    for start in xrange(0, len(SNP_index), BED_BLOCK_SNPS):
+        X = packed_genotypes.unpack(packed[SNP_index[start:start + BED_BLOCK_SNPS]],
+                                    num_samples)
+        missing += (X[people] == packed_genotypes.MISSING).sum(axis=1)
+    threshold = int((args.na_threshold) * len(relevant_columns))
+    drop_row = list(df_fam['sample'].values[people[missing > threshold]])
+    logger.info('Dropping %d rows because of N/As:' % (len(drop_row)))
+    logger.info(drop_row)
+    people = people[missing <= threshold]
+    df_labels = df_labels[missing <= threshold]
+
+    # The .bim file's second allele (PLINK's reference allele) is the wild
+    # type.
+    df_wild = pd.DataFrame({'SNP': SNP_columns,
+                            'wild_type': df_bim['allele_2'].values[SNP_index]},
+                           columns=['SNP', 'wild_type'])
+    df_wild.to_csv(os.path.join(args.working_dir, 'wild_types.csv'), index=False)
+
+    # The .bed file counts copies of the .bim file's first allele.
+    columns = {}
+    for start in xrange(0, len(SNP_index), BED_BLOCK_SNPS):
+        block = SNP_index[start:start + BED_BLOCK_SNPS]
+        X = packed_genotypes.unpack(packed[block], num_samples)[people]
+        for (k, j) in enumerate(block):
+            (a1, a2) = (df_bim['allele_1'].values[j], df_bim['allele_2'].values[j])
+            genotypes = np.array([np.nan, a2 + '|' + a2, a1 + '|' + a2, a1 + '|' + a1],
+                                 dtype=object)
+            columns[SNP_columns[start + k]] = genotypes[X[:, k] + 1]
+    for f in df_labels.columns:
+        columns[f] = df_labels[f].values
+    df = pd.DataFrame(columns, columns=SNP_columns + list(df_labels.columns))
+    return(df, list(df_labels.columns))
 
 
 if __name__ == '__main__':
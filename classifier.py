@@ -4,33 +4,116 @@
 import numpy as np
 import pandas as pd
 import os
-from sklearn.model_selection import GridSearchCV
+import shutil
+import tempfile
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
 from sklearn.linear_model import SGDClassifier
+from sklearn.base import clone
 import utils_snpko as utils
-import operator
+import run_report
+import enet_logistic
+import selection_table
 import itertools
 from joblib import Parallel, delayed
-import datetime
 import halt_machine
 import traceback
+from scipy.stats import norm
 
 
 logger = utils.logger
 
 
-def single_FDR(child_num, SGD_max_iterations, args, one_label_field, knockoff_trial):
+def read_trial(args, knockoff_trial, shared_dir=None):
     '''
-    Computes both modified FDR (mFDR) and classical fdr (cFDR) for
-    a single feature, trained on a single knockoff trial.
+    Read the features (SNPs and their knockoffs, as allele counts) and labels
+    of a knockoff trial.  If shared_dir is given, the arrays are saved there
+    and returned memory-mapped (see utils.shared_array()), so that they can
+    be passed to every worker without copying.
     '''
     df = pd.read_csv(os.path.join(
         args.working_dir, 'knockoffs',
         'knockoffs_%03d.csv' % knockoff_trial))
 
     feature_fields = [field for field in df.columns if field.startswith('rs')]
+    label_fields = [field for field in df.columns if field.startswith(args.data_prefix)]
+    trial_data = {'feature_fields': feature_fields,
+                  'label_fields': label_fields,
+                  'features': np.array(df[feature_fields]).astype(np.int8),
+                  'labels': np.array(df[label_fields]).astype(float)}
+    if shared_dir is not None:
+        for key in ['features', 'labels']:
+            trial_data[key] = utils.shared_array(
+                trial_data[key], os.path.join(shared_dir, '%s_%03d.npy' % (key, knockoff_trial)))
+    return(trial_data)
+
+
+def cv_folds(labels, num_folds):
+    '''
+    Cross-validation folds, as a list of (train, test) index arrays, exactly
+    as GridSearchCV(cv=num_folds) makes them for a classifier.
+    '''
+    return(list(StratifiedKFold(n_splits=num_folds).split(np.zeros(len(labels)), labels)))
+
+
+def fold_blocks(features, labels, folds):
+    '''
+    For each fold, yield (X_train, y_train, X_test, y_test).  features may be
+    int8 (and memory-mapped); each fold's blocks are upcast to float only
+    when that fold is reached, so only one fold is held at a time.
+    '''
+    for (train, test) in folds:
+        yield(np.asarray(features[train], dtype=float), labels[train],
+              np.asarray(features[test], dtype=float), labels[test])
 
-    features = np.array(df[feature_fields]).astype(float)
-    labels = np.array(df[one_label_field]).astype(float)
+
+def grid_search(estimator, param_grid, features, labels, folds):
+    '''
+    Same result as GridSearchCV(estimator, param_grid, cv=folds, iid=True),
+    but each fold's blocks are made once and shared by every parameter
+    setting, rather than sliced from the features again for each one.
+
+    Returns a dict with best_estimator (refit on all of the data),
+    best_params, best_score, and params, mean_test_score and std_test_score
+    for every parameter setting.
+    '''
+    candidates = list(ParameterGrid(param_grid))
+    scores = np.empty((len(folds), len(candidates)))
+    for (k, (X_train, y_train, X_test, y_test)) in enumerate(
+            fold_blocks(features, labels, folds)):
+        for (c, params) in enumerate(candidates):
+            model = clone(estimator).set_params(**params)
+            scores[k, c] = model.fit(X_train, y_train).score(X_test, y_test)
+
+    # iid=True: weight each fold by its number of test samples.
+    weights = np.array([len(test) for (train, test) in folds], dtype=float)
+    mean = np.average(scores, axis=0, weights=weights)
+    std = np.sqrt(np.average((scores - mean) ** 2, axis=0, weights=weights))
+    best = int(np.argmax(mean))
+    best_estimator = clone(estimator).set_params(**candidates[best])
+    best_estimator.fit(np.asarray(features, dtype=float), labels)
+    return({'best_estimator': best_estimator, 'best_params': candidates[best],
+            'best_score': mean[best], 'params': candidates,
+            'mean_test_score': mean, 'std_test_score': std})
+
+
+def single_FDR(child_num, SGD_max_iterations, args, one_label_field, knockoff_trial,
+               trial_data=None, folds=None):
+    '''
+    Computes both modified FDR (mFDR) and classical fdr (cFDR) for
+    a single feature, trained on a single knockoff trial.  trial_data is
+    the trial as returned by read_trial(), and folds the cross-validation
+    folds for this label (see cv_folds()); by default they are made here.
+    '''
+    if trial_data is None:
+        trial_data = read_trial(args, knockoff_trial)
+
+    feature_fields = trial_data['feature_fields']
+
+    features = trial_data['features']
+    labels = np.array(trial_data['labels'][
+        :, trial_data['label_fields'].index(one_label_field)])
+    if folds is None:
+        folds = cv_folds(labels, args.cv)
 
     # Set the parameters by cross-validation
     tuned_parameters = [{'alpha': np.power(
@@ -40,24 +123,28 @@ def single_FDR(child_num, SGD_max_iterations, args, one_label_field, knockoff_tr
     assert child_num < 10000
     seed = args.random_seed + child_num
 
-    # loss='log' is logistic regression
-    clf = GridSearchCV(SGDClassifier(loss='log', penalty='elasticnet',
-                                     max_iter=SGD_max_iterations,
-                                     random_state=seed, tol=args.tol,
-                                     n_iter_no_change=args.n_iter_no_change),
-                       tuned_parameters, cv=args.cv, n_jobs=1, iid=True)
-
-    clf.fit(features, labels)
+    if args.classifier_engine == 'cd':
+        clf = enet_logistic.grid_search(tuned_parameters, features, labels, folds,
+                                        tolerance=args.cd_tolerance)
+        coef = clf['coef']
+    else:
+        # loss='log' is logistic regression
+        clf = grid_search(SGDClassifier(loss='log', penalty='elasticnet',
+                                        max_iter=SGD_max_iterations,
+                                        random_state=seed, tol=args.tol,
+                                        n_iter_no_change=args.n_iter_no_change),
+                          tuned_parameters, features, labels, folds)
+        coef = clf['best_estimator'].coef_[0]
 
     logger.debug("Best parameters set found on development set:")
-    logger.debug("GRID_PARAMS: %s" % (clf.best_params_))
-    logger.debug("Best score: %.4f" % (clf.best_score_))
+    logger.debug("GRID_PARAMS: %s" % (clf['best_params']))
+    logger.debug("Best score: %.4f" % (clf['best_score']))
     # Disabling this for now; it's just too verbose.
     if False and args.verbose:
         logger.debug("Grid scores on development set:")
-        means = clf.cv_results_['mean_test_score']
-        stds = clf.cv_results_['std_test_score']
-        for mean, std, params in zip(means, stds, clf.cv_results_['params']):
+        means = clf['mean_test_score']
+        stds = clf['std_test_score']
+        for mean, std, params in zip(means, stds, clf['params']):
             logger.debug("%0.3f (+/-%0.03f) for %r"
                          % (mean, std * 2, params))
 
@@ -67,61 +154,92 @@ def single_FDR(child_num, SGD_max_iterations, args, one_label_field, knockoff_tr
 
     stat_list = []
     for i in xrange(0, len(feature_fields), 2):
-        W = np.abs(clf.best_estimator_.coef_[0][
-            i]) - np.abs(clf.best_estimator_.coef_[0][i + 1])
+        W = np.abs(coef[i]) - np.abs(coef[i + 1])
         stat_list.append(W)
 
-    stat_list = np.array(stat_list)
-
-    # Implement Equation 3.11 of Candes et al 2017
-    tau_mFDR = np.inf  # Modified FDR
-    tau_cFDR = np.inf  # Classical FDR
-    for W in stat_list:
-        if W <= 0:
-            continue
-        if W >= tau_mFDR and W >= tau_cFDR:
-            continue
-
-        ratio_mFDR = 1.0 * (np.sum(stat_list <= -W)) / \
-            (np.sum(stat_list >= W))
-        ratio_cFDR = 1.0 * (1 + np.sum(stat_list <= -W)) / \
-            (np.sum(stat_list >= W))
-
-        if ratio_mFDR < args.fdr:
-            tau_mFDR = W
-        if ratio_cFDR < args.fdr:
-            tau_cFDR = W
+    stat_list = selection_table.saved_W(stat_list)
+
+    (tau_mFDR, tau_cFDR) = selection_table.knockoff_thresholds(stat_list, args.fdr)
     logger.debug("tau_mFDR = %.3f, tau_cFDR = %.3f" %
                  (tau_mFDR, tau_cFDR))
 
-    SNP_list_mFDR = []
-    SNP_list_cFDR = []
-    for i, stat in enumerate(stat_list):
-        SNP = feature_fields[2 * i]
-
-        if stat >= tau_mFDR:
-            SNP_list_mFDR.append(SNP)
-        if stat >= tau_cFDR:
-            SNP_list_cFDR.append(SNP)
-    return(one_label_field, SNP_list_mFDR, SNP_list_cFDR)
+    SNPs = feature_fields[::2]
+    return(one_label_field, knockoff_trial, SNPs, stat_list,
+           stat_list >= tau_mFDR, stat_list >= tau_cFDR)
 
 
-def significant_SNPs(args):
+def classify_trials(args, label_fields, trial_list):
     '''
-    Determine which SNPs are actually significant predictors of features.
+    Run single_FDR() (in parallel) for every label on each knockoff trial in
+    trial_list.
+    '''
+    # Each trial is read once and shared with the workers through
+    # memory-mapped files, rather than read again for every label.
+    shared_dir = tempfile.mkdtemp(prefix='shared_', dir=args.working_dir)
+    try:
+        trial_data = dict((trial, read_trial(args, trial, shared_dir=shared_dir))
+                          for trial in trial_list)
+        # The labels are the same in every trial, so the cross-validation
+        # folds of each label are made once.
+        folds = {}
+        if trial_data:
+            one_trial = trial_data[trial_list[0]]
+            for (label_index, one_label_field) in enumerate(one_trial['label_fields']):
+                folds[one_label_field] = cv_folds(one_trial['labels'][:, label_index], args.cv)
+        # child_num is the index into product(label_fields, all trials), so that
+        # a trial gets the same random seed however the trials are batched.
+        timed_results = Parallel(n_jobs=args.num_workers)(
+            delayed(run_report.timed_call)(
+                single_FDR, label_index * args.num_knockoff_trials + trial,
+                args.SGD_max_iterations, args, one_label_field, trial,
+                trial_data=trial_data[trial], folds=folds[one_label_field])
+            for (label_index, one_label_field), trial in itertools.product(
+                enumerate(label_fields), trial_list))
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    results = run_report.record_tasks('single_FDR', timed_results)
+    run_report.add_counts(fits=len(results))
+    return(results)
+
+
+def tally_results(results, summarized):
+    '''
+    Add the SNPs selected in single_FDR() results to the running count of
+    how often each SNP was selected, summarized[label][fdr][SNP].
     '''
+    for (one_label_field, _, SNPs, _, selected_mFDR, selected_cFDR) in results:
+        if one_label_field not in summarized:
+            summarized[one_label_field] = {'mFDR': {}, 'cFDR': {}}
+        for selected, fdr in [(selected_mFDR, 'mFDR'), (selected_cFDR, 'cFDR')]:
+            for SNP in np.array(SNPs)[selected]:
+                if SNP not in summarized[one_label_field][fdr]:
+                    summarized[one_label_field][fdr][SNP] = 0
+                summarized[one_label_field][fdr][SNP] += 1
+    return(summarized)
 
-    logger.info("####################################")
-    logger.info("Classifier for significance.")
 
-    logger.info("SGD iterations: %d" % args.SGD_max_iterations)
+def write_selections(args, results, label_fields, num_trials):
+    '''
+    Store the W statistics and selections of every single_FDR() result in
+    the results directory, as a table and as an array of W statistics (see
+    selection_table.py).
+    '''
+    SNPs = results[0][2]
+    assert all(list(result[2]) == list(SNPs) for result in results)
+    results = [(one_label_field, trial, W, selected_mFDR, selected_cFDR)
+               for (one_label_field, trial, _, W, selected_mFDR, selected_cFDR) in results]
+    selection_table.write(os.path.join(args.results_dir, selection_table.FILENAME),
+                          results, label_fields, SNPs, args.fdr, num_trials)
+    selection_table.write_W_statistics(
+        os.path.join(args.results_dir, selection_table.W_FILENAME), results, label_fields)
 
-    logger.info("Target FDR: %.2f" % args.fdr)
 
-    # Extract list of data labels (i.e., the dependent variables we're trying to
-    # predict)
-    df_for_field_names = pd.read_csv(
-        os.path.join(args.working_dir, 'pruned_experiment.csv'))
+def extract_fields(args):
+    '''
+    Extract list of data labels (i.e., the dependent variables we're trying to
+    predict) and features (i.e., SNPs).
+    '''
+    df_for_field_names = pd.read_csv(utils.knockoff_input_file(args, 'experiment.csv'))
     label_fields = [
         field for field in df_for_field_names.columns if field.startswith(args.data_prefix)]
     feature_fields = [
@@ -133,51 +251,137 @@ def significant_SNPs(args):
 
     logger.info('Label fields:')
     logger.info(label_fields)
+    return(label_fields, feature_fields)
+
+
+def significant_SNPs(args):
+    '''
+    Determine which SNPs are actually significant predictors of features.
+    '''
+
+    logger.info("####################################")
+    logger.info("Classifier for significance.")
+
+    if args.classifier_engine == 'cd':
+        logger.info("Coordinate descent tolerance: %g" % args.cd_tolerance)
+    else:
+        logger.info("SGD iterations: %d" % args.SGD_max_iterations)
+
+    logger.info("Target FDR: %.2f" % args.fdr)
+
+    (label_fields, feature_fields) = extract_fields(args)
 
     utils.safe_mkdir(os.path.join(args.working_dir, 'results'))
 
     # Do the work (in parallel)
-    results = (Parallel(n_jobs=args.num_workers)
-               (delayed(single_FDR)(child_num, args.SGD_max_iterations, args, *x)
-                for child_num, x in enumerate(itertools.product(label_fields,
-                                                                xrange(args.num_knockoff_trials)))))
+    results = classify_trials(args, label_fields,
+                              xrange(args.num_knockoff_trials))
 
-    summarized = {}
-    for (one_label_field, SNP_list_mFDR, SNP_list_cFDR) in results:
-        if one_label_field not in summarized:
-            summarized[one_label_field] = {'mFDR': {}, 'cFDR': {}}
-        for l, fdr in [(SNP_list_mFDR, 'mFDR'), (SNP_list_cFDR, 'cFDR')]:
-            for SNP in l:
-                if SNP not in summarized[one_label_field][fdr]:
-                    summarized[one_label_field][fdr][SNP] = 0
-                summarized[one_label_field][fdr][SNP] += 1
+    write_selections(args, results, label_fields, args.num_knockoff_trials)
 
-    out_fp = open(os.path.join(args.results_dir, 'knockoff_trials.txt'), 'w')
-    out_fp.write(
-        'Using the HMM knockoff framework, and applying the method %d times\n'
-        'with independent knockoff samples, determine which SNPs are significant\n'
-        'predictors of which data labels (i.e., dependent variables).\n\n'
-        'We examine both a classical FDR (cFDR) and a modified FDR (mFDR),\n'
-        'per Candes 2017, Equations 3.10 and 3.11.\n\n' % (
-            args.num_knockoff_trials))
-    out_fp.write('Target FDR: %.1f%%\n\n' % (100.0 * (args.fdr)))
-    out_fp.write(str(datetime.datetime.now()))
-    out_fp.write('\n')
-    for one_label_field in summarized:
-        out_fp.write('Label: %s\n' % one_label_field)
+    logger.info('Done with classifier!')
+
+
+def undecided_obs_freq(args, summarized, label_fields, feature_fields, num_trials):
+    '''
+    For every (label, fdr, SNP), compute a Wilson score interval for the
+    running obs_freq after num_trials knockoff trials.  A triple is
+    "undecided" if its interval still contains the --obs_freq decision
+    boundary.
+
+    Returns (number of undecided triples, list of trace rows).
+    '''
+    z = norm.ppf(0.5 + args.trial_confidence / 2.0)
+    num_undecided = 0
+    trace = []
+    for one_label_field in label_fields:
         for fdr in ['mFDR', 'cFDR']:
-            out_fp.write('Type of FDR: %s\n' % fdr)
-            if len(summarized[one_label_field][fdr]) == 0:
-                out_fp.write('  No significant SNPs.\n')
-            else:
-                sorted_SNPs = sorted(
-                    summarized[one_label_field][fdr].items(),
-                    key=operator.itemgetter(1), reverse=True)
-                for (SNP, count) in sorted_SNPs:
-                    percentage = 100.0 * count / args.num_knockoff_trials
-                    out_fp.write("   %s : %d%%\n" %
-                                 (SNP, np.round(percentage)))
-    out_fp.close()
+            counts = summarized.get(one_label_field, {}).get(fdr, {})
+            for SNP in feature_fields:
+                count = counts.get(SNP, 0)
+                obs_freq = 1.0 * count / num_trials
+                center = (obs_freq + z * z / (2.0 * num_trials)) / \
+                    (1.0 + z * z / num_trials)
+                half_width = (z / (1.0 + z * z / num_trials)) * np.sqrt(
+                    obs_freq * (1.0 - obs_freq) / num_trials +
+                    z * z / (4.0 * num_trials * num_trials))
+                decided = not (center - half_width <= args.obs_freq <=
+                               center + half_width)
+                if not decided:
+                    num_undecided += 1
+                if count > 0 or not decided:
+                    trace.append((num_trials, one_label_field, fdr, SNP, count,
+                                  obs_freq, center - half_width,
+                                  center + half_width, decided))
+    return(num_undecided, trace)
+
+
+def adaptive_significant_SNPs(args):
+    '''
+    Like make_knockoffs.make_all_knockoffs() followed by significant_SNPs(),
+    but generate and classify knockoff trials in batches of
+    --trial_batch_size.  After each batch, stop if every running obs_freq is
+    confidently above or below --obs_freq; --num_knockoff_trials is the
+    maximum number of trials.
+
+    Trial seeds do not depend on the batching, so stopping after T trials
+    gives the same selections as a fixed run of T trials.
+    '''
+
+    # Only this mode generates knockoffs, so only it pays to import SNPknock.
+    import make_knockoffs
+
+    logger.info("####################################")
+    logger.info("Adaptive knockoff trials and classifier for significance.")
+
+    if args.classifier_engine == 'cd':
+        logger.info("Coordinate descent tolerance: %g" % args.cd_tolerance)
+    else:
+        logger.info("SGD iterations: %d" % args.SGD_max_iterations)
+
+    logger.info("Target FDR: %.2f" % args.fdr)
+
+    (label_fields, feature_fields) = extract_fields(args)
+
+    utils.safe_mkdir(os.path.join(args.working_dir, 'results'))
+    utils.safe_mkdir(args.results_dir)
+
+    summarized = {}
+    results = []
+    trace = []
+    num_trials = 0
+    while num_trials < args.num_knockoff_trials:
+        trial_list = range(num_trials, min(num_trials + args.trial_batch_size,
+                                           args.num_knockoff_trials))
+        make_knockoffs.make_all_knockoffs(args, trial_list=trial_list)
+        batch_results = classify_trials(args, label_fields, trial_list)
+        tally_results(batch_results, summarized)
+        results += batch_results
+        num_trials = trial_list[-1] + 1
+
+        (num_undecided, batch_trace) = undecided_obs_freq(
+            args, summarized, label_fields, feature_fields, num_trials)
+        trace += batch_trace
+        logger.info('After %d trials: %d of %d (label, fdr, SNP) obs_freqs '
+                    'undecided at obs_freq=%.2f' % (
+                        num_trials, num_undecided,
+                        2 * len(label_fields) * len(feature_fields), args.obs_freq))
+        if num_undecided == 0:
+            break
+
+    if num_trials < args.num_knockoff_trials:
+        logger.info('Converged after %d of at most %d knockoff trials' % (
+            num_trials, args.num_knockoff_trials))
+    else:
+        logger.info('Reached maximum of %d knockoff trials' % num_trials)
+
+    df_trace = pd.DataFrame(trace, columns=[
+        'num_trials', 'label', 'fdr_type', 'SNP', 'count', 'obs_freq',
+        'ci_low', 'ci_high', 'decided'])
+    df_trace.to_csv(os.path.join(args.results_dir, 'convergence_trace.csv'),
+                    index=False)
+
+    write_selections(args, results, label_fields, num_trials)
 
     logger.info('Done with classifier!')
 
@@ -189,7 +393,10 @@ if __name__ == '__main__':
     # Because this step takes so long, we allow halting here if
     # called from command line.
     try:
-        significant_SNPs(args)
+        if args.adaptive_trials:
+            adaptive_significant_SNPs(args)
+        else:
+            significant_SNPs(args)
         halt_machine.possibly_halt(args)
     except Exception:
         logger.warn(traceback.format_exc())
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Bulk transfer of files to and from cloud storage (Google cloud storage or
+# AWS S3).
+#
+# Clients are created once per process and then reused (they are safe to
+# share between threads), rather than re-authenticating for every file.  Bulk
+# uploads and downloads run on a thread pool, retry failed transfers, verify
+# MD5 checksums, and skip files whose size and checksum already match at the
+# destination.
+#
+# For testing against local stand-ins: the Google cloud client honors the
+# STORAGE_EMULATOR_HOST environment variable (e.g., for fake-gcs-server), in
+# which case we use anonymous credentials; boto3 can be redirected with the
+# usual AWS configuration, or intercepted with moto.
+#
+# The cloud SDKs are slow to import, so they are only imported when the first
+# client is created.
+
+import base64
+import binascii
+import hashlib
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import utils_snpko as utils
+
+logger = utils.logger
+
+PROVIDERS = ['gcloud', 'aws']
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _forget_other_processes():
+    '''
+    Drop the clients inherited from a parent process (which cannot be used
+    after a fork).  Call with _clients_lock held.
+    '''
+    for key in list(_clients):
+        if key[1] != os.getpid():
+            del _clients[key]
+
+
+def gcloud_client():
+    '''
+    Google cloud storage client, cached per process.  (It can be shared by
+    threads.)
+    '''
+    key = ('gcloud', os.getpid())
+    with _clients_lock:
+        if key not in _clients:
+            _forget_other_processes()
+            import google.cloud.storage
+            import google.auth
+            import google.auth.credentials
+            if os.environ.get('STORAGE_EMULATOR_HOST'):
+                _clients[key] = google.cloud.storage.Client(
+                    credentials=google.auth.credentials.AnonymousCredentials(),
+                    project='snpko-test')
+            else:
+                credentials, project = google.auth.default()
+                _clients[key] = google.cloud.storage.Client(
+                    credentials=credentials, project=project)
+        return(_clients[key])
+
+
+def gcloud_bucket(bucket_name):
+    '''
+    Handle to a Google cloud bucket.  (Unlike client.get_bucket(), this does
+    not cost a round trip to the server.)
+    '''
+    return(gcloud_client().bucket(bucket_name))
+
+
+def aws_client():
+    '''
+    S3 client, cached per process.  (boto3 clients are thread-safe.)
+    '''
+    key = ('aws', os.getpid())
+    with _clients_lock:
+        if key not in _clients:
+            _forget_other_processes()
+            import boto3
+            _clients[key] = boto3.client('s3')
+        return(_clients[key])
+
+
+def file_md5(filename):
+    '''
+    Hex MD5 digest of a local file.
+    '''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            md5.update(chunk)
+    return(md5.hexdigest())
+
+
+def remote_info(provider, bucket_name, name):
+    '''
+    Return (size, hex MD5) of a remote object, or None if it does not exist.
+    The MD5 is None if the server does not report one (e.g., S3 multipart
+    uploads, whose ETag is not an MD5).
+    '''
+    if provider == 'gcloud':
+        blob = gcloud_bucket(bucket_name).get_blob(name)
+        if blob is None:
+            return(None)
+        md5 = None
+        if blob.md5_hash:
+            md5 = binascii.hexlify(base64.b64decode(blob.md5_hash)).decode('ascii')
+        return(blob.size, md5)
+    else:
+        s3 = aws_client()
+        try:
+            head = s3.head_object(Bucket=bucket_name, Key=name)
+        except s3.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['404', 'NoSuchKey', 'NotFound']:
+                return(None)
+            raise
+        etag = head.get('ETag', '').strip('"')
+        md5 = etag if (etag and '-' not in etag) else None
+        return(head['ContentLength'], md5)
+
+
+def same_contents(local_name, info):
+    '''
+    Does the local file match remote (size, md5) info?
+    '''
+    if info is None or not os.path.exists(local_name):
+        return(False)
+    (size, md5) = info
+    if os.path.getsize(local_name) != size:
+        return(False)
+    return(md5 is None or file_md5(local_name) == md5)
+
+
+def _with_retries(fn, description, retries):
+    for attempt in xrange(retries + 1):
+        try:
+            return(fn())
+        except Exception:
+            if attempt == retries:
+                logger.info('Giving up on %s after %d attempts' % (
+                    description, retries + 1))
+                raise
+            wait = 2 ** attempt
+            logger.info('Retrying %s in %ds (attempt %d failed)' % (
+                description, wait, attempt + 1))
+            time.sleep(wait)
+
+
+def upload_file(provider, bucket_name, source_name, destination_name,
+                retries=3, SSE=True):
+    '''
+    Upload a single file unless an identical copy is already there.
+    Returns True if the file was transferred, False if it was skipped.
+    '''
+    def attempt():
+        try:
+            info = remote_info(provider, bucket_name, destination_name)
+        except Exception:
+            # E.g., write-only credentials; just upload.
+            info = None
+        if same_contents(source_name, info):
+            return(False)
+        if provider == 'gcloud':
+            blob = gcloud_bucket(bucket_name).blob(destination_name)
+            try:
+                blob.upload_from_filename(source_name)
+            except Exception:
+                logger.info(
+                    "Gcloud upload failure; check that instance has write access to "
+                    "'Google storage'.")
+                raise
+        else:
+            if SSE:
+                aws_client().upload_file(source_name, bucket_name, destination_name,
+                                         ExtraArgs={'ServerSideEncryption': "AES256"})
+            else:
+                aws_client().upload_file(source_name, bucket_name, destination_name)
+        info = remote_info(provider, bucket_name, destination_name)
+        if info is not None and not same_contents(source_name, info):
+            raise IOError('Checksum mismatch after uploading %s' % source_name)
+        return(True)
+
+    return(_with_retries(attempt, 'upload of %s to %s:%s' % (
+        source_name, bucket_name, destination_name), retries))
+
+
+def download_file(provider, bucket_name, source_name, destination_name,
+                  retries=3):
+    '''
+    Download a single object unless an identical local copy exists.
+    Returns True if the file was transferred, False if it was skipped.
+    '''
+    def attempt():
+        info = remote_info(provider, bucket_name, source_name)
+        if info is None:
+            raise IOError('%s:%s does not exist' % (bucket_name, source_name))
+        if same_contents(destination_name, info):
+            return(False)
+        # Download to a temporary name and rename, so an interrupted transfer
+        # never leaves a truncated file under the final name.
+        tmp_name = '%s.tmp.%d' % (destination_name, os.getpid())
+        if provider == 'gcloud':
+            gcloud_bucket(bucket_name).blob(source_name).download_to_filename(tmp_name)
+        else:
+            aws_client().download_file(bucket_name, source_name, tmp_name)
+        if not same_contents(tmp_name, info):
+            os.unlink(tmp_name)
+            raise IOError('Checksum mismatch after downloading %s' % source_name)
+        os.rename(tmp_name, destination_name)
+        return(True)
+
+    return(_with_retries(attempt, 'download of %s:%s' % (
+        bucket_name, source_name), retries))
+
+
+def _run_pool(fn, jobs, num_threads):
+    if len(jobs) == 0:
+        return([])
+    pool = ThreadPool(max(1, min(num_threads, len(jobs))))
+    try:
+        return(pool.map(fn, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def upload_files(provider, bucket_name, pairs, num_threads=8, retries=3):
+    '''
+    Upload a list of (source_name, destination_name) pairs in parallel.
+    '''
+    transferred = _run_pool(
+        lambda pair: upload_file(provider, bucket_name, pair[0], pair[1],
+                                 retries=retries),
+        list(pairs), num_threads)
+    logger.info('Uploaded %d files to %s bucket %s (%d already up to date)' % (
+        sum(transferred), provider, bucket_name,
+        len(transferred) - sum(transferred)))
+
+
+def download_files(provider, bucket_name, pairs, num_threads=8, retries=3):
+    '''
+    Download a list of (source_name, destination_name) pairs in parallel.
+    '''
+    transferred = _run_pool(
+        lambda pair: download_file(provider, bucket_name, pair[0], pair[1],
+                                   retries=retries),
+        list(pairs), num_threads)
+    logger.info('Downloaded %d files from %s bucket %s (%d already up to date)' % (
+        sum(transferred), provider, bucket_name,
+        len(transferred) - sum(transferred)))
+
+
+def list_files(provider, bucket_name, prefix=None, delimiter=None):
+    if provider == 'gcloud':
+        blobs = gcloud_bucket(bucket_name).list_blobs(prefix=prefix,
+                                                      delimiter=delimiter)
+        return([blob.name for blob in blobs])
+    else:
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix or ''}
+        if delimiter is not None:
+            kwargs['Delimiter'] = delimiter
+        paginator = aws_client().get_paginator('list_objects_v2')
+        list_of_names = []
+        for page in paginator.paginate(**kwargs):
+            list_of_names += [obj['Key'] for obj in page.get('Contents', [])]
+        return(list_of_names)
+
+
+def download_prefix(provider, bucket_name, prefix, destination_dir,
+                    num_threads=8, retries=3):
+    '''
+    Download every object whose name starts with prefix into destination_dir
+    (flattening any "directories" in the object names).
+    '''
+    utils.safe_mkdir(destination_dir)
+    pairs = [(f, os.path.join(destination_dir, os.path.basename(f)))
+             for f in list_files(provider, bucket_name, prefix=prefix)
+             if not f.endswith('/')]
+    download_files(provider, bucket_name, pairs, num_threads=num_threads,
+                   retries=retries)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Elastic-net logistic regression by coordinate descent, as an alternative to
+# the SGDClassifier grid search in classifier.py.
+#
+# Minimizes the same objective as SGDClassifier(loss='log',
+# penalty='elasticnet'), so that the grid of (alpha, l1_ratio) means the
+# same thing:
+#    mean log loss + alpha * (l1_ratio * |w|_1 + (1 - l1_ratio) / 2 * |w|^2)
+# with an unpenalized intercept.  Each fit is iteratively reweighted least
+# squares, as in glmnet (Friedman, Hastie & Tibshirani 2010), with each
+# weighted least squares step solved by coordinate descent in scikit-learn's
+# ElasticNet.  Unlike SGD, the result is deterministic.
+# Features are not standardized (neither does the SGD engine), so that a
+# SNP and its knockoff stay on the same scale.
+#
+# For each l1_ratio, the alphas are fit as a path from largest to smallest,
+# each fit warm-started from the previous one.  Coordinate descent only
+# visits a working set of features: those that are nonzero in the previous
+# fit, or whose gradient there already exceeds the new penalty.  After each
+# fit a KKT check adds back any feature that was wrongly left out.  (The
+# sequential strong rule of Tibshirani et al. (2012) discards nothing when
+# successive alphas are more than a factor of 2 apart, as on the default
+# grid of classifier.py.)
+
+import warnings
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import ElasticNet
+from sklearn.model_selection import ParameterGrid
+
+MAX_IRLS_ITERATIONS = 100
+MAX_CD_ITERATIONS = 1000
+MAX_STEP_HALVINGS = 30
+# Keeps IRLS weights away from 0 when the fitted probabilities saturate.
+MIN_WEIGHT = 1e-5
+
+
+def _probability(f):
+    return(1.0 / (1.0 + np.exp(-np.clip(f, -35.0, 35.0))))
+
+
+def _objective(X, y, w, b, alpha, l1_ratio):
+    f = b + np.dot(X, w)
+    # log(1 + exp(f)) - y * f, computed stably
+    loss = np.mean(np.logaddexp(0.0, f) - y * f)
+    return(loss + alpha * (l1_ratio * np.abs(w).sum() +
+                           0.5 * (1.0 - l1_ratio) * np.dot(w, w)))
+
+
+def _fit(X, y, alpha, l1_ratio, w, b, active, tolerance):
+    '''
+    Minimize the objective over the features in active (the others stay
+    at zero), starting from (w, b).  Returns (w, b).
+
+    Each IRLS step is a weighted least squares problem.  With the intercept
+    eliminated by (weighted) centering and the rows scaled by the square
+    roots of the weights, it is exactly the problem ElasticNet solves
+    (by coordinate descent), with the same alpha and l1_ratio.
+    '''
+    n = len(y)
+    w = w.copy()
+    if len(active) == 0:
+        # Only the intercept, which fits the mean of the labels.
+        mean = np.clip(np.mean(y), 1e-6, 1.0 - 1e-6)
+        return(w, np.log(mean / (1.0 - mean)))
+    XA = X[:, active]
+    beta = w[active]
+    objective = _objective(X, y, w, b, alpha, l1_ratio)
+    # With more people than active features, coordinate descent is cheaper
+    # on their Gram matrix than on the residuals.
+    model = ElasticNet(alpha=alpha, l1_ratio=l1_ratio, fit_intercept=False,
+                       precompute=len(active) < n, tol=tolerance,
+                       max_iter=MAX_CD_ITERATIONS, warm_start=True)
+    for iteration in xrange(MAX_IRLS_ITERATIONS):
+        (beta_old, b_old) = (beta.copy(), b)
+        f = b + np.dot(XA, beta)
+        p = _probability(f)
+        weights = np.maximum(p * (1.0 - p), MIN_WEIGHT)
+        working_response = f + (y - p) / weights
+        total_weight = weights.sum()
+        x_mean = np.dot(weights, XA) / total_weight
+        z_mean = np.dot(weights, working_response) / total_weight
+        centered = XA - x_mean
+        root_weights = np.sqrt(weights)
+        model.coef_ = beta.copy()
+        with warnings.catch_warnings():
+            # A single IRLS step need not be solved exactly (e.g., when the
+            # classes are nearly separable); convergence is tested below.
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            model.fit(root_weights[:, None] * centered,
+                      root_weights * (working_response - z_mean))
+        beta = model.coef_.copy()
+        b = z_mean - np.dot(x_mean, beta)
+
+        # IRLS can overshoot when the fitted probabilities are near 0 or 1;
+        # step back towards the previous point until the objective decreases.
+        w[active] = beta
+        new_objective = _objective(X, y, w, b, alpha, l1_ratio)
+        for halving in xrange(MAX_STEP_HALVINGS):
+            if new_objective <= objective + 1e-12 * abs(objective):
+                break
+            beta = 0.5 * (beta + beta_old)
+            b = 0.5 * (b + b_old)
+            w[active] = beta
+            new_objective = _objective(X, y, w, b, alpha, l1_ratio)
+        # Largest change in the fit, as in glmnet's convergence test.
+        weighted_variance = np.dot(weights, centered ** 2) / n
+        step = max((b - b_old) ** 2 * total_weight / n,
+                   np.max(weighted_variance * (beta - beta_old) ** 2))
+        objective = new_objective
+        if step < tolerance:
+            break
+    return(w, b)
+
+
+def path(X, y, alphas, l1_ratio, tolerance=1e-6):
+    '''
+    Fits for each of alphas (in decreasing order) with the given l1_ratio, on
+    features X (n x d, float) and labels y (0 or 1).  Returns a list of
+    (w, b), one per alpha.
+    '''
+    (n, d) = X.shape
+    mean = np.clip(np.mean(y), 1e-6, 1.0 - 1e-6)
+    b = np.log(mean / (1.0 - mean))
+    w = np.zeros(d)
+    # |gradient| of the mean log loss, at the intercept-only fit.
+    gradient = np.abs(np.dot(X.T, y - mean)) / n
+
+    fits = []
+    for alpha in alphas:
+        # Working set: the nonzero features of the previous fit, and those
+        # whose gradient there would violate the KKT conditions at this
+        # alpha.  The check below adds any that are missed.
+        keep = (gradient >= l1_ratio * alpha) | (w != 0)
+        while True:
+            (w, b) = _fit(X, y, alpha, l1_ratio, w, b, np.flatnonzero(keep), tolerance)
+            gradient = np.abs(np.dot(X.T, y - _probability(b + np.dot(X, w)))) / n
+            # KKT: a feature held at 0 must have |gradient| <= l1_ratio * alpha.
+            violations = ~keep & (gradient > l1_ratio * alpha * (1 + 1e-6))
+            if not violations.any():
+                break
+            keep |= violations
+        fits.append((w.copy(), b))
+    return(fits)
+
+
+def _accuracy(X, y, w, b):
+    return(np.mean((b + np.dot(X, w) > 0) == (y > 0)))
+
+
+def grid_search(param_grid, features, labels, folds, tolerance=1e-6):
+    '''
+    As classifier.grid_search() with an elastic-net SGDClassifier, but with
+    the coordinate descent fits above: every fold is fit along the whole
+    alpha path for each l1_ratio.  features may be int8 (and memory-mapped);
+    labels must be 0 or 1.
+
+    Returns a dict with coef (of the fit on all the data with the best
+    parameters), intercept, best_params, best_score, and params,
+    mean_test_score and std_test_score for every parameter setting.
+    '''
+    candidates = list(ParameterGrid(param_grid))
+    alphas = np.array(sorted(set(c['alpha'] for c in candidates), reverse=True))
+    l1_ratios = sorted(set(c['l1_ratio'] for c in candidates))
+    # scores[k, (alpha, l1_ratio)]
+    scores = [{} for fold in folds]
+    for (k, (train, test)) in enumerate(folds):
+        X_train = np.asarray(features[train], dtype=float)
+        X_test = np.asarray(features[test], dtype=float)
+        (y_train, y_test) = (labels[train], labels[test])
+        for l1_ratio in l1_ratios:
+            for (alpha, (w, b)) in zip(alphas, path(X_train, y_train, alphas, l1_ratio,
+                                                    tolerance)):
+                scores[k][(alpha, l1_ratio)] = _accuracy(X_test, y_test, w, b)
+    scores = np.array([[fold_scores[(c['alpha'], c['l1_ratio'])] for c in candidates]
+                       for fold_scores in scores])
+
+    # As GridSearchCV with iid=True.
+    weights = np.array([len(test) for (train, test) in folds], dtype=float)
+    mean = np.average(scores, axis=0, weights=weights)
+    std = np.sqrt(np.average((scores - mean) ** 2, axis=0, weights=weights))
+    best = int(np.argmax(mean))
+    best_alpha = candidates[best]['alpha']
+    X = np.asarray(features, dtype=float)
+    (w, b) = path(X, labels, alphas[alphas >= best_alpha],
+                  candidates[best]['l1_ratio'], tolerance)[-1]
+    return({'coef': w, 'intercept': b, 'best_params': candidates[best],
+            'best_score': mean[best], 'params': candidates,
+            'mean_test_score': mean, 'std_test_score': std})
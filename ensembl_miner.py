@@ -10,9 +10,13 @@
 
 import requests
 import cPickle as pickle
+import numpy as np
 import pandas as pd
 import os
 import utils_snpko as utils
+import run_report
+import cache_entry
+import genotype_store
 from joblib import Parallel, delayed
 import multiprocessing
 
@@ -27,23 +31,38 @@ def grab_individual_genotypes(SNP, cache_dir):
     json_file = os.path.join(cache_dir, str(SNP))
     logger.debug("Downloading SNP %s" % SNP)
 
-    if os.path.exists(json_file):
-        # Try to grab ENSEMBL data from cache...
-        decoded = pickle.load(open(json_file))
-    else:
-        # ...if not in cache, fetch it from server
-        server = "https://rest.ensembl.org"
-        ext = "/variation/human/%s?genotypes=1" % (SNP)
-
-        r = requests.get(
-            server + ext, headers={"Content-Type": "application/json"})
-
-        if not r.ok:
-            # Calling code can capture exceptions (e.g., 404) here.
-            r.raise_for_status()
-
-        decoded = r.json()
-        pickle.dump(decoded, open(json_file, 'w'))
+    # The cache may be shared with other processes (studies, p-value workers)
+    # running at the same time; see cache_entry.py.
+    with cache_entry.lock(json_file):
+        decoded = None
+        if cache_entry.is_complete(json_file, [json_file]):
+            # Try to grab ENSEMBL data from cache...
+            decoded = pickle.load(open(json_file, 'rb'))
+        elif os.path.exists(json_file) and not cache_entry.has_checksum(json_file):
+            # ...written before the cache kept checksums: keep it if it is
+            # not truncated...
+            try:
+                decoded = pickle.load(open(json_file, 'rb'))
+                cache_entry.commit(json_file, [json_file])
+            except Exception:
+                logger.info('Cached ENSEMBL record %s is unreadable; downloading it again' %
+                            json_file)
+        if decoded is None:
+            # ...if not in cache, fetch it from server
+            cache_entry.discard(json_file)
+            server = "https://rest.ensembl.org"
+            ext = "/variation/human/%s?genotypes=1" % (SNP)
+
+            r = requests.get(
+                server + ext, headers={"Content-Type": "application/json"})
+
+            if not r.ok:
+                # Calling code can capture exceptions (e.g., 404) here.
+                r.raise_for_status()
+
+            decoded = r.json()
+            cache_entry.atomic_write(json_file, lambda fp: pickle.dump(decoded, fp))
+            cache_entry.commit(json_file, [json_file])
 
     # Determine chromosome and genomic location for SNP
     if 'mappings' not in decoded:
@@ -107,8 +126,7 @@ def download_SNPs(args):
     logger.info("####################################")
     logger.info("Downloading SNP data from ENSEMBL")
 
-    cache_dir = os.path.join(args.working_dir, 'ensembl_cache')
-    utils.safe_mkdir(cache_dir)
+    cache_dir = utils.cache_subdir(args, 'ensembl_cache')
 
     # Input is, e.g., "rs56116432"; output is a dictionary mapping
     # an individual (like '1000GENOMES:phase_3:HG00096') to
@@ -118,8 +136,10 @@ def download_SNPs(args):
     df_in = pd.read_csv(os.path.join(args.working_dir, 'cleaned_input.csv'))
     SNP_list = [x for x in df_in.columns if x.startswith('rs')]
 
-    logger.info("Start download of genotype data for %d SNPs" %
-                (len(SNP_list)))
+    num_cached = len([SNP for SNP in SNP_list
+                      if os.path.exists(os.path.join(cache_dir, str(SNP)))])
+    logger.info("Start download of genotype data for %d SNPs (%d in cache %s)" %
+                (len(SNP_list), num_cached, cache_dir))
 
     # If there are too many cores, we could overwhelm the ENSEMBL server with requests.  So,
     # we throttle the parallelism.
@@ -134,9 +154,15 @@ def download_SNPs(args):
             num_workers, server_threshold))
         num_workers = server_threshold
 
-    results = Parallel(n_jobs=num_workers)(
-        delayed(grab_individual_genotypes)(SNP, cache_dir)
-        for SNP in SNP_list)
+    if args.streaming:
+        results = download_to_store(args, SNP_list, cache_dir, num_workers)
+    else:
+        timed_results = Parallel(n_jobs=num_workers)(
+            delayed(run_report.timed_call)(grab_individual_genotypes, SNP, cache_dir)
+            for SNP in SNP_list)
+        results = run_report.record_tasks('grab_individual_genotypes', timed_results)
+    run_report.add_counts(SNPs=len(SNP_list), ensembl_cache_hits=num_cached,
+                          ensembl_cache_misses=len(SNP_list) - num_cached)
 
     (chr_list, chr_loc_list, wild_type_list, geno_list) = zip(*results)
     df = pd.DataFrame({'SNP': SNP_list, 'chromosome': chr_list,
@@ -148,18 +174,70 @@ def download_SNPs(args):
     if not os.path.exists(os.path.join(args.working_dir, 'wild_types.csv')):
         unique_wild_type = []
         for i in xrange(len(wild_type_list)):
-            unique_wild_type[i] = wild_type_list[i].split('/')[0]
+            unique_wild_type.append(wild_type_list[i].split('/')[0])
         df_wild = pd.DataFrame(
             {'SNP': SNP_list, 'wild_type': unique_wild_type})
         df_wild.to_csv(os.path.join(args.working_dir,
                                     'wild_types.csv'), index=False)
 
-    genotypes = dict(zip(SNP_list, geno_list))
-    outfile = os.path.join(args.working_dir, "ensembl.pkl")
-    pickle.dump(genotypes, open(outfile, "wb"))
+    if not args.streaming:
+        genotypes = dict(zip(SNP_list, geno_list))
+        outfile = os.path.join(args.working_dir, "ensembl.pkl")
+        pickle.dump(genotypes, open(outfile, "wb"))
     logger.info("Download completed.")
 
 
+def download_to_store(args, SNP_list, cache_dir, num_workers):
+    '''
+    With --streaming, download the SNPs in batches sized to
+    --memory_budget_mb, and write their genotypes as allele counts to the
+    store ensembl_store/ (see genotype_store.py) instead of ensembl.pkl.
+    Returns the results of grab_individual_genotypes(), without the
+    genotypes.
+    '''
+    wild_type_file = os.path.join(args.working_dir, 'wild_types.csv')
+    SNP_to_wild_type = None
+    if os.path.exists(wild_type_file):
+        df_wild = pd.read_csv(wild_type_file)
+        SNP_to_wild_type = dict(zip(df_wild['SNP'].values, df_wild['wild_type'].values))
+
+    writer = genotype_store.StoreWriter(os.path.join(args.working_dir, 'ensembl_store'))
+    facts = []
+    # The first batch tells us how many people ENSEMBL has per SNP.
+    batch_size = num_workers
+    start = 0
+    while start < len(SNP_list):
+        batch = SNP_list[start:start + batch_size]
+        timed_results = Parallel(n_jobs=num_workers)(
+            delayed(run_report.timed_call)(grab_individual_genotypes, SNP, cache_dir)
+            for SNP in batch)
+        results = run_report.record_tasks('grab_individual_genotypes', timed_results)
+
+        people = sorted(set(person for (_, _, _, out) in results for person in out))
+        person_index = dict((person, i) for (i, person) in enumerate(people))
+        X = np.full((len(people), len(batch)), genotype_store.MISSING, dtype=np.int8)
+        for (j, (SNP, (chromosome, loc_start, wild_type, out))) in enumerate(
+                zip(batch, results)):
+            if SNP_to_wild_type is not None:
+                unique_wild_type = SNP_to_wild_type[SNP]
+            else:
+                unique_wild_type = wild_type.split('/')[0]
+            SNP_people = list(out.keys())
+            X[[person_index[person] for person in SNP_people], j] = (
+                utils.genotype_to_nonwild_type_count(
+                    [out[person] for person in SNP_people], unique_wild_type))
+            facts.append((chromosome, loc_start, wild_type, None))
+        writer.add_chunk(batch, X, people=people)
+        logger.info('Downloaded %d of %d SNPs' % (start + len(batch), len(SNP_list)))
+
+        start += len(batch)
+        batch_size = genotype_store.chunk_SNPs(
+            args.memory_budget_mb, len(writer.people),
+            bytes_per_genotype=genotype_store.BYTES_PER_RECORD_GENOTYPE)
+    writer.close()
+    return(facts)
+
+
 if __name__ == '__main__':
     args = utils.parse_arguments()
     utils.safe_mkdir(args.working_dir)
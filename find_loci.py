@@ -5,6 +5,8 @@ import pandas as pd
 from scipy.stats.stats import pearsonr
 import os
 import utils_snpko as utils
+import run_report
+import genotype_store
 
 logger = utils.logger
 
@@ -57,9 +59,15 @@ def prune(args):
 
     df = pd.read_csv(os.path.join(args.working_dir, 'cleaned_input.csv'))
     data_labels = [x for x in df.columns if x.startswith(args.data_prefix)]
-    df_ensembl = pd.read_csv(os.path.join(
-        args.working_dir, 'genotypes_ensembl.csv'))
-    ensembl_SNP_list = [x for x in df_ensembl.columns if x.startswith('rs')]
+    if args.streaming:
+        # Only the SNP list is needed until the output is written.
+        ensembl_store = genotype_store.Store(os.path.join(
+            args.working_dir, 'genotypes_ensembl_store'))
+        ensembl_SNP_list = ensembl_store.SNPs
+    else:
+        df_ensembl = pd.read_csv(os.path.join(
+            args.working_dir, 'genotypes_ensembl.csv'))
+        ensembl_SNP_list = [x for x in df_ensembl.columns if x.startswith('rs')]
 
     # Remove any SNPs not in ENSEMBL list, or with constant number of genotypes (e.g.,
     # if all were wild_type/wild_type, or all were wild_type/non-wild_type)
@@ -83,7 +91,8 @@ def prune(args):
 
     df_SNP = df_SNP.iloc[good_SNP_vector].reset_index()
     df = df[good_SNP_list + data_labels]
-    df_ensembl = df_ensembl[good_SNP_list]
+    if not args.streaming:
+        df_ensembl = df_ensembl[good_SNP_list]
 
     grouped_by_chromosome = df_SNP.groupby('chromosome')
     logger.info('Considering %d chromosomes' %
@@ -125,12 +134,17 @@ def prune(args):
 
     logger.info("Created %d loci from %d underlying SNPs" %
                 (locus_count, locus_SNP_count))
+    run_report.add_counts(SNPs=len(df_SNP), loci=len(distinct_loci))
 
     df[distinct_loci + data_labels].to_csv(os.path.join(args.working_dir, 'pruned_experiment.csv'),
                                            index=False)
 
-    df_ensembl[distinct_loci].to_csv(os.path.join(
-        args.working_dir, 'pruned_ensembl.csv'), index=False)
+    if args.streaming:
+        ensembl_store.copy_columns(os.path.join(args.working_dir, 'pruned_ensembl_store'),
+                                   distinct_loci, args.memory_budget_mb)
+    else:
+        df_ensembl[distinct_loci].to_csv(os.path.join(
+            args.working_dir, 'pruned_ensembl.csv'), index=False)
 
     index = np.zeros(len(df_SNP)).astype(bool)
     for i in xrange(len(df_SNP)):
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# On-disk store of genotypes as allele counts, for --streaming mode.
+#
+# Without --streaming, the ENSEMBL reference panel passes between stages as
+# ensembl.pkl (a dict of dicts of genotype strings), genotypes_ensembl.csv and
+# pruned_ensembl.csv, and each stage loads the whole panel as Python objects.
+# With tens of thousands of reference samples, that is what limits memory.
+#
+# A store is a directory holding the non-wild-type allele counts (see
+# utils.genotype_to_nonwild_type_count()) of people x SNPs, with -1 where a
+# person has no genotype for a SNP, packed two bits per genotype (see
+# packed_genotypes.py), one .npy file per chunk of SNP columns.  meta.json
+# lists the people and, for each chunk, its file, its SNPs and how many of
+# the people it has rows for (later chunks may add people; earlier chunks are
+# missing them).  Stages read and write a store a chunk at a time, with
+# chunks sized to --memory_budget_mb, and get back unpacked int8 counts.
+#
+# Usage:
+#     writer = genotype_store.StoreWriter(path)
+#     writer.add_chunk(SNPs, X, people=people)
+#     writer.close()
+#     store = genotype_store.Store(path)
+#     for (SNPs, X) in store.chunks():
+#         ...
+
+import json
+import os
+import shutil
+import numpy as np
+import utils_snpko as utils
+import packed_genotypes
+
+logger = utils.logger
+
+META_FILE = 'meta.json'
+MISSING = -1
+
+# Rough memory cost, in bytes, of one person's genotype at one SNP while a
+# stage works on it: as part of an ENSEMBL reply (a dict of strings), and as
+# an allele count (with the temporary arrays built from it).
+BYTES_PER_RECORD_GENOTYPE = 400
+BYTES_PER_COUNT = 16
+
+
+def chunk_SNPs(memory_budget_mb, num_people, bytes_per_genotype=BYTES_PER_COUNT):
+    '''
+    Number of SNPs per chunk that keeps a chunk of num_people people within
+    memory_budget_mb.
+    '''
+    return(max(1, int(memory_budget_mb * 1024 * 1024 //
+                      (max(1, num_people) * bytes_per_genotype))))
+
+
+class StoreWriter(object):
+    '''
+    Write a new store at path (replacing any old one).  The store is only
+    complete once close() has written its meta.json.
+    '''
+
+    def __init__(self, path, people=()):
+        self.path = path
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        utils.safe_mkdir(path)
+        self.people = list(people)
+        self.person_index = dict((person, i) for (i, person) in enumerate(self.people))
+        self.chunk_list = []
+
+    def add_chunk(self, SNPs, X, people=None):
+        '''
+        Add the columns X (people x SNPs) for SNPs.  The rows of X are the
+        people in "people" (new people are added to the store), or, by
+        default, the store's people.
+        '''
+        X = np.asarray(X, dtype=np.int8)
+        if people is not None:
+            for person in people:
+                if person not in self.person_index:
+                    self.person_index[person] = len(self.people)
+                    self.people.append(person)
+            rows = np.array([self.person_index[person] for person in people], dtype=int)
+            X_all = np.full((len(self.people), len(SNPs)), MISSING, dtype=np.int8)
+            X_all[rows] = X
+            X = X_all
+        file_name = 'chunk_%05d.npy' % len(self.chunk_list)
+        np.save(os.path.join(self.path, file_name), packed_genotypes.pack(X))
+        self.chunk_list.append({'file': file_name, 'SNPs': [str(SNP) for SNP in SNPs],
+                                'num_people': X.shape[0]})
+
+    def close(self):
+        meta = {'people': self.people, 'chunks': self.chunk_list}
+        tmp_name = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp_name, 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(tmp_name, os.path.join(self.path, META_FILE))
+
+
+class Store(object):
+    '''
+    A store written by StoreWriter, read a chunk (or a few columns) at a
+    time.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as fp:
+            meta = json.load(fp)
+        self.people = [str(person) for person in meta['people']]
+        self.chunk_list = meta['chunks']
+        self.SNPs = []
+        # SNP => (chunk number, column within chunk)
+        self.location = {}
+        for (c, chunk) in enumerate(self.chunk_list):
+            for (j, SNP) in enumerate(chunk['SNPs']):
+                self.location[str(SNP)] = (c, j)
+                self.SNPs.append(str(SNP))
+
+    def _chunk(self, c):
+        '''
+        The packed chunk c (SNPs x bytes), memory-mapped.
+        '''
+        return(np.load(os.path.join(self.path, self.chunk_list[c]['file']),
+                       mmap_mode='r'))
+
+    def chunks(self):
+        '''
+        Yield (SNPs, X) for each chunk, with X (people x SNPs) covering all of
+        the store's people.
+        '''
+        for (c, chunk) in enumerate(self.chunk_list):
+            yield(chunk['SNPs'], self.read(chunk['SNPs']))
+
+    def read(self, SNPs, rows=None):
+        '''
+        Allele counts (people x SNPs) of SNPs, for all people or for the
+        people with indices "rows".
+        '''
+        if rows is None:
+            rows = np.arange(len(self.people))
+        rows = np.asarray(rows, dtype=int)
+        X = np.full((len(rows), len(SNPs)), MISSING, dtype=np.int8)
+        by_chunk = {}
+        for (k, SNP) in enumerate(SNPs):
+            (c, j) = self.location[str(SNP)]
+            by_chunk.setdefault(c, []).append((k, j))
+        for (c, pairs) in by_chunk.items():
+            num_people = self.chunk_list[c]['num_people']
+            (ks, js) = [np.array(v) for v in zip(*pairs)]
+            X_chunk = packed_genotypes.unpack(self._chunk(c)[js], num_people)
+            present = rows < num_people
+            X[np.ix_(np.flatnonzero(present), ks)] = X_chunk[rows[present]]
+        return(X)
+
+    def copy_columns(self, path, SNPs, memory_budget_mb, rows=None):
+        '''
+        Write the columns SNPs (and the people with indices "rows") to a new
+        store at path, a chunk at a time.
+        '''
+        if rows is None:
+            rows = np.arange(len(self.people))
+        writer = StoreWriter(path, people=[self.people[i] for i in rows])
+        step = chunk_SNPs(memory_budget_mb, len(rows))
+        for start in xrange(0, len(SNPs), step):
+            writer.add_chunk(SNPs[start:start + step],
+                             self.read(SNPs[start:start + step], rows=rows))
+        writer.close()
+
+    def shared_array(self, SNPs, path, memory_budget_mb):
+        '''
+        As utils.shared_array() for the allele counts of SNPs (all people),
+        filled a chunk at a time without holding the whole array in memory.
+        '''
+        X = np.lib.format.open_memmap(path, mode='w+', dtype=np.int8,
+                                      shape=(len(self.people), len(SNPs)))
+        step = chunk_SNPs(memory_budget_mb, len(self.people))
+        for start in xrange(0, len(SNPs), step):
+            X[:, start:start + step] = self.read(SNPs[start:start + step])
+        X.flush()
+        del X
+        return(np.load(path, mmap_mode='r'))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# In-process replacement for fastPHASE: fit the haplotype-cluster HMM of
+# Scheet & Stephens (2006) to unphased genotypes with EM, and assemble it into
+# the genotype HMM (pInit, Q, pEmit) used by SNPknock's knockoffHMM.
+#
+# The model: each of a person's two haplotypes is a path through K clusters.
+# At SNP j a haplotype either stays in its cluster (probability exp(-r[j]))
+# or jumps to cluster k with probability alpha[j, k]; cluster k carries the
+# non-wild-type allele at SNP j with probability theta[j, k].  A genotype
+# (0, 1 or 2 non-wild-type alleles) is the sum of the two haplotypes.
+#
+# The forward-backward pass runs over ordered pairs of clusters, vectorized
+# across people; because the two haplotypes move independently, each step
+# costs O(K^2) per person rather than O(K^4).  The forward pass keeps a
+# (SNPs x people x K x K) array, so people are processed in chunks, sized to
+# keep that array within MAX_CHUNK_CELLS float64 cells (128 MB) however many
+# SNPs there are.
+
+import numpy as np
+from joblib import Parallel, delayed
+import utils_snpko as utils
+
+logger = utils.logger
+
+# Bounds keeping EM away from degenerate parameters.
+MIN_THETA = 1e-3
+MIN_ALPHA = 1e-6
+MIN_JUMP = 1e-6
+
+# Largest forward-pass array of one chunk of people, in float64 cells.
+MAX_CHUNK_CELLS = 2 ** 24
+
+
+def _emission(theta_j):
+    '''
+    Probabilities of genotypes 0, 1, 2 given an ordered pair of clusters;
+    shape (3, K, K).
+    '''
+    t = theta_j
+    return(np.array([np.outer(1 - t, 1 - t),
+                     np.outer(t, 1 - t) + np.outer(1 - t, t),
+                     np.outer(t, t)]))
+
+
+def _e_step(X, r, alpha, theta):
+    '''
+    Forward-backward over the people in X, shape (n, p), with entries 0, 1, 2.
+    Returns the log likelihood and the expected sufficient statistics:
+       hap_counts[j, k]:  haplotypes in cluster k at SNP j
+       allele_counts[j, k]:  those carrying the non-wild-type allele
+       jumps[j, k]:  haplotypes jumping into cluster k at SNP j
+    '''
+    (n, p) = X.shape
+    K = alpha.shape[1]
+    stay = np.exp(-r)
+    jump = 1.0 - stay
+
+    F = np.empty((p, n, K, K))
+    log_c = np.zeros(n)
+    c = np.empty((p, n))
+    emissions = [_emission(theta[j]) for j in xrange(p)]
+
+    # Forward pass, normalized at each SNP.
+    F[0] = np.outer(alpha[0], alpha[0])[None, :, :] * emissions[0][X[:, 0]]
+    for j in xrange(p):
+        if j > 0:
+            a = stay[j]
+            b = jump[j]
+            prev = F[j - 1]
+            # Haplotype 1 transitions, then haplotype 2.
+            Y = a * prev + b * alpha[j][None, :, None] * prev.sum(axis=1)[:, None, :]
+            Z = a * Y + b * Y.sum(axis=2)[:, :, None] * alpha[j][None, None, :]
+            F[j] = Z * emissions[j][X[:, j]]
+        c[j] = F[j].sum(axis=(1, 2))
+        F[j] /= c[j][:, None, None]
+        log_c += np.log(c[j])
+
+    hap_counts = np.zeros((p, K))
+    allele_counts = np.zeros((p, K))
+    jumps = np.zeros((p, K))
+
+    beta = np.ones((n, K, K))
+    for j in xrange(p - 1, -1, -1):
+        gamma = F[j] * beta
+        # Expected number of non-wild-type alleles on each haplotype, given
+        # the genotype and the pair of clusters.
+        t = theta[j]
+        het = emissions[j][1]
+        on_1 = np.array([np.zeros((K, K)), np.outer(t, 1 - t) / het, np.ones((K, K))])
+        on_2 = np.array([np.zeros((K, K)), np.outer(1 - t, t) / het, np.ones((K, K))])
+        g = X[:, j]
+        hap_counts[j] = gamma.sum(axis=(0, 2)) + gamma.sum(axis=(0, 1))
+        allele_counts[j] = ((gamma * on_1[g]).sum(axis=(0, 2)) +
+                            (gamma * on_2[g]).sum(axis=(0, 1)))
+        if j == 0:
+            break
+
+        a = stay[j]
+        b = jump[j]
+        W = emissions[j][X[:, j]] * beta / c[j][:, None, None]
+        prev = F[j - 1]
+        # Probability mass arriving at each cluster of haplotype 2 (resp. 1)
+        # from the previous SNP, summed over the other haplotype.
+        into_2 = a * prev.sum(axis=1) + b * alpha[j][None, :]
+        into_1 = a * prev.sum(axis=2) + b * alpha[j][None, :]
+        jumps_1 = b * alpha[j][None, :, None] * into_2[:, None, :] * W
+        jumps_2 = b * alpha[j][None, None, :] * into_1[:, :, None] * W
+        jumps[j] = jumps_1.sum(axis=(0, 2)) + jumps_2.sum(axis=(0, 1))
+
+        # beta[j-1] = T W T'
+        V = a * W + b * (alpha[j][None, :, None] * W).sum(axis=1)[:, None, :]
+        beta = a * V + b * (V * alpha[j][None, None, :]).sum(axis=2)[:, :, None]
+
+    return(log_c.sum(), hap_counts, allele_counts, jumps)
+
+
+def _m_step(num_haplotypes, hap_counts, allele_counts, jumps):
+    theta = np.clip(allele_counts / np.maximum(hap_counts, 1e-300),
+                    MIN_THETA, 1.0 - MIN_THETA)
+    alpha = np.empty_like(hap_counts)
+    alpha[0] = hap_counts[0]
+    alpha[1:] = jumps[1:]
+    alpha = np.maximum(alpha / alpha.sum(axis=1)[:, None], MIN_ALPHA)
+    alpha /= alpha.sum(axis=1)[:, None]
+    jump_probability = np.clip(jumps.sum(axis=1) / num_haplotypes,
+                               MIN_JUMP, 1.0 - MIN_JUMP)
+    r = -np.log(1.0 - jump_probability)
+    r[0] = 0.0
+    return(r, alpha, theta)
+
+
+def initial_parameters(p, K, random_seed):
+    '''
+    Random starting point for EM, as fastPHASE does.
+    '''
+    rng = np.random.RandomState(random_seed)
+    r = np.full(p, -np.log(0.9))
+    r[0] = 0.0
+    alpha = np.full((p, K), 1.0 / K)
+    theta = rng.uniform(0.05, 0.95, size=(p, K))
+    return(r, alpha, theta)
+
+
+def warm_start(SNPs, cached_SNPs, cached_fit, random_seed=1):
+    '''
+    Starting point for EM on SNPs, reusing the parameters of the SNPs that
+    also appear in a previous fit (cached_fit, on cached_SNPs); the other SNPs
+    start from a random point.
+    '''
+    K = cached_fit['alpha'].shape[1]
+    (r, alpha, theta) = initial_parameters(len(SNPs), K, random_seed)
+    cached_index = dict((SNP, i) for (i, SNP) in enumerate(cached_SNPs))
+    for (j, SNP) in enumerate(SNPs):
+        i = cached_index.get(SNP)
+        if i is None:
+            continue
+        theta[j] = cached_fit['theta'][i]
+        alpha[j] = cached_fit['alpha'][i]
+        if j > 0 and i > 0:
+            r[j] = cached_fit['r'][i]
+    return(r, alpha, theta)
+
+
+def em(X, K=12, max_iterations=500, tolerance=1e-6, random_seed=1,
+       chunk_size=None, start=None):
+    '''
+    Fit the HMM to genotypes X (n x p array of 0, 1, 2) by EM, starting from
+    start=(r, alpha, theta) if given, or else from a random point.  Stops
+    after max_iterations, or when the relative improvement in log likelihood
+    falls below tolerance.  Returns a dict with r, alpha, theta and the log
+    likelihood after each iteration.  The E step runs over chunks of
+    chunk_size people (by default, as many as MAX_CHUNK_CELLS allows).
+    '''
+    X = np.asarray(X).astype(int)
+    (n, p) = X.shape
+    if start is None:
+        (r, alpha, theta) = initial_parameters(p, K, random_seed)
+    else:
+        (r, alpha, theta) = [np.array(x, dtype=float) for x in start]
+        K = alpha.shape[1]
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_CELLS // max(1, p * K * K))
+    log_likelihoods = []
+    for iteration in xrange(max_iterations):
+        total = [0.0, np.zeros((p, K)), np.zeros((p, K)), np.zeros((p, K))]
+        for i in xrange(0, n, chunk_size):
+            stats = _e_step(X[i:i + chunk_size], r, alpha, theta)
+            for s in xrange(4):
+                total[s] = total[s] + stats[s]
+        log_likelihoods.append(total[0])
+        (r, alpha, theta) = _m_step(2 * n, total[1], total[2], total[3])
+        if (len(log_likelihoods) > 1 and
+                abs(log_likelihoods[-1] - log_likelihoods[-2]) <=
+                tolerance * abs(log_likelihoods[-2])):
+            break
+    return({'r': r, 'alpha': alpha, 'theta': theta,
+            'log_likelihoods': np.array(log_likelihoods)})
+
+
+def fit(X, K=12, max_iterations=500, tolerance=1e-6, num_starts=1,
+        random_seed=1, n_jobs=1, start=None):
+    '''
+    Run EM from num_starts starting points (in parallel) and keep the fit
+    with the highest log likelihood.  If start=(r, alpha, theta) is given
+    (e.g., from warm_start()), it is the first starting point; the rest are
+    random.
+    '''
+    starts = [start] + [None] * (num_starts - 1)
+    fits = Parallel(n_jobs=n_jobs)(
+        delayed(em)(X, K=K, max_iterations=max_iterations, tolerance=tolerance,
+                    random_seed=random_seed + i, start=starts[i])
+        for i in xrange(num_starts))
+    best = max(fits, key=lambda f: f['log_likelihoods'][-1])
+    logger.debug('EM: %d SNPs, log likelihood %.2f after %d iterations' % (
+        X.shape[1], best['log_likelihoods'][-1], len(best['log_likelihoods'])))
+    return(best)
+
+
+def assemble_hmm(r, alpha, theta):
+    '''
+    Genotype HMM over unordered pairs of clusters, laid out as
+    SNPknock.fastphase.loadFit() does: states i = k1*(k1+1)/2 + k2 for
+    k2 <= k1; pInit has shape (Keff,), Q (p-1, Keff, Keff), and
+    pEmit (p, 3, Keff).
+    '''
+    (p, K) = alpha.shape
+    (k1, k2) = np.tril_indices(K)
+    stay = np.exp(-r[1:])
+    Q1 = ((1.0 - stay)[:, None, None] * alpha[1:, None, :] +
+          stay[:, None, None] * np.eye(K)[None, :, :])
+    Q = Q1[:, k1[:, None], k1[None, :]] * Q1[:, k2[:, None], k2[None, :]]
+    swapped = Q1[:, k1[:, None], k2[None, :]] * Q1[:, k2[:, None], k1[None, :]]
+    Q += swapped * (k1 != k2)[None, None, :]
+    Q /= Q.sum(axis=2)[:, :, None]
+
+    pInit = alpha[0, k1] * alpha[0, k2] * np.where(k1 == k2, 1.0, 2.0)
+    pInit /= pInit.sum()
+
+    t1 = theta[:, k1]
+    t2 = theta[:, k2]
+    pEmit = np.array([(1 - t1) * (1 - t2),
+                      t1 * (1 - t2) + t2 * (1 - t1),
+                      t1 * t2]).transpose(1, 0, 2)
+    pEmit /= pEmit.sum(axis=1)[:, None, :]
+    return({'pInit': pInit, 'Q': Q, 'pEmit': pEmit})
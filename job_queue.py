@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# A simple work-stealing job queue backed by a directory, so that several
+# worker processes (on one machine or on many machines sharing storage) can
+# split up a fixed set of jobs (e.g., p-value trials) without hand-assigned
+# "--machine_num"s.
+#
+# Each job is a file named after its job ID; the job's state is the
+# subdirectory it lives in:
+#     pending/   waiting for a worker
+#     claimed/   being worked on; the worker touches the file periodically
+#                ("heartbeat"), so a stale modification time means the worker
+#                died or was preempted
+#     done/      finished
+# Moving a job between states is an os.rename(), which is atomic on a POSIX
+# filesystem, so two workers can never both claim the same pending job.
+
+import os
+import socket
+import threading
+import time
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def default_worker_id():
+    return('%s_%d' % (socket.gethostname(), os.getpid()))
+
+
+class FileJobQueue(object):
+    '''
+    Job queue stored in the directory queue_dir.  A claimed job whose
+    heartbeat is older than heartbeat_timeout seconds is considered abandoned
+    and may be re-queued.
+    '''
+
+    def __init__(self, queue_dir, heartbeat_timeout=600):
+        self.queue_dir = queue_dir
+        self.heartbeat_timeout = heartbeat_timeout
+        self.state_dir = {}
+        for state in ['pending', 'claimed', 'done']:
+            self.state_dir[state] = os.path.join(queue_dir, state)
+            utils.safe_mkdir(self.state_dir[state])
+        self.populated_marker = os.path.join(queue_dir, 'populated')
+
+    def _path(self, state, job_id):
+        return(os.path.join(self.state_dir[state], 'job_%06d' % job_id))
+
+    def _jobs(self, state):
+        return(sorted([int(f[4:]) for f in os.listdir(self.state_dir[state])
+                       if f.startswith('job_')]))
+
+    def populate(self, job_ids):
+        '''
+        Add any job in job_ids that is not already in the queue (in any
+        state), so that a restarted coordinator does not redo finished work.
+        '''
+        existing = set(self._jobs('pending') + self._jobs('claimed') +
+                       self._jobs('done'))
+        for job_id in job_ids:
+            if job_id not in existing:
+                open(self._path('pending', job_id), 'w').close()
+        open(self.populated_marker, 'w').close()
+
+    def is_populated(self):
+        return(os.path.exists(self.populated_marker))
+
+    def claim(self, worker_id):
+        '''
+        Claim the lowest-numbered pending job; return its ID, or None if
+        nothing is pending.
+        '''
+        for job_id in self._jobs('pending'):
+            try:
+                os.rename(self._path('pending', job_id),
+                          self._path('claimed', job_id))
+            except OSError:
+                # Another worker got there first.
+                continue
+            with open(self._path('claimed', job_id), 'w') as fp:
+                fp.write('%s\n' % worker_id)
+            logger.info('Worker %s claimed job %d' % (worker_id, job_id))
+            return(job_id)
+        return(None)
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self._path('claimed', job_id), None)
+        except OSError:
+            # Job was re-queued out from under us; keep working anyway, since
+            # a job's result does not depend on which worker computes it.
+            pass
+
+    def complete(self, job_id):
+        try:
+            os.rename(self._path('claimed', job_id),
+                      self._path('done', job_id))
+        except OSError:
+            # We were presumed dead and the job was re-queued.  Our result is
+            # still good, so mark it done and withdraw any pending copy.
+            open(self._path('done', job_id), 'w').close()
+            try:
+                os.unlink(self._path('pending', job_id))
+            except OSError:
+                pass
+
+    def release(self, job_id):
+        '''
+        Give a claimed job back to the queue (e.g., on failure).
+        '''
+        try:
+            os.rename(self._path('claimed', job_id),
+                      self._path('pending', job_id))
+        except OSError:
+            pass
+
+    def requeue_stale(self):
+        '''
+        Move claimed jobs whose heartbeat has expired back to pending.
+        Returns the list of re-queued job IDs.
+        '''
+        requeued = []
+        now = time.time()
+        for job_id in self._jobs('claimed'):
+            path = self._path('claimed', job_id)
+            try:
+                # Renaming a file updates its ctime (but not its mtime), so a
+                # job that was claimed a moment ago is never mistaken for a
+                # stale one.
+                st = os.stat(path)
+            except OSError:
+                continue
+            age = now - max(st.st_mtime, st.st_ctime)
+            if age <= self.heartbeat_timeout:
+                continue
+            if os.path.exists(self._path('done', job_id)):
+                # Completed by a worker that had been presumed dead.
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                os.rename(path, self._path('pending', job_id))
+            except OSError:
+                continue
+            logger.info('Re-queued abandoned job %d (no heartbeat for %ds)' % (
+                job_id, age))
+            requeued.append(job_id)
+        return(requeued)
+
+    def counts(self):
+        return(dict((state, len(self._jobs(state)))
+                    for state in ['pending', 'claimed', 'done']))
+
+    def finished(self):
+        return(self.is_populated() and len(self._jobs('pending')) == 0 and
+               len(self._jobs('claimed')) == 0)
+
+    def wait_until_finished(self, poll_interval=10):
+        while not self.finished():
+            self.requeue_stale()
+            time.sleep(poll_interval)
+
+
+class Heartbeat(object):
+    '''
+    Context manager that touches a claimed job every "interval" seconds from
+    a background thread while the job is being worked on.
+    '''
+
+    def __init__(self, queue, job_id, interval):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.queue.heartbeat(self.job_id)
+
+    def __enter__(self):
+        self.thread.start()
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stopped.set()
+        self.thread.join()
+        return(False)
+
+
+def run_worker(queue, work_fn, worker_id=None, poll_interval=10):
+    '''
+    Repeatedly claim a job and call work_fn(job_id) on it, until every job in
+    the queue is done.  While other workers still hold jobs, keep polling so
+    that we can pick up any job they abandon.
+
+    Returns the list of job IDs this worker completed.
+    '''
+    if worker_id is None:
+        worker_id = default_worker_id()
+    heartbeat_interval = max(1.0, queue.heartbeat_timeout / 4.0)
+
+    while not queue.is_populated():
+        logger.info('Worker %s waiting for job queue %s to be populated' % (
+            worker_id, queue.queue_dir))
+        time.sleep(poll_interval)
+
+    completed = []
+    while True:
+        job_id = queue.claim(worker_id)
+        if job_id is None:
+            queue.requeue_stale()
+            if queue.finished():
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            with Heartbeat(queue, job_id, heartbeat_interval):
+                work_fn(job_id)
+        except Exception:
+            queue.release(job_id)
+            raise
+        queue.complete(job_id)
+        completed.append(job_id)
+        logger.info('Worker %s finished job %d; queue: %s' % (
+            worker_id, job_id, queue.counts()))
+    return(completed)
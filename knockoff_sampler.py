@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Knockoff copies of genotypes under an HMM (as in SNPknock's knockoffHMM),
+# drawing many trials at once.
+#
+# knockoffHMM samples one trial per object: a backward pass over the
+# observed genotypes, then, for each person, hidden states given the
+# genotypes, knockoff hidden states (the Markov chain knockoff construction
+# of Sesia, Sabatti & Candes), and finally knockoff genotypes.  The backward
+# pass depends only on the genotypes and the HMM, so here it is done once per
+# chromosome; the sampling steps then run for all trials and people at once,
+# as array operations over (trials, people, states).
+#
+# The backward pass keeps a (SNPs x people x states) array.  Everything is
+# independent across people, so people are processed in blocks that keep it
+# within MAX_BACKWARD_CELLS (stored as float32), however large the cohort.
+#
+# Each trial draws from its own numpy RandomState seeded with that trial's
+# seed, one person after another, so a trial's knockoffs depend neither on
+# which other trials are sampled with it nor on the block sizes.  (They are
+# not the same draws as knockoffHMM makes with the same seed, which uses a
+# different generator.)
+
+import numpy as np
+
+# The backward pass runs over blocks of people of at most this many (SNP,
+# person, state) cells.
+MAX_BACKWARD_CELLS = 2 ** 24
+
+# Trials are sampled in batches of at most this many (trial, person, SNP)
+# cells, to bound the memory used by the random draws and hidden states.
+MAX_BATCH_CELLS = 2 ** 22
+
+
+def _choose(weights, u):
+    '''
+    For each row of weights (..., S), normalized, the index selected by the
+    uniform draw u (...).
+    '''
+    cumulative = np.cumsum(weights, axis=-1)
+    choice = (cumulative < u[..., None] * cumulative[..., -1:]).sum(axis=-1)
+    return(np.minimum(choice, weights.shape[-1] - 1))
+
+
+class MultiTrialSampler(object):
+    '''
+    Knockoff sampler for the genotypes X (n x p array of 0, 1, 2) under the
+    HMM {'pInit', 'Q', 'pEmit'}, laid out as by SNPknock.fastphase.loadFit().
+    '''
+
+    def __init__(self, hmm, X):
+        self.pInit = np.asarray(hmm['pInit'], dtype=float)
+        self.Q = np.asarray(hmm['Q'], dtype=float)
+        self.pEmit = np.asarray(hmm['pEmit'], dtype=float)
+        self.X = np.asarray(X).astype(int)
+
+    def backward(self, X):
+        '''
+        emit_beta[j] = P(X_j | H_j) * beta_j(H_j) for the people in X, with
+        beta normalized at each SNP; this is all the conditional sampling of H
+        needs.  Shape (p, n, S).
+        '''
+        (n, p) = X.shape
+        emit_beta = np.empty((p, n, len(self.pInit)), dtype=np.float32)
+        beta = np.ones((n, len(self.pInit)))
+        for j in xrange(p - 1, -1, -1):
+            emit = self.pEmit[j][X[:, j]] * beta
+            emit_beta[j] = emit
+            if j > 0:
+                beta = np.dot(emit, self.Q[j - 1].T)
+                beta /= beta.sum(axis=1)[:, None]
+        return(emit_beta)
+
+    def sample_hidden_states(self, emit_beta, uniforms):
+        '''
+        Hidden states given the genotypes (summarized by emit_beta, from
+        backward()), for each trial; uniforms has shape (T, n, p).
+        '''
+        (T, n, p) = uniforms.shape
+        H = np.empty((T, n, p), dtype=int)
+        weights = self.pInit[None, None, :] * emit_beta[0][None, :, :]
+        H[:, :, 0] = _choose(weights, uniforms[:, :, 0])
+        for j in xrange(1, p):
+            weights = self.Q[j - 1][H[:, :, j - 1]] * emit_beta[j][None, :, :]
+            H[:, :, j] = _choose(weights, uniforms[:, :, j])
+        return(H)
+
+    def sample_knockoff_states(self, H, uniforms):
+        '''
+        Knockoff copies of the Markov chain H, shape (T, n, p).
+        '''
+        (T, n, p) = H.shape
+        Q = self.Q
+        Ht = np.empty_like(H)
+        if p == 1:
+            # A single variable: an independent draw from its marginal.
+            weights = np.broadcast_to(self.pInit, (T, n, len(self.pInit)))
+            Ht[:, :, 0] = _choose(weights, uniforms[:, :, 0])
+            return(Ht)
+
+        Z = np.dot(self.pInit, Q[0])
+        weights = (self.pInit[None, None, :] * Q[0].T[H[:, :, 1]] /
+                   Z[H[:, :, 1]][:, :, None])
+        Ht[:, :, 0] = _choose(weights, uniforms[:, :, 0])
+        Z_old = np.broadcast_to(Z, (T, n, len(Z)))
+
+        for j in xrange(1, p - 1):
+            both = Q[j - 1][H[:, :, j - 1]] * Q[j - 1][Ht[:, :, j - 1]] / Z_old
+            Z = np.dot(both, Q[j])
+            next_H = H[:, :, j + 1]
+            Z_next = Z[np.arange(T)[:, None], np.arange(n)[None, :], next_H]
+            weights = both * Q[j].T[next_H] / Z_next[:, :, None]
+            Ht[:, :, j] = _choose(weights, uniforms[:, :, j])
+            Z_old = Z
+
+        weights = Q[p - 2][H[:, :, p - 2]] * Q[p - 2][Ht[:, :, p - 2]] / Z_old
+        Ht[:, :, p - 1] = _choose(weights, uniforms[:, :, p - 1])
+        return(Ht)
+
+    def _sample_batch(self, emit_beta, uniforms):
+        '''
+        Knockoff genotypes of a block of people for a batch of trials, given
+        the block's emit_beta and uniforms of shape (3, T, n, p).
+        '''
+        H = self.sample_hidden_states(emit_beta, uniforms[0])
+        Ht = self.sample_knockoff_states(H, uniforms[1])
+        # pEmit[j] has shape (3, S); pick the column of each knockoff state.
+        X_knockoffs = np.empty(H.shape, dtype=np.int8)
+        for j in xrange(H.shape[2]):
+            weights = self.pEmit[j].T[Ht[:, :, j]]
+            X_knockoffs[:, :, j] = _choose(weights, uniforms[2][:, :, j])
+        return(X_knockoffs)
+
+    def sample(self, random_seeds):
+        '''
+        Knockoff genotypes for each seed in random_seeds; returns an array of
+        shape (len(random_seeds), n, p).
+        '''
+        (n, p) = self.X.shape
+        random_states = [np.random.RandomState(seed) for seed in random_seeds]
+        X_knockoffs = np.empty((len(random_states), n, p), dtype=np.int8)
+        block_size = max(1, MAX_BACKWARD_CELLS // max(1, p * len(self.pInit)))
+        for i in xrange(0, n, block_size):
+            emit_beta = self.backward(self.X[i:i + block_size])
+            block = emit_beta.shape[1]
+            batch_size = max(1, MAX_BATCH_CELLS // max(1, block * p))
+            for t in xrange(0, len(random_states), batch_size):
+                batch = random_states[t:t + batch_size]
+                # Each person's draws for the three sampling steps.
+                uniforms = np.empty((3, len(batch), block, p))
+                for (k, random_state) in enumerate(batch):
+                    uniforms[:, k] = random_state.rand(block, 3, p).transpose(1, 0, 2)
+                X_knockoffs[t:t + batch_size, i:i + block] = self._sample_batch(
+                    emit_beta, uniforms)
+        return(X_knockoffs)
@@ -3,68 +3,99 @@
 
 import pandas as pd
 import os
+import glob
+import hashlib
+import shutil
+import tempfile
 import numpy as np
 import SNPknock.fastphase as fp
 from SNPknock import knockoffHMM
 from joblib import Parallel, delayed
 import utils_snpko as utils
+import hmm_fit
+import knockoff_sampler
+import run_report
+import cache_entry
+import genotype_store
 
 logger = utils.logger
 
+# fastPHASE is run for this many EM iterations first, then for twice as many,
+# and so on, until its log likelihood converges.
+FIRST_FASTPHASE_ITERATIONS = 25
 
-def make_knockoff(chromosome=None, grouped_by_chromosome=None, df_SNP=None,
-                  df_geno_experiment=None, df_geno_ensembl=None,
-                  SNP_to_wild_type=None, cache_dir=None, path_to_fp=None,
-                  em_iterations=25, random_seed=123):
-    # assert chromosome!=None and grouped_by_chromosome!=None and df_SNP!=None
-    assert chromosome is not None
-    assert grouped_by_chromosome is not None
-    assert df_SNP is not None
-
-    logger.debug("################")
-    logger.debug("Chromosome %2d #" % chromosome)
-    logger.debug("################")
+# Warm-start EM from a cached fit if it covers at least this fraction of the
+# SNPs.
+MIN_WARM_START_OVERLAP = 0.5
 
-    num_experiment_people = len(df_geno_experiment)
-    num_ensembl_people = len(df_geno_ensembl)
+# The files of a fastPHASE fit.
+FASTPHASE_SUFFIXES = ['alphahat.txt', 'finallikelihoods', 'origchars', 'rhat.txt',
+                      'thetahat.txt']
 
-    indices = grouped_by_chromosome.groups[chromosome]
-    df_SNP_chromo = df_SNP.iloc[indices].sort_values('chromosome_position')
-    SNPs_on_chromosome = df_SNP_chromo['SNP'].values
 
-    X_experiment = np.empty((num_experiment_people, len(SNPs_on_chromosome)))
-    X_ensembl = np.empty((num_ensembl_people, len(SNPs_on_chromosome)))
-    for X, df in [
-            (X_experiment, df_geno_experiment),
-            (X_ensembl, df_geno_ensembl)]:
+def final_log_likelihood(likelihood_file):
+    '''
+    Best log likelihood reported in fastPHASE's "_finallikelihoods" file, or
+    None if there is none.
+    '''
+    best = None
+    with open(likelihood_file) as fp_in:
+        for line in fp_in:
+            try:
+                log_likelihood = float(line.split()[-1])
+            except (IndexError, ValueError):
+                continue
+            if best is None or log_likelihood > best:
+                best = log_likelihood
+    return(best)
 
-        for j, SNP in enumerate(SNPs_on_chromosome):
-            X[:, j] = utils.genotype_to_nonwild_type_count(
-                df[SNP].values, SNP_to_wild_type[SNP])
 
-    out_path = '%s/chrom_%d' % (cache_dir, chromosome)
+def fastphase_tag(chromosome, hmm_states, segment_key=None, cache_key=None):
+    '''
+    Name of the fastPHASE files for a chromosome in the cache (see
+    fit_hmm_with_fastphase()).
+    '''
+    # The default K keeps the original file names, so existing caches stay valid.
+    tag = '%d' % chromosome
+    if cache_key is not None:
+        tag += '_%s' % cache_key
+    elif segment_key is not None:
+        tag += '_%s' % segment_key
+    if hmm_states != 12:
+        tag += '_K%d' % hmm_states
+    return(tag)
+
+
+def fit_hmm_with_fastphase(chromosome, X_ensembl, cache_dir, path_to_fp, hmm_states,
+                           em_iterations, em_tolerance, segment_key=None, cache_key=None):
+    '''
+    Fit the HMM by running the external fastPHASE binary (or reuse its cached
+    output).
+
+    fastPHASE cannot stop on its own when EM converges, or resume a previous
+    fit.  But with a fixed seed, a run of 2n iterations retraces a run of n
+    iterations and then continues.  So if em_tolerance is set (it is 0 by
+    default) we run 25, 50, 100, ... iterations, up to em_iterations.  We stop
+    once the log likelihood improves by less than em_tolerance (relative) per
+    added iteration.  Since each run starts over, a chromosome that does not
+    converge costs all of these runs, up to about 2.5 * em_iterations
+    iterations.
+
+    A segment of a chromosome (see split_chromosome()) is cached under
+    segment_key, which identifies its SNPs.  In a cache shared by several
+    studies, the fit is instead cached under cache_key (see
+    hmm_cache_key()).
+    '''
+    tag = fastphase_tag(chromosome, hmm_states, segment_key=segment_key,
+                        cache_key=cache_key)
+    out_path = '%s/chrom_%s' % (cache_dir, tag)
 
     # If all relevant files are found in cache, skip EM recomputation; otherwise,
-    # redo the whole thing.
-    target_file_suffix_list = [
-        'alphahat.txt', 'finallikelihoods', 'origchars', 'rhat.txt', 'thetahat.txt']
-    already_in_cache = True
-    for suffix in target_file_suffix_list:
-        target_path = os.path.join(
-            cache_dir, 'chrom_%d_%s' % (chromosome, suffix))
-        if not os.path.exists(target_path):
-            already_in_cache = False
-            break
-    if already_in_cache:
-        logger.debug("Found chrom %d HMM in cache" % chromosome)
-    else:
-        # Write array to file
-        Xfp_file = '%s/X_%d.inp' % (cache_dir, chromosome)
-        fp.writeX(X_ensembl, Xfp_file)
-
-        # Run fastPhase on data (which runs EM)
-        fp.runFastPhase(path_to_fp, Xfp_file, out_path,
-                        K=12, numit=em_iterations)
+    # redo the whole thing.  Only one process at a time may run fastPHASE into
+    # out_path.
+    with cache_entry.lock(out_path):
+        run_fastphase(chromosome, X_ensembl, cache_dir, tag, path_to_fp, hmm_states,
+                      em_iterations, em_tolerance)
 
     # Read in fastPhase results (i.e., HMM parameters) from file:
     r_file = out_path + "_rhat.txt"
@@ -72,6 +103,237 @@ def make_knockoff(chromosome=None, grouped_by_chromosome=None, df_SNP=None,
     theta_file = out_path + "_thetahat.txt"
     # Why is X_ensembl[0, :] in the function arguments below?
     hmm = fp.loadFit(r_file, theta_file, alpha_file, X_ensembl[0, :])
+    return(hmm)
+
+
+def run_fastphase(chromosome, X_ensembl, cache_dir, tag, path_to_fp, hmm_states,
+                  em_iterations, em_tolerance):
+    '''
+    Run fastPHASE into the cache, unless its output is already there.  The
+    output files are a cache entry (see cache_entry.py) named out_path, so a
+    run that did not finish is redone.
+    '''
+    out_path = '%s/chrom_%s' % (cache_dir, tag)
+    target_paths = ['%s_%s' % (out_path, suffix) for suffix in FASTPHASE_SUFFIXES]
+    if cache_entry.is_complete(out_path, target_paths):
+        logger.debug("Found chrom %d HMM in cache" % chromosome)
+    else:
+        cache_entry.discard(out_path)
+        # Write array to file
+        Xfp_file = '%s/X_%s.inp' % (cache_dir, tag)
+        fp.writeX(X_ensembl, Xfp_file)
+
+        # Run fastPhase on data (which runs EM)
+        if em_tolerance > 0:
+            num_iterations = min(FIRST_FASTPHASE_ITERATIONS, em_iterations)
+        else:
+            num_iterations = em_iterations
+        previous = None
+        while True:
+            fp.runFastPhase(path_to_fp, Xfp_file, out_path,
+                            K=hmm_states, numit=num_iterations)
+            if num_iterations >= em_iterations:
+                break
+            log_likelihood = final_log_likelihood(out_path + '_finallikelihoods')
+            if log_likelihood is None:
+                # Cannot monitor convergence; just do the full run.
+                num_iterations = em_iterations
+                continue
+            if previous is not None and (
+                    log_likelihood - previous[1] <=
+                    em_tolerance * (num_iterations - previous[0]) * abs(previous[1])):
+                break
+            previous = (num_iterations, log_likelihood)
+            num_iterations = min(2 * num_iterations, em_iterations)
+        logger.debug("Chrom %d: fastPHASE stopped after %d EM iterations" % (
+            chromosome, num_iterations))
+        cache_entry.commit(out_path, target_paths)
+
+
+def SNP_set_key(SNPs):
+    return(hashlib.sha1(','.join(SNPs).encode('utf-8')).hexdigest()[:16])
+
+
+def hmm_cache_key(SNPs, X_ensembl):
+    '''
+    Key of an HMM fit in a cache shared by several studies: a hash of the
+    SNPs and of the ENSEMBL genotypes (people x SNPs) it is fit to, since
+    studies with the same SNPs may refine the ENSEMBL population
+    differently.
+    '''
+    sha = hashlib.sha1(','.join(SNPs).encode('utf-8'))
+    sha.update(np.ascontiguousarray(X_ensembl, dtype=np.int8).tobytes())
+    return(sha.hexdigest()[:16])
+
+
+def numpy_hmm_file(cache_dir, hmm_states, SNPs, cache_key=None):
+    '''
+    File of a fit by fit_hmm_in_process().
+    '''
+    if cache_key is None:
+        cache_key = SNP_set_key(SNPs)
+    return(os.path.join(cache_dir, 'hmm_K%d_%s.npz' % (hmm_states, cache_key)))
+
+
+def hmm_in_cache(cache_dir, hmm_engine, hmm_states, chromosome, SNPs,
+                 segment_key=None, cache_key=None):
+    '''
+    Is the HMM fit for these SNPs already in the cache?  (Its checksums are
+    only verified when it is used.)
+    '''
+    if hmm_engine == 'numpy':
+        return(cache_entry.has_checksum(numpy_hmm_file(cache_dir, hmm_states, SNPs,
+                                                       cache_key=cache_key)))
+    tag = fastphase_tag(chromosome, hmm_states, segment_key=segment_key,
+                        cache_key=cache_key)
+    return(cache_entry.has_checksum('%s/chrom_%s' % (cache_dir, tag)))
+
+
+def find_warm_start(cache_dir, hmm_states, SNPs, random_seed):
+    '''
+    Starting point for EM from the cached fit sharing the most SNPs with
+    SNPs (e.g., from a run on a slightly different panel), or None if no
+    fit covers at least MIN_WARM_START_OVERLAP of them.
+    '''
+    SNP_set = set(SNPs)
+    best = None
+    best_overlap = MIN_WARM_START_OVERLAP * len(SNPs)
+    for hmm_file in glob.glob(os.path.join(cache_dir, 'hmm_K%d_*.npz' % hmm_states)):
+        try:
+            cached = np.load(hmm_file)
+            overlap = len(SNP_set.intersection(cached['SNPs']))
+        except Exception:
+            continue
+        if overlap >= best_overlap:
+            (best, best_overlap) = (hmm_file, overlap)
+    if best is None:
+        return(None)
+    logger.debug("Warm-starting EM from %s (%d of %d SNPs)" % (
+        best, best_overlap, len(SNPs)))
+    cached = np.load(best)
+    return(hmm_fit.warm_start(SNPs, list(cached['SNPs']), cached,
+                              random_seed=random_seed))
+
+
+def fit_hmm_in_process(chromosome, X_ensembl, SNPs_on_chromosome, cache_dir, hmm_states,
+                       em_iterations, em_tolerance, em_restarts, cache_key=None):
+    '''
+    Fit the HMM with hmm_fit, or reuse a cached fit of the same SNPs.  Fits
+    are cached by SNP set (or, in a cache shared by several studies, by
+    cache_key; see hmm_cache_key()); a new SNP set is warm-started from the
+    cached fit that overlaps it most.
+    '''
+    SNPs = [str(SNP) for SNP in SNPs_on_chromosome]
+    hmm_file = numpy_hmm_file(cache_dir, hmm_states, SNPs, cache_key=cache_key)
+    # Only one process at a time may fit a missing HMM; see cache_entry.py.
+    with cache_entry.lock(hmm_file):
+        fit = None
+        if cache_entry.is_complete(hmm_file, [hmm_file]) or (
+                os.path.exists(hmm_file) and not cache_entry.has_checksum(hmm_file)):
+            # A fit cached before the cache kept checksums is kept if it loads.
+            try:
+                cached = np.load(hmm_file)
+                fit = dict((k, cached[k]) for k in ['r', 'alpha', 'theta'])
+                logger.debug("Found chrom %d HMM in cache" % chromosome)
+                if not cache_entry.has_checksum(hmm_file):
+                    cache_entry.commit(hmm_file, [hmm_file])
+            except Exception:
+                fit = None
+        if fit is None:
+            cache_entry.discard(hmm_file)
+            # Same seed as fastPHASE's default; the fit is shared by all trials.
+            start = find_warm_start(cache_dir, hmm_states, SNPs, random_seed=1)
+            fit = hmm_fit.fit(X_ensembl, K=hmm_states, max_iterations=em_iterations,
+                              tolerance=em_tolerance, num_starts=em_restarts, random_seed=1,
+                              n_jobs=em_restarts, start=start)
+            logger.debug("Chrom %d: EM stopped after %d iterations" % (
+                chromosome, len(fit['log_likelihoods'])))
+            cache_entry.atomic_write(
+                hmm_file, lambda fp: np.savez(fp, SNPs=np.array(SNPs), **fit))
+            cache_entry.commit(hmm_file, [hmm_file])
+    return(hmm_fit.assemble_hmm(fit['r'], fit['alpha'], fit['theta']))
+
+
+def split_chromosome(positions, X_ensembl, segment_gap, segment_r2, min_segment_SNPs):
+    '''
+    Split the SNPs of a chromosome (in position order) into segments that
+    get separate HMMs: at gaps of more than segment_gap base pairs between
+    adjacent SNPs, and where adjacent SNPs have squared correlation below
+    segment_r2 in the ENSEMBL genotypes X_ensembl (people x SNPs).  Either
+    test is disabled by 0.  A split is only made if it leaves at least
+    min_segment_SNPs SNPs on each side.  Returns a list of (start, end)
+    index pairs.
+    '''
+    num_SNPs = len(positions)
+    split_before = np.zeros(num_SNPs, dtype=bool)
+    if segment_gap > 0:
+        split_before[1:] |= np.diff(positions) > segment_gap
+    if segment_r2 > 0 and num_SNPs > 1:
+        X = np.asarray(X_ensembl, dtype=float)
+        X = X - X.mean(axis=0)
+        norms = np.sqrt((X ** 2).sum(axis=0))
+        covariance = (X[:, 1:] * X[:, :-1]).sum(axis=0)
+        # A constant SNP is uncorrelated with its neighbours.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = np.where(norms[1:] * norms[:-1] > 0,
+                          covariance / (norms[1:] * norms[:-1]), 0.0) ** 2
+        split_before[1:] |= r2 < segment_r2
+
+    segments = []
+    start = 0
+    for j in np.flatnonzero(split_before).tolist():
+        if j - start >= min_segment_SNPs and num_SNPs - j >= min_segment_SNPs:
+            segments.append((start, j))
+            start = j
+    segments.append((start, num_SNPs))
+    return(segments)
+
+
+def chromosome_genotypes_and_hmm(chromosome, SNPs_on_chromosome, SNP_columns,
+                                 X_experiment_all, X_ensembl_all, cache_dir, path_to_fp,
+                                 em_iterations, hmm_engine, hmm_states,
+                                 em_tolerance, em_restarts, segment_key=None,
+                                 cache_key=None):
+    '''
+    Genotypes (as non-wild-type allele counts) of the experimental data at
+    SNPs_on_chromosome, and the HMM fit to the ENSEMBL genotypes there.  The
+    SNPs are columns SNP_columns of the count matrices X_experiment_all and
+    X_ensembl_all (see utils.genotype_count_matrix()).
+    '''
+    X_experiment = X_experiment_all[:, SNP_columns]
+    X_ensembl = X_ensembl_all[:, SNP_columns]
+
+    if hmm_engine == 'numpy':
+        hmm = fit_hmm_in_process(chromosome, X_ensembl, SNPs_on_chromosome, cache_dir,
+                                 hmm_states, em_iterations, em_tolerance, em_restarts,
+                                 cache_key=cache_key)
+    else:
+        hmm = fit_hmm_with_fastphase(chromosome, X_ensembl, cache_dir, path_to_fp,
+                                     hmm_states, em_iterations, em_tolerance,
+                                     segment_key=segment_key, cache_key=cache_key)
+    return(X_experiment, hmm)
+
+
+def make_knockoff(chromosome=None, SNPs_on_chromosome=None, SNP_columns=None,
+                  X_experiment_all=None, X_ensembl_all=None, cache_dir=None,
+                  path_to_fp=None, em_iterations=25, random_seed=123,
+                  hmm_engine='fastphase', hmm_states=12, em_tolerance=0.0,
+                  em_restarts=1, segment_key=None, cache_key=None):
+    assert chromosome is not None
+    assert SNPs_on_chromosome is not None
+    assert SNP_columns is not None
+
+    logger.debug("################")
+    logger.debug("Chromosome %2d #" % chromosome)
+    logger.debug("################")
+    if segment_key is not None:
+        logger.debug("Segment of %d SNPs, %s to %s" % (
+            len(SNPs_on_chromosome), SNPs_on_chromosome[0], SNPs_on_chromosome[-1]))
+
+    (X_experiment, hmm) = chromosome_genotypes_and_hmm(
+        chromosome, SNPs_on_chromosome, SNP_columns, X_experiment_all, X_ensembl_all,
+        cache_dir, path_to_fp, em_iterations, hmm_engine, hmm_states,
+        em_tolerance, em_restarts, segment_key=segment_key, cache_key=cache_key)
 
     # Actually produce the knockoffs
     knockoffs = knockoffHMM(hmm["pInit"], hmm["Q"], hmm[
@@ -81,7 +343,33 @@ def make_knockoff(chromosome=None, grouped_by_chromosome=None, df_SNP=None,
     return(X_knockoffs, X_experiment, SNPs_on_chromosome)
 
 
-def make_all_knockoffs(args):
+def make_multi_trial_knockoffs(chromosome=None, SNPs_on_chromosome=None, SNP_columns=None,
+                               X_experiment_all=None, X_ensembl_all=None, cache_dir=None,
+                               path_to_fp=None, em_iterations=25, random_seeds=None,
+                               hmm_engine='fastphase', hmm_states=12, em_tolerance=0.0,
+                               em_restarts=1, segment_key=None, cache_key=None):
+    '''
+    As make_knockoff(), but for all of random_seeds at once with
+    knockoff_sampler; X_knockoffs has shape (len(random_seeds), n, p).
+    '''
+    assert chromosome is not None
+    assert random_seeds is not None
+
+    logger.debug("Chromosome %2d: sampling %d knockoff trials" % (
+        chromosome, len(random_seeds)))
+
+    (X_experiment, hmm) = chromosome_genotypes_and_hmm(
+        chromosome, SNPs_on_chromosome, SNP_columns, X_experiment_all, X_ensembl_all,
+        cache_dir, path_to_fp, em_iterations, hmm_engine, hmm_states,
+        em_tolerance, em_restarts, segment_key=segment_key, cache_key=cache_key)
+
+    sampler = knockoff_sampler.MultiTrialSampler(hmm, X_experiment)
+    X_knockoffs = sampler.sample(random_seeds)
+
+    return(X_knockoffs, X_experiment, SNPs_on_chromosome)
+
+
+def make_all_knockoffs(args, trial_list=None):
     '''
     For each chromosome, independently:
        Sort SNPs according to position on genome.
@@ -90,25 +378,47 @@ def make_all_knockoffs(args):
 
     For now, we ignore sex of persons, although that is
     available in ENSEMBL
+
+    By default, generate all of the --num_knockoff_trials trials; otherwise,
+    only generate the trials (i.e., 0-up trial indices) in trial_list.
     '''
 
     logger.info("####################################")
     logger.info("Fitting HMM and generating knockoffs")
 
     path_to_fp = os.path.join(args.fastPHASE_path, 'fastPHASE')
-    if not(os.path.exists(path_to_fp)):
+    if args.hmm_engine == 'fastphase' and not(os.path.exists(path_to_fp)):
         logger.info("Cannot find fastPHASE at %s" % path_to_fp)
         raise Exception
 
-    cache_dir = os.path.join(args.working_dir, 'fastphase_cache')
-    utils.safe_mkdir(cache_dir)
+    cache_dir = utils.cache_subdir(args, 'fastphase_cache')
+
+    # Arrays shared with the workers (see utils.shared_array()).
+    shared_dir = tempfile.mkdtemp(prefix='shared_', dir=args.working_dir)
+    try:
+        make_knockoff_trials(args, trial_list, path_to_fp, cache_dir, shared_dir)
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    logger.info("Done making knockoffs!!!")
+
 
-    df_geno_ensembl = pd.read_csv(os.path.join(
-        (args.working_dir), 'pruned_ensembl.csv'))
+def make_knockoff_trials(args, trial_list, path_to_fp, cache_dir, shared_dir):
+    '''
+    The work of make_all_knockoffs(); arrays shared with the workers are
+    written to shared_dir.
+    '''
+    if args.streaming:
+        # Only the allele counts of the ENSEMBL panel are needed; see
+        # genotype_store.py.
+        ensembl_store = genotype_store.Store(
+            utils.knockoff_input_file(args, 'ensembl_store'))
+        ensembl_SNPs = ensembl_store.SNPs
+    else:
+        df_geno_ensembl = pd.read_csv(utils.knockoff_input_file(args, 'ensembl.csv'))
+        ensembl_SNPs = [c for c in df_geno_ensembl.columns if c.startswith('rs')]
 
     # SNP,wild_type,chromosome,chromosome_position
-    df_SNP = pd.read_csv(os.path.join(
-        (args.working_dir), 'pruned_SNP_facts.csv'))
+    df_SNP = pd.read_csv(utils.knockoff_input_file(args, 'SNP_facts.csv'))
     df_wild = pd.read_csv(os.path.join(args.working_dir, 'wild_types.csv'))
     SNP_to_wild_type = dict(
         zip(df_wild['SNP'].values, df_wild['wild_type'].values))
@@ -117,14 +427,14 @@ def make_all_knockoffs(args):
     for chromosome in chromosome_list:
         assert chromosome in np.arange(1, 24)
 
-    df_geno_experiment = pd.read_csv(os.path.join(
-        (args.working_dir), 'pruned_experiment.csv'))
+    df_geno_experiment = pd.read_csv(utils.knockoff_input_file(args, 'experiment.csv'))
 
     # Make sure we have the same SNPs everywhere.
-    assert (set([c for c in df_geno_ensembl.columns if c.startswith('rs')]) ==
+    ensembl_SNP_set = set(ensembl_SNPs)
+    assert (ensembl_SNP_set ==
             set([c for c in df_geno_experiment.columns if c.startswith('rs')]))
     for SNP in df_SNP.SNP.values:
-        assert SNP in df_geno_ensembl.columns
+        assert SNP in ensembl_SNP_set
 
     grouped_by_chromosome = df_SNP.groupby('chromosome')
     num_experiment_people = len(df_geno_experiment)
@@ -133,40 +443,128 @@ def make_all_knockoffs(args):
 
     utils.safe_mkdir(os.path.join(args.working_dir, 'knockoffs'))
 
-    em_iterations = 500
-    logger.info('Number of EM iterations: %d' % em_iterations)
-
-    for knockoff_trial_count in xrange(args.num_knockoff_trials):
+    em_iterations = args.em_iterations
+    logger.info('Fitting HMM with %s; at most %d EM iterations' % (
+        args.hmm_engine, em_iterations))
+
+    # Convert the genotypes to allele counts once, and share them with the
+    # workers through memory-mapped files; each task gets only the columns
+    # of its SNPs.
+    SNP_column = dict((SNP, j) for (j, SNP) in enumerate(df_SNP.SNP.values))
+    X_experiment_all = utils.shared_array(
+        utils.genotype_count_matrix(df_geno_experiment, df_SNP.SNP.values, SNP_to_wild_type),
+        os.path.join(shared_dir, 'X_experiment.npy'))
+    if args.streaming:
+        X_ensembl_all = ensembl_store.shared_array(
+            df_SNP.SNP.values, os.path.join(shared_dir, 'X_ensembl.npy'),
+            args.memory_budget_mb)
+    else:
+        X_ensembl_all = utils.shared_array(
+            utils.genotype_count_matrix(df_geno_ensembl, df_SNP.SNP.values, SNP_to_wild_type),
+            os.path.join(shared_dir, 'X_ensembl.npy'))
+
+    # Each (chromosome, segment) pair gets its own HMM and is a separate
+    # task; segment_key is None for a chromosome that is not split.  In a
+    # cache shared by several studies, each HMM is keyed by content instead
+    # (cache_key; see hmm_cache_key()).
+    segment_list = []
+    for chromosome in chromosome_list:
+        df_SNP_chromo = df_SNP.iloc[grouped_by_chromosome.groups[chromosome]].sort_values(
+            'chromosome_position')
+        SNPs_on_chromosome = df_SNP_chromo['SNP'].values
+        columns = [SNP_column[SNP] for SNP in SNPs_on_chromosome]
+        if args.segment_gap > 0 or args.segment_r2 > 0:
+            segments = split_chromosome(
+                df_SNP_chromo['chromosome_position'].values, X_ensembl_all[:, columns],
+                args.segment_gap, args.segment_r2, args.min_segment_SNPs)
+        else:
+            segments = [(0, len(SNPs_on_chromosome))]
+        if len(segments) > 1:
+            logger.info('Splitting the %d SNPs on chromosome %d into %d segments' % (
+                len(SNPs_on_chromosome), chromosome, len(segments)))
+        for (start, end) in segments:
+            segment_SNPs = SNPs_on_chromosome[start:end]
+            segment_key = None
+            if len(segments) > 1:
+                segment_key = SNP_set_key([str(SNP) for SNP in segment_SNPs])
+            cache_key = None
+            if args.cache_dir is not None:
+                cache_key = hmm_cache_key([str(SNP) for SNP in segment_SNPs],
+                                          X_ensembl_all[:, columns[start:end]])
+            segment_list.append((chromosome, segment_SNPs, columns[start:end],
+                                 segment_key, cache_key))
+
+    num_cached = len([segment for segment in segment_list if hmm_in_cache(
+        cache_dir, args.hmm_engine, args.hmm_states, segment[0],
+        [str(SNP) for SNP in segment[1]], segment_key=segment[3], cache_key=segment[4])])
+    logger.info('%d of %d HMMs found in cache %s' % (
+        num_cached, len(segment_list), cache_dir))
+    run_report.add_counts(hmm_cache_hits=num_cached,
+                          hmm_cache_misses=len(segment_list) - num_cached)
+
+    if trial_list is None:
+        trial_list = xrange(args.num_knockoff_trials)
+    trial_list = list(trial_list)
+
+    if args.knockoff_sampler == 'numpy':
+        # One backward pass per chromosome, shared by all of the trials.
+        timed_results = Parallel(n_jobs=args.num_workers)(
+            delayed(run_report.timed_call)(
+                make_multi_trial_knockoffs, chromosome=i,
+                SNPs_on_chromosome=SNPs, SNP_columns=columns,
+                X_experiment_all=X_experiment_all, X_ensembl_all=X_ensembl_all,
+                cache_dir=cache_dir, path_to_fp=path_to_fp,
+                em_iterations=em_iterations,
+                random_seeds=[t + args.random_seed for t in trial_list],
+                hmm_engine=args.hmm_engine, hmm_states=args.hmm_states,
+                em_tolerance=args.em_tolerance, em_restarts=args.em_restarts,
+                segment_key=segment_key, cache_key=cache_key)
+            for (i, SNPs, columns, segment_key, cache_key) in segment_list)
+        multi_trial_knockoffs = run_report.record_tasks('make_multi_trial_knockoffs',
+                                                        timed_results)
+
+    for (trial_index, knockoff_trial_count) in enumerate(trial_list):
         random_seed = knockoff_trial_count + args.random_seed
         if ((args.num_knockoff_trials <= 20) or
                 knockoff_trial_count % ((args.num_knockoff_trials) // 20) == 0):
             logger.info("Knockoff sampling %d of %d" % (
                 knockoff_trial_count, args.num_knockoff_trials))
 
-        if False:
+        if args.knockoff_sampler == 'numpy':
+            knockoff_SNP_list = [
+                (X_knockoffs[trial_index], X_experiment, SNPs_on_chromosome)
+                for (X_knockoffs, X_experiment, SNPs_on_chromosome) in multi_trial_knockoffs]
+        elif False:
             # Serial version; code preserved for debugging purposes
-            for chromosome in chromosome_list:
+            for (chromosome, SNPs, columns, segment_key, cache_key) in segment_list:
                 knockoff_SNP_list.append(
                     make_knockoff(
-                        chromosome=chromosome,
-                        grouped_by_chromosome=grouped_by_chromosome, df_SNP=df_SNP,
-                        df_geno_experiment=df_geno_experiment, df_geno_ensembl=df_geno_ensembl,
-                        SNP_to_wild_type=SNP_to_wild_type, cache_dir=cache_dir,
-                        path_to_fp=path_to_fp, em_iterations=em_iterations, random_seed=random_seed))
+                        chromosome=chromosome, SNPs_on_chromosome=SNPs, SNP_columns=columns,
+                        X_experiment_all=X_experiment_all, X_ensembl_all=X_ensembl_all,
+                        cache_dir=cache_dir, path_to_fp=path_to_fp,
+                        em_iterations=em_iterations, random_seed=random_seed,
+                        hmm_engine=args.hmm_engine, hmm_states=args.hmm_states,
+                        em_tolerance=args.em_tolerance, em_restarts=args.em_restarts,
+                        segment_key=segment_key, cache_key=cache_key))
         else:
-            knockoff_SNP_list = Parallel(n_jobs=args.num_workers)(
-                delayed(make_knockoff)(
-                    chromosome=i,
-                    grouped_by_chromosome=grouped_by_chromosome, df_SNP=df_SNP,
-                    df_geno_experiment=df_geno_experiment, df_geno_ensembl=df_geno_ensembl,
-                    SNP_to_wild_type=SNP_to_wild_type, cache_dir=cache_dir, path_to_fp=path_to_fp,
-                    em_iterations=em_iterations, random_seed=random_seed)
-                for i in chromosome_list)
+            timed_results = Parallel(n_jobs=args.num_workers)(
+                delayed(run_report.timed_call)(
+                    make_knockoff, chromosome=i,
+                    SNPs_on_chromosome=SNPs, SNP_columns=columns,
+                    X_experiment_all=X_experiment_all, X_ensembl_all=X_ensembl_all,
+                    cache_dir=cache_dir, path_to_fp=path_to_fp,
+                    em_iterations=em_iterations, random_seed=random_seed,
+                    hmm_engine=args.hmm_engine, hmm_states=args.hmm_states,
+                    em_tolerance=args.em_tolerance, em_restarts=args.em_restarts,
+                    segment_key=segment_key, cache_key=cache_key)
+                for (i, SNPs, columns, segment_key, cache_key) in segment_list)
+            knockoff_SNP_list = run_report.record_tasks('make_knockoff', timed_results)
+        run_report.add_counts(knockoff_trials=1, chromosomes=len(chromosome_list),
+                              segments=len(segment_list))
 
         # Stitch results for each chromosome back together into a single dataframe
         # Knockoff results
-        SNP_columns = [
-            x for x in df_geno_ensembl.columns if x.startswith('rs')]
+        SNP_columns = ensembl_SNPs
         df_knockoffs = pd.DataFrame(
             columns=SNP_columns, index=np.arange(num_experiment_people))
 
@@ -203,8 +601,6 @@ def make_all_knockoffs(args):
                                        'knockoffs_%03d.csv' % knockoff_trial_count),
                           index=False)
 
-    logger.info("Done making knockoffs!!!")
-
 
 if __name__ == '__main__':
     args = utils.parse_arguments()
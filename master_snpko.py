@@ -6,16 +6,181 @@ import ensembl_miner
 import simple_stats
 import population_refiner
 import find_loci
+import screen_loci
 import make_knockoffs
+import hmm_fit
+import knockoff_sampler
 import classifier
+import enet_logistic
+import selection_table
+import genotype_store
+import packed_genotypes
 import sig_results
 import halt_machine
 import traceback
 import p_values
+import stage_cache
+import run_report
 
 logger = utils.logger
 
 
+def knockoff_trials(args):
+    '''
+    Generate the knockoffs and run the classifier on them, either for a fixed
+    number of trials or (with --adaptive_trials) until obs_freq converges.
+    '''
+    if args.adaptive_trials:
+        classifier.adaptive_significant_SNPs(args)
+    else:
+        make_knockoffs.make_all_knockoffs(args)
+        classifier.significant_SNPs(args)
+
+
+# Every stage of the pipeline (other than p-values), in order, with the files
+# and arguments it reads and the files it writes; see stage_cache.py.  With
+# --streaming, the ENSEMBL panel is passed between stages in the *_store
+# directories instead of ensembl.pkl and the *_ensembl.csv files.
+PREPARATION_STAGES = [
+    stage_cache.Stage(
+        'check_input', check_input.check_and_convert_input,
+        input_files=['{input_file}', '{input_prefix}.bim', '{input_prefix}.fam',
+                     '{phenotype_file}'],
+        arg_fields=['input_file', 'phenotype_file', 'skip_rows', 'data_prefix',
+                    'na_threshold', 'never_na'],
+        output_files=['{working_dir}/cleaned_input.csv',
+                      '{working_dir}/wild_types.csv'],
+        code_modules=[packed_genotypes]),
+    stage_cache.Stage(
+        'download_SNPs', ensembl_miner.download_SNPs,
+        input_files=['{working_dir}/cleaned_input.csv',
+                     '{working_dir}/wild_types.csv'],
+        arg_fields=['streaming'],
+        output_files=['{working_dir}/SNP_facts.csv', '{working_dir}/ensembl.pkl',
+                      '{working_dir}/ensembl_store', '{working_dir}/wild_types.csv'],
+        code_modules=[genotype_store, packed_genotypes]),
+    stage_cache.Stage(
+        'stats', simple_stats.stats,
+        input_files=['{working_dir}/cleaned_input.csv',
+                     '{working_dir}/wild_types.csv'],
+        arg_fields=['data_prefix'],
+        output_files=['{working_dir}/results/uncorrected.csv',
+                      '{working_dir}/results/association.csv'],
+        code_modules=[packed_genotypes]),
+    stage_cache.Stage(
+        'refine', population_refiner.refine,
+        input_files=['{working_dir}/ensembl.pkl', '{working_dir}/ensembl_store'],
+        arg_fields=['snp_weight', 'streaming'],
+        output_files=['{working_dir}/genotypes_ensembl.csv',
+                      '{working_dir}/genotypes_ensembl_store'],
+        code_modules=[genotype_store, packed_genotypes]),
+    stage_cache.Stage(
+        'prune', find_loci.prune,
+        input_files=['{working_dir}/SNP_facts.csv', '{working_dir}/wild_types.csv',
+                     '{working_dir}/cleaned_input.csv',
+                     '{working_dir}/genotypes_ensembl.csv',
+                     '{working_dir}/genotypes_ensembl_store'],
+        arg_fields=['data_prefix', 'locus_threshold', 'streaming'],
+        output_files=['{working_dir}/pruned_experiment.csv',
+                      '{working_dir}/pruned_ensembl.csv',
+                      '{working_dir}/pruned_ensembl_store',
+                      '{working_dir}/pruned_SNP_facts.csv'],
+        code_modules=[genotype_store, packed_genotypes]),
+    stage_cache.Stage(
+        'screen', screen_loci.screen,
+        input_files=['{working_dir}/pruned_experiment.csv',
+                     '{working_dir}/pruned_ensembl.csv',
+                     '{working_dir}/pruned_ensembl_store',
+                     '{working_dir}/pruned_SNP_facts.csv', '{working_dir}/wild_types.csv',
+                     '{working_dir}/results/association.csv'],
+        arg_fields=['data_prefix', 'streaming', 'screen_p_value', 'screen_test',
+                    'screen_min_variance', 'screen_split', 'original_random_seed'],
+        output_files=['{working_dir}/screened_experiment.csv',
+                      '{working_dir}/screened_ensembl.csv',
+                      '{working_dir}/screened_ensembl_store',
+                      '{working_dir}/screened_SNP_facts.csv'],
+        code_modules=[simple_stats, genotype_store, packed_genotypes]),
+]
+
+# The knockoff stages read the screened loci if screening, otherwise the
+# pruned loci; see utils.knockoff_input_file().
+KNOCKOFF_INPUT_FILES = ['{working_dir}/{knockoff_input_prefix}experiment.csv',
+                        '{working_dir}/{knockoff_input_prefix}ensembl.csv',
+                        '{working_dir}/{knockoff_input_prefix}ensembl_store',
+                        '{working_dir}/{knockoff_input_prefix}SNP_facts.csv',
+                        '{working_dir}/wild_types.csv']
+KNOCKOFF_ARG_FIELDS = ['data_prefix', 'streaming', 'num_knockoff_trials', 'random_seed',
+                       'hmm_engine', 'hmm_states', 'em_iterations', 'em_tolerance', 'em_restarts',
+                       'knockoff_sampler', 'segment_gap', 'segment_r2', 'min_segment_SNPs']
+# The classifier's selections at another --fdr are recomputed from its W
+# statistics by the summary (see sig_results.selections()), so --fdr is not
+# one of its arguments.
+CLASSIFIER_ARG_FIELDS = ['data_prefix', 'num_knockoff_trials', 'random_seed',
+                         'cv', 'alpha_count', 'l1_count', 'tol', 'n_iter_no_change',
+                         'SGD_max_iterations', 'classifier_engine', 'cd_tolerance']
+
+SUMMARIZE_STAGE = stage_cache.Stage(
+    'summarize', sig_results.summarize,
+    input_files=['{results_dir}/knockoff_selections.npz', '{results_dir}/W_statistics.npy',
+                 '{results_dir}/uncorrected.csv'],
+    arg_fields=['fdr', 'obs_freq', 'knockoff_report'],
+    output_files=['{results_dir}/all_results.csv', '{results_dir}/sig_results.csv',
+                  '{results_dir}/sig_max.csv', '{results_dir}/expected_appearance.csv',
+                  '{results_dir}/exploratory.csv'],
+    code_modules=[selection_table])
+
+STAGE_NAMES = utils.STAGE_NAMES
+
+
+def causal_stages(args):
+    '''
+    Stages that generate knockoffs and select SNPs.  With --adaptive_trials,
+    knockoff generation and the classifier are interleaved, so they are a
+    single stage.
+    '''
+    if args.adaptive_trials:
+        knockoff_stages = [stage_cache.Stage(
+            'classifier', knockoff_trials,
+            input_files=KNOCKOFF_INPUT_FILES,
+            # When to stop adding trials depends on the selections at --fdr.
+            arg_fields=KNOCKOFF_ARG_FIELDS + CLASSIFIER_ARG_FIELDS + [
+                'fdr', 'obs_freq', 'trial_batch_size', 'trial_confidence'],
+            output_files=['{results_dir}/knockoff_selections.npz',
+                          '{results_dir}/W_statistics.npy',
+                          '{results_dir}/convergence_trace.csv'],
+            code_modules=[make_knockoffs, hmm_fit, knockoff_sampler, genotype_store,
+                          packed_genotypes, classifier, enet_logistic, selection_table])]
+    else:
+        knockoff_stages = [
+            stage_cache.Stage(
+                'knockoffs', make_knockoffs.make_all_knockoffs,
+                input_files=KNOCKOFF_INPUT_FILES,
+                arg_fields=KNOCKOFF_ARG_FIELDS,
+                output_files=['{working_dir}/knockoffs'],
+                code_modules=[hmm_fit, knockoff_sampler, genotype_store,
+                              packed_genotypes]),
+            stage_cache.Stage(
+                'classifier', classifier.significant_SNPs,
+                input_files=['{working_dir}/knockoffs',
+                             '{working_dir}/{knockoff_input_prefix}experiment.csv'],
+                arg_fields=CLASSIFIER_ARG_FIELDS,
+                output_files=['{results_dir}/knockoff_selections.npz',
+                              '{results_dir}/W_statistics.npy'],
+                code_modules=[enet_logistic, selection_table])]
+    return(knockoff_stages + [SUMMARIZE_STAGE])
+
+
+def p_value_trial(args, p_trial_num):
+    '''
+    One null-hypothesis trial for estimating p-values.
+    '''
+    with run_report.stage('p_value_trial', trials=1):
+        p_values.prepare_files(args, p_trial_num)
+        knockoff_trials(args)
+        sig_results.parse_knockoff_results(args)
+        p_values.upload_p_value_files(args, p_trial_num)
+
+
 def master(args):
     '''
     Given a collection of SNP data and some observed features (like presence
@@ -28,38 +193,59 @@ def master(args):
     '''
 
     utils.check_permissions(args)
+    if args.streaming and args.p_values:
+        # p-value trials swap ENSEMBL people into the experimental data, which
+        # needs the genotype strings of pruned_ensembl.csv.
+        logger.info('--streaming does not support --p_values')
+        raise Exception
+    if utils.screening_loci(args) and args.p_values:
+        # The null trials would each need their own screening to be valid.
+        logger.info('Screening loci ("--screen_p_value", "--screen_min_variance") does not '
+                    'support --p_values')
+        raise Exception
 
     try:
-        check_input.check_and_convert_input(args)
-        ensembl_miner.download_SNPs(args)
-        simple_stats.stats(args)
-        population_refiner.refine(args)
-        find_loci.prune(args)
-        if (args.machine_num == 0) or not(args.p_values):
+        stage_cache.run_stages(args, PREPARATION_STAGES, STAGE_NAMES)
+        if args.p_values and args.p_queue_dir is not None:
+            # With a shared job queue, the coordinator computes the causal
+            # knockoffs while the other workers start on p-value trials.
+            causal_machine = args.p_coordinator
+            if args.p_coordinator:
+                p_values.populate_p_value_queue(args)
+        else:
+            causal_machine = (args.machine_num == 0)
+        if causal_machine or not(args.p_values):
             logger.info("####################################")
             logger.info("CAUSAL KNOCKOFFS")
             # If computing p-values and using multiple machines,
             # only compute causal knockoffs on one machine.
             # (Rest are for computing p-values.)
-            make_knockoffs.make_all_knockoffs(args)
-            classifier.significant_SNPs(args)
-            sig_results.summarize(args)
+            stage_cache.run_stages(args, causal_stages(args), STAGE_NAMES)
             utils.upload_results_dir(args)
-        if args.p_values:
+        if args.p_values and args.to_stage is None:
             logger.info("####################################")
             logger.info("P-VALUE KNOCKOFFS")
             p_values.preserve_original_files(args)
-            for p_trial_num in xrange(args.p_samples):
-                p_values.prepare_files(args, p_trial_num)
-                make_knockoffs.make_all_knockoffs(args)
-                classifier.significant_SNPs(args)
-                sig_results.parse_knockoff_results(args)
-                p_values.upload_p_value_files(args, p_trial_num)
-            p_values.extract_null_distribution(args)
+            if args.p_queue_dir is not None:
+                p_values.run_p_value_queue(args, p_value_trial)
+            else:
+                for p_trial_num in xrange(args.p_samples):
+                    p_value_trial(args, p_trial_num)
+                    if (args.p_sequential and
+                            p_values.p_values_resolved(args, p_trial_num + 1)):
+                        logger.info('All reported p-values resolved; stopping '
+                                    'after %d of at most %d trials.' % (
+                                        p_trial_num + 1, args.p_samples))
+                        args.p_samples = p_trial_num + 1
+                        break
+            with run_report.stage('p_values'):
+                p_values.extract_null_distribution(args)
+        run_report.write_report(args)
         halt_machine.possibly_halt(args)
     except Exception:
         logger.warn(traceback.format_exc())
 
+        run_report.write_report(args)
         halt_machine.possibly_halt(args)
         raise
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Run master_snpko.py on several studies (e.g., cohorts genotyped on
+# overlapping SNP panels) at once, under a single budget of worker processes,
+# with one ENSEMBL and HMM cache shared by all of them (--cache_dir).  A SNP
+# is downloaded from ENSEMBL, and an HMM fitted, only once for all of the
+# studies; the caches are locked so that concurrent studies never fill the
+# same entry twice.
+#
+# The manifest (--study_manifest) is a CSV file with one row per study and
+# the columns
+#     input_file    the study's input file (required)
+#     study         name of the study (default: the input file's base name)
+#     working_dir   the study's working directory (default:
+#                   <working_dir>/<study>)
+# Any other column (e.g., data_prefix or results_dir) is passed to that study
+# as a command-line argument; empty cells are skipped.  The other arguments
+# given to multi_study.py apply to every study.
+#
+# Usage:
+#     ./multi_study.py --study_manifest studies.csv --cache_dir shared_cache \
+#         --num_workers 32 --concurrent_studies 4
+#
+# Each study writes its own working directory, as if run alone (with the
+# console output of master_snpko.py in multi_study_output.txt).  A summary of
+# all of the studies, including their ENSEMBL and HMM cache hits and misses,
+# is written to study_summary.csv in the working directory.
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+import pandas as pd
+import utils_snpko as utils
+import halt_machine
+
+logger = utils.logger
+
+MASTER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'master_snpko.py')
+
+# Arguments of multi_study.py that are not passed on to the studies, with
+# whether they take a value.  (--halt halts the machine after all of the
+# studies, not after the first.)
+RUNNER_ARGUMENTS = {'--study_manifest': True, '--concurrent_studies': True,
+                    '--input_file': True, '--working_dir': True, '--results_dir': True,
+                    '--cache_dir': True, '--num_workers': True, '--halt': False}
+
+# Subdirectories of --cache_dir that the studies share (see
+# utils.cache_subdir()).
+SHARED_CACHES = ['ensembl_cache', 'fastphase_cache']
+
+CACHE_COUNTS = ['ensembl_cache_hits', 'ensembl_cache_misses',
+                'hmm_cache_hits', 'hmm_cache_misses']
+
+
+def shared_arguments(argv):
+    '''
+    The command-line arguments in argv that apply to every study.
+    '''
+    shared = []
+    i = 0
+    while i < len(argv):
+        name = argv[i].split('=')[0]
+        if name in RUNNER_ARGUMENTS:
+            if RUNNER_ARGUMENTS[name] and '=' not in argv[i]:
+                i += 1
+        else:
+            shared.append(argv[i])
+        i += 1
+    return(shared)
+
+
+def read_manifest(args):
+    '''
+    The studies in --study_manifest, as a list of dicts with study,
+    input_file, working_dir and the study's own command-line arguments.
+    '''
+    df = pd.read_csv(args.study_manifest, dtype=str)
+    if 'input_file' not in df.columns:
+        logger.info('Study manifest %s has no "input_file" column' % args.study_manifest)
+        raise Exception
+    studies = []
+    for (_, row) in df.iterrows():
+        input_file = os.path.expanduser(row['input_file'])
+        study = row.get('study')
+        if pd.isnull(study):
+            study = os.path.splitext(os.path.basename(input_file))[0]
+        working_dir = row.get('working_dir')
+        if pd.isnull(working_dir):
+            working_dir = os.path.join(args.working_dir, study)
+        study_args = []
+        for field in df.columns:
+            if field in ['study', 'input_file', 'working_dir'] or pd.isnull(row[field]):
+                continue
+            study_args += ['--%s' % field, row[field]]
+        studies.append({'study': study, 'input_file': input_file,
+                        'working_dir': os.path.expanduser(working_dir),
+                        'arguments': study_args})
+    if len(set(s['working_dir'] for s in studies)) < len(studies):
+        logger.info('Studies in %s must have different working directories' %
+                    args.study_manifest)
+        raise Exception
+    return(studies)
+
+
+def cache_counts(study):
+    '''
+    ENSEMBL and HMM cache hits and misses of a finished study, from its run
+    report (summed over all of its stages); 0 if there is no report.
+    '''
+    results_dir = os.path.join(study['working_dir'], 'results')
+    if '--results_dir' in study['arguments']:
+        results_dir = os.path.expanduser(
+            study['arguments'][study['arguments'].index('--results_dir') + 1])
+    counts = dict((name, 0) for name in CACHE_COUNTS)
+    try:
+        with open(os.path.join(results_dir, 'run_report.json')) as fp:
+            report = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return(counts)
+    for record in report['stages']:
+        for name in CACHE_COUNTS:
+            counts[name] += record['counts'].get(name, 0)
+    return(counts)
+
+
+def run_study(study, command):
+    '''
+    Run master_snpko.py for one study; return its exit code and wall time.
+    '''
+    utils.safe_mkdir(study['working_dir'])
+    logger.info('Starting study %s in %s' % (study['study'], study['working_dir']))
+    start = time.time()
+    with open(os.path.join(study['working_dir'], 'multi_study_output.txt'), 'w') as out_fp:
+        exit_code = subprocess.call(command, stdout=out_fp, stderr=subprocess.STDOUT)
+    wall_seconds = time.time() - start
+    logger.info('Study %s %s after %.1fs' % (
+        study['study'], 'finished' if exit_code == 0 else 'FAILED (exit code %d)' % exit_code,
+        wall_seconds))
+    return(exit_code, wall_seconds)
+
+
+def run_studies(args):
+    '''
+    Run every study in --study_manifest, --concurrent_studies at a time, and
+    write study_summary.csv.
+    '''
+    logger.info("####################################")
+    logger.info("Running multiple studies")
+
+    studies = read_manifest(args)
+    if args.cache_dir is None:
+        args.cache_dir = os.path.abspath(os.path.join(args.working_dir, 'shared_cache'))
+    # Create the shared caches now, rather than in each study at once.
+    for name in SHARED_CACHES:
+        utils.cache_subdir(args, name)
+
+    # Split the worker budget between the studies running at once.
+    if args.num_workers == -1:
+        budget = multiprocessing.cpu_count()
+    else:
+        budget = args.num_workers
+    num_concurrent = max(1, min(args.concurrent_studies, len(studies)))
+    workers_per_study = max(1, budget // num_concurrent)
+    logger.info('%d studies, %d at a time with %d workers each; shared cache %s' % (
+        len(studies), num_concurrent, workers_per_study, args.cache_dir))
+
+    shared = shared_arguments(sys.argv[1:])
+    commands = [[sys.executable, MASTER_SCRIPT] + shared + [
+        '--input_file', study['input_file'], '--working_dir', study['working_dir'],
+        '--cache_dir', args.cache_dir, '--num_workers', str(workers_per_study)] +
+        study['arguments'] for study in studies]
+
+    pool = ThreadPool(num_concurrent)
+    try:
+        outcomes = pool.map(lambda i: run_study(studies[i], commands[i]),
+                            range(len(studies)))
+    finally:
+        pool.close()
+
+    rows = []
+    for (study, (exit_code, wall_seconds)) in zip(studies, outcomes):
+        row = {'study': study['study'], 'working_dir': study['working_dir'],
+               'exit_code': exit_code, 'wall_seconds': wall_seconds}
+        row.update(cache_counts(study))
+        logger.info('Study %s: ENSEMBL cache %d hits, %d misses; '
+                    'HMM cache %d hits, %d misses' % (
+                        study['study'], row['ensembl_cache_hits'],
+                        row['ensembl_cache_misses'], row['hmm_cache_hits'],
+                        row['hmm_cache_misses']))
+        rows.append(row)
+    summary_file = os.path.join(args.working_dir, 'study_summary.csv')
+    pd.DataFrame(rows, columns=['study', 'working_dir', 'exit_code', 'wall_seconds'] +
+                 CACHE_COUNTS).to_csv(summary_file, index=False)
+    logger.info('Study summary written to %s' % summary_file)
+
+    num_failed = len([row for row in rows if row['exit_code'] != 0])
+    if num_failed > 0:
+        logger.info('%d of %d studies failed' % (num_failed, len(studies)))
+    return(num_failed)
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    utils.initialize_logger(args)
+    if args.study_manifest is None:
+        logger.info('multi_study.py needs --study_manifest')
+        raise Exception
+    num_failed = run_studies(args)
+    halt_machine.possibly_halt(args)
+    sys.exit(1 if num_failed > 0 else 0)
@@ -5,6 +5,7 @@ import shutil
 import pandas as pd
 import numpy as np
 import utils_snpko as utils
+import job_queue
 
 logger = utils.logger
 
@@ -140,7 +141,9 @@ def prepare_files(args, p_trial_num):
     num_subjects = len(df_experiment)
     num_ensembl_total = len(df_ensembl)
     assert num_ensembl_total >= num_subjects
-    fake_subject_index = np.random.permutation(
+    # Seed the partition from the trial's random seed, so that a trial
+    # recomputed elsewhere (e.g., re-queued by job_queue) is identical.
+    fake_subject_index = np.random.RandomState(args.random_seed).permutation(
         np.arange(num_ensembl_total).astype(int))[:num_subjects]
     for i, j in enumerate(fake_subject_index):
         for col in df_ensembl:
@@ -173,9 +176,217 @@ def upload_p_value_files(args, p_trial_num):
                                  destination_name=destination_name)
 
 
+def populate_p_value_queue(args):
+    '''
+    Fill the shared job queue with p-value trials 0, ..., --p_samples - 1.
+    (Trials already in the queue, e.g. from an earlier run, are kept.)
+    '''
+    queue = job_queue.FileJobQueue(args.p_queue_dir,
+                                   heartbeat_timeout=args.heartbeat_timeout)
+    queue.populate(xrange(args.p_samples))
+    logger.info('Populated p-value job queue %s: %s' % (
+        args.p_queue_dir, queue.counts()))
+
+
+def run_p_value_queue(args, trial_fn):
+    '''
+    Work-stealing alternative to assigning p-value trials to machines with
+    "--machine_num".  Every worker (on this machine or any other machine that
+    shares --p_queue_dir) claims trial numbers from a job_queue.FileJobQueue
+    and calls trial_fn(args, p_trial_num) on each.  Trials whose worker stops
+    heartbeating are re-queued.
+
+    The coordinator (--p_coordinator) populates the queue (see
+    populate_p_value_queue()), works like any other worker, and then waits
+    until every trial is done.
+    '''
+    queue = job_queue.FileJobQueue(args.p_queue_dir,
+                                   heartbeat_timeout=args.heartbeat_timeout)
+    queue_results_dir = os.path.join(args.p_queue_dir, 'results')
+    utils.safe_mkdir(queue_results_dir)
+
+    def work(p_trial_num):
+        # The random seed depends only on the trial number (not on which
+        # worker runs it); prepare_files() adds 10000 before first use.
+        args.random_seed = args.original_random_seed + 10000 * p_trial_num
+        trial_fn(args, p_trial_num)
+
+        # Publish the result with a rename, so readers never see a
+        # partially copied file.
+        dst_file = os.path.join(queue_results_dir,
+                                'all_results_%03d.csv' % p_trial_num)
+        shutil.copyfile(os.path.join(args.results_dir, 'all_results.csv'),
+                        dst_file + '.tmp')
+        os.rename(dst_file + '.tmp', dst_file)
+
+    completed = job_queue.run_worker(queue, work, worker_id=args.worker_id)
+    logger.info('This worker completed %d p-value trials' % len(completed))
+
+    if args.p_coordinator:
+        queue.wait_until_finished()
+        logger.info('All %d p-value trials done' % args.p_samples)
+
+
+def collect_null_obs_freq(null_hypo_files):
+    '''
+    Pool the obs_freq values of every <SNP, label> pair across the
+    null-hypothesis files.  SNPs that never showed up in a trial are
+    suppressed in "all_results.csv", so we add those zero counts back in.
+
+    Returns (all_q, num_SNPs), where all_q[fdr][label] is a sorted array of
+    obs_freq samples and num_SNPs is the number of distinct SNPs seen.
+    '''
+    fdr_mode_list = ['mFDR', 'cFDR']
+    df_list = [pd.read_csv(f) for f in null_hypo_files]
+    label_list = set()
+    for df in df_list:
+        label_list.update(df.label.values)
+
+    # First, extract all obs_freq
+    SNP_dict = {}
+    q_dict = {}
+    for fdr in fdr_mode_list:
+        q_dict[fdr] = {}
+        for label in label_list:
+            q_dict[fdr][label] = {}
+    for df in df_list:
+        for i in xrange(len(df)):
+            fdr = df.fdr_type.values[i]
+            label = df.label.values[i]
+            SNP = df.SNP.values[i]
+            if SNP not in q_dict[fdr][label]:
+                q_dict[fdr][label][SNP] = []
+                SNP_dict[SNP] = True
+            q_dict[fdr][label][SNP].append(
+                df.obs_freq.values[i])
+    for fdr in fdr_mode_list:
+        for label in label_list:
+            for SNP in SNP_dict:
+                if SNP not in q_dict[fdr][label]:
+                    q_dict[fdr][label][SNP] = []
+    # Second, add back in zero counts, which had been suppressed
+    all_q = {}
+    for fdr in fdr_mode_list:
+        all_q[fdr] = {}
+        for label in label_list:
+            all_q[fdr][label] = []
+            for SNP in SNP_dict:
+                extra = len(null_hypo_files) - len(q_dict[fdr][label][SNP])
+                for i in xrange(extra):
+                    q_dict[fdr][label][SNP].append(0.0)
+                all_q[fdr][label] += q_dict[fdr][label][SNP]
+            all_q[fdr][label] = np.sort(all_q[fdr][label])
+    return(all_q, len(SNP_dict))
+
+
+def computed_tail_p_value(null_q, num_SNPs, q):
+    '''
+    "Computed tail" p-value: probability that the maximum of num_SNPs draws
+    from the (sorted) null obs_freq samples null_q is at least q.
+    '''
+    x = null_q
+    y = np.linspace(0, 1, len(x))
+    yy = 1.0 - np.power(y, num_SNPs)
+    ii = np.searchsorted(x, q)
+    if ii < len(yy):
+        # Typical case:
+        return(yy[ii])
+    else:
+        # If causal value exceeds maximum observed null hypothesis
+        # (which is a good case)
+        return(0.0)
+
+
+def computed_tail_p_interval(null_q, num_SNPs, num_trials, q, confidence):
+    '''
+    Confidence interval for computed_tail_p_value().  The null CDF at q is
+    estimated as a proportion of the pooled samples, so we take a
+    Clopper-Pearson interval for it and push both ends through the
+    "max of num_SNPs draws" transform.
+
+    The pooled samples are not independent: the SNPs of one null trial all
+    come from the same permutation of the labels.  So the interval is
+    computed as if the proportion had been observed on num_trials
+    independent samples (the null trials), not on all len(null_q) of them.
+    This is conservative, which keeps the sequential stopping rule from
+    stopping too soon.
+    '''
+    from scipy.stats import beta
+
+    n = float(num_trials)
+    # Number of the n effective samples below q (not necessarily whole).
+    k = n * np.searchsorted(null_q, q) / len(null_q)
+    alpha = 1.0 - confidence
+    if k == 0:
+        cdf_low = 0.0
+    else:
+        cdf_low = beta.ppf(alpha / 2, k, n - k + 1)
+    if k == n:
+        cdf_high = 1.0
+    else:
+        cdf_high = beta.ppf(1.0 - alpha / 2, k + 1, n - k)
+    return(1.0 - np.power(cdf_high, num_SNPs),
+           1.0 - np.power(cdf_low, num_SNPs))
+
+
+def p_values_resolved(args, num_trials):
+    '''
+    Sequential Monte Carlo stopping rule (in the spirit of Besag and
+    Clifford 1991) for the p-value trials run on this machine.
+
+    After num_trials null-hypothesis trials, compute a confidence interval
+    for the computed-tail p-value of every reported <SNP, label> pair (i.e.,
+    those in "sig_max.csv" and "sig_results.csv").  Once every interval lies
+    entirely above or entirely below --p_thresh, more trials cannot change
+    which side of the threshold a reported p-value falls on, so we can stop.
+    '''
+    if num_trials < args.p_min_samples:
+        return(False)
+
+    null_hypo_files = [os.path.join(args.working_dir,
+                                    'results_%03d' % (p_trial_num),
+                                    'all_results.csv')
+                       for p_trial_num in xrange(num_trials)]
+    null_hypo_files = [f for f in null_hypo_files if os.path.exists(f)]
+    if len(null_hypo_files) == 0:
+        return(False)
+    (all_q, num_SNPs) = collect_null_obs_freq(null_hypo_files)
+
+    num_reported = 0
+    num_unresolved = 0
+    for f in ['sig_max', 'sig_results']:
+        filename = os.path.join(args.original_results_dir, "%s.csv" % (f))
+        if not os.path.exists(filename):
+            logger.info('Sequential p-values: cannot find %s; continuing '
+                        'with fixed number of trials.' % filename)
+            return(False)
+        df = pd.read_csv(filename)
+        for i in xrange(len(df)):
+            fdr = df.fdr_type.values[i]
+            label = df.label.values[i]
+            num_reported += 1
+            if label not in all_q[fdr]:
+                num_unresolved += 1
+                continue
+            (p_low, p_high) = computed_tail_p_interval(
+                all_q[fdr][label], num_SNPs, len(null_hypo_files),
+                df.obs_freq.values[i], args.p_confidence)
+            if p_low <= args.p_thresh <= p_high:
+                num_unresolved += 1
+
+    logger.info('Sequential p-values: %d of %d reported p-values unresolved '
+                'at p=%.2f after %d trials' % (
+                    num_unresolved, num_reported, args.p_thresh,
+                    len(null_hypo_files)))
+    return(num_unresolved == 0)
+
+
 def extract_null_distribution(args):
     if args.skip_p_value_accumulation:
         return
+    if args.p_queue_dir is not None and not args.p_coordinator:
+        # Only the coordinator accumulates results from the job queue.
+        return
 
     p_dir = os.path.join(args.working_dir, 'p_values')
     utils.safe_mkdir(p_dir)
@@ -186,14 +397,36 @@ def extract_null_distribution(args):
         utils.download_prefix_from_gcloud(bucket_name=args.bucket_name,
                                           prefix='p_values/all_results_%d_' % (
                                               args.original_random_seed),
-                                          destination_dir=p_dir)
+                                          destination_dir=p_dir,
+                                          num_threads=args.transfer_threads)
         utils.download_prefix_from_gcloud(bucket_name=args.bucket_name,
                                           prefix='causal_%d/' % (
                                               args.original_random_seed),
-                                          destination_dir=args.original_results_dir)
+                                          destination_dir=args.original_results_dir,
+                                          num_threads=args.transfer_threads)
     elif args.download_aws:
-        logger.info('AWS S3 download not implemented.')
-        pass
+        logger.info('Downloading p-values from AWS S3.')
+
+        utils.download_prefix_from_aws(bucket_name=args.bucket_name,
+                                       prefix='p_values/all_results_%d_' % (
+                                           args.original_random_seed),
+                                       destination_dir=p_dir,
+                                       num_threads=args.transfer_threads)
+        utils.download_prefix_from_aws(bucket_name=args.bucket_name,
+                                       prefix='causal_%d/' % (
+                                           args.original_random_seed),
+                                       destination_dir=args.original_results_dir,
+                                       num_threads=args.transfer_threads)
+    elif args.p_queue_dir is not None:
+        # Collect results published by all workers on the job queue
+        queue_results_dir = os.path.join(args.p_queue_dir, 'results')
+        for f in os.listdir(queue_results_dir):
+            if not (f.startswith('all_results_') and f.endswith('.csv')):
+                continue
+            p_trial_num = int(f[len('all_results_'):-len('.csv')])
+            shutil.copyfile(os.path.join(queue_results_dir, f),
+                            os.path.join(p_dir, 'all_results_%d_%d_%03d.csv' % (
+                                args.original_random_seed, 0, p_trial_num)))
     else:
         # Just use local files
         for p_trial_num in xrange(args.p_samples):
@@ -261,41 +494,8 @@ def extract_null_distribution(args):
         logger.info("   %s : %.1f%%" % (label, v))
 
     # Extract all obs_freq ("q" = "obs_freq")
-    # First, extract all obs_freq
-    fdr_mode_list = ['mFDR', 'cFDR']
-    SNP_dict = {}
-    q_dict = {}
-    for fdr in fdr_mode_list:
-        q_dict[fdr] = {}
-        for label in label_list:
-            q_dict[fdr][label] = {}
-    for f in null_hypo_files:
-        df = pd.read_csv(os.path.join(p_dir, f))
-        for i in xrange(len(df)):
-            fdr = df.fdr_type.values[i]
-            label = df.label.values[i]
-            SNP = df.SNP.values[i]
-            if SNP not in q_dict[fdr][label]:
-                q_dict[fdr][label][SNP] = []
-                SNP_dict[SNP] = True
-            q_dict[fdr][label][SNP].append(
-                df.obs_freq.values[i])
-    for fdr in fdr_mode_list:
-        for label in label_list:
-            for SNP in SNP_dict:
-                if SNP not in q_dict[fdr][label]:
-                    q_dict[fdr][label][SNP] = []
-    # Second, add back in zero counts, which had been suppressed
-    all_q = {}
-    for fdr in fdr_mode_list:
-        all_q[fdr] = {}
-        for label in label_list:
-            all_q[fdr][label] = []
-            for SNP in SNP_dict:
-                extra = len(null_hypo_files) - len(q_dict[fdr][label][SNP])
-                for i in xrange(extra):
-                    q_dict[fdr][label][SNP].append(0.0)
-                all_q[fdr][label] += q_dict[fdr][label][SNP]
+    (all_q, num_SNPs) = collect_null_obs_freq(
+        [os.path.join(p_dir, f) for f in null_hypo_files])
 
     # If "sig_max.csv" or "sig_results.csv" files are present, add p-values
     for f in ['sig_max', 'sig_results']:
@@ -309,21 +509,9 @@ def extract_null_distribution(args):
         for i in xrange(len(df)):
             fdr = df.fdr_type.values[i]
             label = df.label.values[i]
-            SNP = df.SNP.values[i]
             q = df.obs_freq.values[i]
-            x = np.sort(all_q[fdr][label])
-            y = np.linspace(0, 1, len(x))
-            yy = 1.0 - np.power(y, len(SNP_dict))
-            ii = np.searchsorted(x, q)
-            if ii < len(yy):
-                # Typical case:
-                p = yy[ii]
-            else:
-                # If causal value exceeds maximum observed null hypothesis
-                # (which is a good case)
-                p = 0.0
-
-            df['p_value_for_obs_freq'].values[i] = p
+            df['p_value_for_obs_freq'].values[i] = computed_tail_p_value(
+                all_q[fdr][label], num_SNPs, q)
         try:
             df.to_csv(filename, index=False)
         except Exception:
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Genotypes packed two bits each, four people to a byte, as in PLINK's .bed
+# format.
+#
+# A genotype here is a non-wild-type allele count (0, 1 or 2; see
+# utils.genotype_to_nonwild_type_count()) or missing (-1).  A packed matrix
+# is a uint8 array of shape (SNPs x ceil(people / 4)): each row holds one
+# SNP, with the first person of each byte in its lowest two bits.  The codes
+# are PLINK's, reading the non-wild-type allele as PLINK's first allele:
+#     0b00  2 (homozygous non-wild-type)
+#     0b01  missing
+#     0b10  1 (heterozygous)
+#     0b11  0 (homozygous wild type)
+# The unused cells of a row's last byte hold the missing code, so they drop
+# out of every count.
+#
+# A packed matrix takes 1/4 of the memory of int8 allele counts (and 1/32 of
+# float64).  Per-SNP allele counts and the carrier counts of contingency
+# tables are computed directly on the bytes, by popcount-style table
+# lookups, without unpacking.  Saved with np.save(), a packed matrix can be
+# memory-mapped and unpacked a block of SNPs at a time.
+#
+# Usage:
+#     packed = packed_genotypes.pack(X)
+#     X = packed_genotypes.unpack(packed[SNP_rows], num_people)
+#     (carriers, called) = packed_genotypes.carrier_counts(packed, people_mask)
+#     counts = packed_genotypes.genotype_counts(packed, people_mask)
+
+import numpy as np
+
+MISSING = -1
+
+# 2-bit code of each allele count (indexed by count + 1, so missing first),
+# and the allele count of each code.
+CODE = np.array([0b01, 0b11, 0b10, 0b00], dtype=np.uint8)
+COUNT = np.array([2, MISSING, 1, 0], dtype=np.int8)
+
+# The low bit of every 2-bit cell of a byte.
+LOW_BITS = 0x55
+
+# For each possible byte: its four allele counts, the sum of its called
+# allele counts, its number of called genotypes, and its number of set bits.
+BYTE_COUNTS = np.array([[COUNT[(b >> (2 * k)) & 3] for k in range(4)]
+                        for b in range(256)], dtype=np.int8)
+BYTE_ALLELES = np.where(BYTE_COUNTS == MISSING, 0, BYTE_COUNTS).sum(axis=1).astype(np.uint8)
+BYTE_CALLED = (BYTE_COUNTS != MISSING).sum(axis=1).astype(np.uint8)
+POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+
+def packed_width(num_people):
+    '''
+    Bytes per SNP of a packed matrix of num_people people.
+    '''
+    return((num_people + 3) // 4)
+
+
+def pack(X):
+    '''
+    Pack allele counts X (people x SNPs; 0, 1, 2 or -1 for missing) into a
+    packed matrix (SNPs x packed_width(people)).
+    '''
+    X = np.asarray(X)
+    (num_people, num_SNPs) = X.shape
+    codes = np.full((num_SNPs, 4 * packed_width(num_people)), CODE[0], dtype=np.uint8)
+    codes[:, :num_people] = CODE[X.T.astype(np.intp) + 1]
+    codes = codes.reshape(num_SNPs, -1, 4)
+    return(codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) |
+           (codes[:, :, 3] << 6))
+
+
+def unpack(packed, num_people, dtype=np.int8):
+    '''
+    Allele counts (people x SNPs) of a packed matrix, or of a block of its
+    rows, as dtype.  Missing genotypes are -1.
+    '''
+    packed = np.asarray(packed)
+    X = BYTE_COUNTS[packed].reshape(packed.shape[0], -1)[:, :num_people]
+    return(X.T.astype(dtype))
+
+
+def allele_counts(packed):
+    '''
+    For each SNP of a packed matrix: the number of non-wild-type alleles and
+    the number of called (not missing) genotypes.
+    '''
+    packed = np.asarray(packed)
+    return(BYTE_ALLELES[packed].sum(axis=1, dtype=np.int64),
+           BYTE_CALLED[packed].sum(axis=1, dtype=np.int64))
+
+
+def people_mask(people):
+    '''
+    Pack a boolean vector over people into the low bits of each person's
+    cell, for carrier_counts() and genotype_counts().
+    '''
+    people = np.asarray(people, dtype=bool)
+    mask = np.zeros(4 * packed_width(len(people)), dtype=np.uint8)
+    mask[:len(people)] = people
+    mask = mask.reshape(-1, 4)
+    return(mask[:, 0] | (mask[:, 1] << 2) | (mask[:, 2] << 4) | (mask[:, 3] << 6))
+
+
+def carrier_counts(packed, people):
+    '''
+    For each SNP of a packed matrix, among the people selected by the boolean
+    vector "people": the number of carriers (allele count 1 or 2) and the
+    number of called genotypes.  These are the columns of a 2x2 contingency
+    table of carrier status against membership in the group.
+    '''
+    packed = np.asarray(packed)
+    mask = people_mask(people)
+    # A cell is a carrier if its low bit is clear (codes 0b00 and 0b10), and
+    # called unless it is 0b01.
+    carrier_bits = ~packed & LOW_BITS & mask
+    called_bits = (~packed | (packed >> 1)) & LOW_BITS & mask
+    return(POPCOUNT[carrier_bits].sum(axis=1, dtype=np.int64),
+           POPCOUNT[called_bits].sum(axis=1, dtype=np.int64))
+
+
+def genotype_counts(packed, people):
+    '''
+    For each SNP of a packed matrix, the number of the people selected by the
+    boolean vector "people" with allele count 0, 1 and 2; shape (SNPs x 3).
+    Missing genotypes are not counted.
+    '''
+    packed = np.asarray(packed)
+    mask = people_mask(people)
+    high = packed >> 1
+    counts = np.empty((packed.shape[0], 3), dtype=np.int64)
+    for (count, bits) in [(0, packed & high), (1, ~packed & high), (2, ~packed & ~high)]:
+        counts[:, count] = POPCOUNT[bits & LOW_BITS & mask].sum(axis=1, dtype=np.int64)
+    return(counts)
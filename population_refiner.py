@@ -3,6 +3,8 @@
 import cPickle as pickle
 import os
 import utils_snpko as utils
+import run_report
+import genotype_store
 import numpy as np
 
 logger = utils.logger
@@ -20,6 +22,10 @@ def refine(args):
     logger.info("####################################")
     logger.info("Balancing SNP coverage with population size.")
 
+    if args.streaming:
+        refine_streaming(args)
+        return
+
     ensembl_filename = os.path.join(args.working_dir, 'ensembl.pkl')
     genotypes = pickle.load(open(ensembl_filename, "rb"))
 
@@ -33,6 +39,7 @@ def refine(args):
                 person_count[person] = 0
             person_count[person] += 1
     logger.info("Initial number of people: %d" % (len(person_count)))
+    run_report.add_counts(SNPs=len(SNP_list), people=len(person_count))
 
     # We are
     #   (1) going to grab a swathe of population with many SNPs (i.e., restrict
@@ -98,6 +105,61 @@ def refine(args):
     f.close()
 
 
+def refine_streaming(args):
+    '''
+    refine() for --streaming: the same trade-off, computed a chunk of SNPs at
+    a time from ensembl_store/ (see genotype_store.py).  Writes the chosen
+    people and SNPs to genotypes_ensembl_store/.
+    '''
+    store = genotype_store.Store(os.path.join(args.working_dir, 'ensembl_store'))
+    SNP_list = store.SNPs
+    logger.info("Initial number of SNPs: %d" % (len(SNP_list)))
+
+    # Number of SNPs that each person has a genotype for.
+    person_count = np.zeros(len(store.people), dtype=int)
+    for (SNPs, X) in store.chunks():
+        person_count += (X != genotype_store.MISSING).sum(axis=1)
+    logger.info("Initial number of people: %d" % (len(store.people)))
+    run_report.add_counts(SNPs=len(SNP_list), people=len(store.people))
+
+    # The population of pareto_point(c) in refine() is the people with
+    # person_count >= c, and a SNP is kept if none of them is missing it.  So
+    # a SNP is kept iff c is greater than the largest person_count of the
+    # people missing it.
+    max_missing_count = np.zeros(len(SNP_list), dtype=int)
+    start = 0
+    for (SNPs, X) in store.chunks():
+        if len(store.people) > 0:
+            max_missing_count[start:start + len(SNPs)] = np.where(
+                X == genotype_store.MISSING, person_count[:, np.newaxis], 0).max(axis=0)
+        start += len(SNPs)
+
+    # Find best compromise between population size and SNP size
+    best_score = -np.inf
+    best_c = None
+    for c in sorted(set(person_count.tolist())):
+        pop_size = np.sum(person_count >= c)
+        snp_size = np.sum(max_missing_count < c)
+        score = (1.0 * pop_size / len(store.people) +
+                 (args.snp_weight) * snp_size / len(SNP_list))
+        if score > best_score:
+            best_score = score
+            best_c = c
+
+    population = np.flatnonzero(person_count >= best_c)
+    proposed_SNP_list = [SNP for (SNP, m) in zip(SNP_list, max_missing_count) if m < best_c]
+    logger.info("Pareto-optimal point: score=%.3f, c=%d, |pop|=%d, |SNPs|=%d" % (
+        best_score, best_c, len(population), len(proposed_SNP_list)))
+
+    logger.info("Missing SNPs:")
+    for (SNP, m) in zip(SNP_list, max_missing_count):
+        if m >= best_c:
+            logger.info("   %s" % SNP)
+
+    store.copy_columns(os.path.join(args.working_dir, 'genotypes_ensembl_store'),
+                       proposed_SNP_list, args.memory_budget_mb, rows=population)
+
+
 if __name__ == '__main__':
     args = utils.parse_arguments()
     utils.safe_mkdir(args.working_dir)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Machine-readable profile of a run: for each pipeline stage, wall time, CPU
+# time, peak resident memory, and item counts (SNPs, subjects, fits, ...) with
+# the corresponding throughput; and for the parallel (joblib) sections, the
+# duration of every task on every worker.
+#
+# Usage:
+#     with run_report.stage('prune'):
+#         ...
+#         run_report.add_counts(SNPs=123)
+#     results = run_report.record_tasks('make_knockoff', Parallel(...)(
+#         delayed(run_report.timed_call)(make_knockoff, ...) for ...))
+#     run_report.write_report(args)
+#
+# The report is written to "run_report.json" (everything) plus
+# "run_report_stages.csv" and "run_report_tasks.csv" in the results directory.
+
+import json
+import os
+import resource
+import socket
+import sys
+import time
+import pandas as pd
+import utils_snpko as utils
+
+logger = utils.logger
+
+_stage_records = []
+_task_records = []
+_stage_stack = []
+
+
+def _cpu_seconds():
+    '''
+    CPU time (user + system) of this process and its reaped children.
+    '''
+    t = os.times()
+    return(t[0] + t[1] + t[2] + t[3])
+
+
+def _reset_peak_rss():
+    '''
+    On Linux, reset this process's high-water mark of resident memory, so
+    that each stage's peak can be measured separately.  Returns True on
+    success.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return(True)
+    except (IOError, OSError):
+        return(False)
+
+
+def _peak_rss_mb():
+    '''
+    High-water mark of this process's resident memory, in MB.
+    '''
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1024.0)
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kB on Linux but bytes on OS X.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return(maxrss / (1024.0 * 1024.0))
+    return(maxrss / 1024.0)
+
+
+def _children_peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        return(maxrss / (1024.0 * 1024.0))
+    return(maxrss / 1024.0)
+
+
+class stage(object):
+    '''
+    Context manager recording the cost of one stage.  Stages may nest (e.g.,
+    the classifier inside a p-value trial); each gets its own record.
+    '''
+
+    def __init__(self, name, **counts):
+        self.record = {'stage': name, 'counts': dict(counts)}
+
+    def __enter__(self):
+        if len(_stage_stack) > 0:
+            # Resetting the high-water mark would lose the enclosing stage's
+            # peak so far; save it first.
+            parent = _stage_stack[-1]
+            parent['_peak_rss_mb'] = max(parent.get('_peak_rss_mb', 0.0),
+                                         _peak_rss_mb())
+        self.peak_reset = _reset_peak_rss()
+        self.start_wall = time.time()
+        self.start_cpu = _cpu_seconds()
+        self.start_tasks = len(_task_records)
+        _stage_stack.append(self.record)
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _stage_stack.pop()
+        record = self.record
+        record['start_time'] = self.start_wall
+        record['wall_seconds'] = time.time() - self.start_wall
+        record['cpu_seconds'] = _cpu_seconds() - self.start_cpu
+        record['peak_rss_mb'] = max(_peak_rss_mb(),
+                                    record.pop('_peak_rss_mb', 0.0))
+        # Without a reset, the high-water mark covers the whole process so
+        # far, not just this stage.
+        record['peak_rss_is_per_stage'] = self.peak_reset
+        record['children_peak_rss_mb'] = _children_peak_rss_mb()
+        tasks = _task_records[self.start_tasks:]
+        record['num_tasks'] = len(tasks)
+        record['worker_cpu_seconds'] = sum(t['cpu_seconds'] for t in tasks)
+        record['num_workers_used'] = len(set(t['pid'] for t in tasks))
+        record['failed'] = exc_type is not None
+        if record['wall_seconds'] > 0:
+            record['per_second'] = dict(
+                (k, v / record['wall_seconds']) for k, v in record['counts'].items())
+        else:
+            record['per_second'] = {}
+        _stage_records.append(record)
+        logger.info('Stage %s: %.1fs wall, %.1fs CPU (+%.1fs in workers), '
+                    'peak RSS %.0f MB%s' % (
+                        record['stage'], record['wall_seconds'],
+                        record['cpu_seconds'], record['worker_cpu_seconds'],
+                        record['peak_rss_mb'],
+                        ''.join(', %s=%s' % (k, v)
+                                for k, v in sorted(record['counts'].items()))))
+        return(False)
+
+
+def add_counts(**counts):
+    '''
+    Add item counts (e.g., SNPs=100, subjects=500) to the innermost running
+    stage.  Does nothing outside of a stage.
+    '''
+    if len(_stage_stack) == 0:
+        return
+    stage_counts = _stage_stack[-1]['counts']
+    for k, v in counts.items():
+        stage_counts[k] = stage_counts.get(k, 0) + v
+
+
+def timed_call(function, *args, **kwargs):
+    '''
+    Call function(*args, **kwargs) and return (result, timing).  Meant to be
+    run inside a joblib worker, e.g.
+        delayed(run_report.timed_call)(make_knockoff, chromosome=1, ...)
+    '''
+    start_wall = time.time()
+    t = os.times()
+    start_cpu = t[0] + t[1]
+    result = function(*args, **kwargs)
+    t = os.times()
+    timing = {'function': function.__name__,
+              'host': socket.gethostname(),
+              'pid': os.getpid(),
+              'start_time': start_wall,
+              'wall_seconds': time.time() - start_wall,
+              'cpu_seconds': t[0] + t[1] - start_cpu}
+    return(result, timing)
+
+
+def record_tasks(section, timed_results):
+    '''
+    Record the timings from a list of timed_call() results; return the list
+    of bare results.
+    '''
+    results = []
+    stage_name = _stage_stack[-1]['stage'] if _stage_stack else None
+    for (result, timing) in timed_results:
+        timing = dict(timing)
+        timing['section'] = section
+        timing['stage'] = stage_name
+        _task_records.append(timing)
+        results.append(result)
+    return(results)
+
+
+def write_report(args):
+    '''
+    Write the run report to the (original) results directory.
+    '''
+    results_dir = args.original_results_dir
+    utils.safe_mkdir(results_dir)
+
+    task_summary = {}
+    for t in _task_records:
+        s = task_summary.setdefault(t['section'], {
+            'num_tasks': 0, 'wall_seconds': [], 'workers': set()})
+        s['num_tasks'] += 1
+        s['wall_seconds'].append(t['wall_seconds'])
+        s['workers'].add((t['host'], t['pid']))
+    for section, s in task_summary.items():
+        durations = sorted(s['wall_seconds'])
+        task_summary[section] = {
+            'num_tasks': s['num_tasks'],
+            'num_workers': len(s['workers']),
+            'total_seconds': sum(durations),
+            'mean_seconds': sum(durations) / len(durations),
+            'median_seconds': durations[len(durations) // 2],
+            'max_seconds': durations[-1]}
+
+    report = {'command_line': ' '.join(sys.argv),
+              'host': socket.gethostname(),
+              'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN'),
+              'stages': _stage_records,
+              'task_summary': task_summary}
+    with open(os.path.join(results_dir, 'run_report.json'), 'w') as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+
+    rows = []
+    for record in _stage_records:
+        row = dict((k, v) for k, v in record.items()
+                   if k not in ['counts', 'per_second'])
+        for k, v in record['counts'].items():
+            row['count_%s' % k] = v
+        for k, v in record['per_second'].items():
+            row['%s_per_second' % k] = v
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(os.path.join(results_dir, 'run_report_stages.csv'),
+                              index=False)
+    pd.DataFrame(_task_records).to_csv(
+        os.path.join(results_dir, 'run_report_tasks.csv'), index=False)
+    logger.info('Run report written to %s' % os.path.join(results_dir, 'run_report.json'))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Optional screening of the pruned loci before the knockoff stages.
+#
+# Every pruned locus gets an HMM and two features (itself and its knockoff)
+# in every classifier fit, but most loci have no univariate association with
+# any label.  With --screen_p_value and/or --screen_min_variance, this stage
+# keeps only the loci that
+#   * have a p-value (of the --screen_test test in results/association.csv;
+#     see simple_stats.py) of at most --screen_p_value for some label, and
+#   * have an allele count variance of at least --screen_min_variance among
+#     the experimental subjects.
+# The kept loci are written to screened_experiment.csv, screened_ensembl.csv
+# (screened_ensembl_store with --streaming) and screened_SNP_facts.csv, which
+# the knockoff and classifier stages then read instead of the pruned_* files
+# (see utils.knockoff_input_file()).
+#
+# Screening on the same subjects as the knockoff analysis uses their labels
+# twice, so the knockoff FDR control no longer strictly holds.  With
+# --screen_split, a random fraction of the subjects is used only for the
+# screening p-values, and is left out of the knockoff analysis, which keeps
+# the guarantee.  (The variance filter does not look at the labels, so it
+# needs no split.)
+
+import numpy as np
+import os
+import pandas as pd
+import utils_snpko as utils
+import run_report
+import genotype_store
+import packed_genotypes
+import simple_stats
+
+logger = utils.logger
+
+SCREEN_TESTS = ['fisher', 'allelic', 'trend', 'genotypic']
+
+
+def screening_p_values(args, df, SNPs, label_fields):
+    '''
+    The smallest --screen_test p-value over the labels of each of SNPs,
+    computed from the subjects in df.
+    '''
+    df_wild = pd.read_csv(os.path.join(args.working_dir, 'wild_types.csv'))
+    SNP_to_wild_type = dict(zip(df_wild['SNP'].values, df_wild['wild_type'].values))
+    packed = packed_genotypes.pack(utils.genotype_count_matrix(df, SNPs, SNP_to_wild_type))
+    label_array = np.array(df[label_fields], dtype=float).reshape(len(df), len(label_fields))
+    results = simple_stats.association_tests(args, packed, label_array)
+    return(results['%s_p_value' % args.screen_test].min(axis=0))
+
+
+def screen(args):
+    '''
+    Keep the pruned loci that pass the screening filters; see above.
+    '''
+    if not utils.screening_loci(args):
+        logger.info('No screening of loci (see "--screen_p_value" and '
+                    '"--screen_min_variance").')
+        return
+
+    logger.info("####################################")
+    logger.info('Screening loci before knockoffs.')
+    if args.screen_split > 0 and args.screen_p_value is None:
+        logger.info('"--screen_split" needs "--screen_p_value"')
+        raise Exception
+    if not (0 <= args.screen_split < 1):
+        logger.info('"--screen_split" must be in [0, 1)')
+        raise Exception
+
+    df = pd.read_csv(os.path.join(args.working_dir, 'pruned_experiment.csv'))
+    SNPs = [field for field in df.columns if field.startswith('rs')]
+    label_fields = [field for field in df.columns if field.startswith(args.data_prefix)]
+    keep = np.ones(len(SNPs), dtype=bool)
+
+    if args.screen_split > 0:
+        # The screening subjects are chosen with the original seed, so that
+        # every machine (see --machine_num) makes the same split.
+        rng = np.random.RandomState(args.original_random_seed)
+        screening = np.zeros(len(df), dtype=bool)
+        screening[rng.permutation(len(df))[:int(round(args.screen_split * len(df)))]] = True
+        logger.info('Using %d of %d subjects for screening only' % (
+            np.sum(screening), len(df)))
+        p_values = screening_p_values(args, df[screening], SNPs, label_fields)
+        df = df[~screening]
+    elif args.screen_p_value is not None:
+        logger.warn('Screening with "--screen_p_value" on the same subjects as the knockoff '
+                    'analysis (no "--screen_split"): the selections are no longer guaranteed '
+                    'to control the FDR at --fdr.')
+        df_association = pd.read_csv(os.path.join(args.working_dir, 'results',
+                                                  'association.csv'))
+        p_values = df_association.groupby('SNP')['%s_p_value' % args.screen_test].min()
+        p_values = p_values.reindex(SNPs).fillna(1.0).values
+    if args.screen_p_value is not None:
+        keep &= (p_values <= args.screen_p_value)
+        logger.info('%d of %d loci have a %s p-value <= %g' % (
+            np.sum(p_values <= args.screen_p_value), len(SNPs), args.screen_test,
+            args.screen_p_value))
+
+    if args.screen_min_variance is not None:
+        df_wild = pd.read_csv(os.path.join(args.working_dir, 'wild_types.csv'))
+        SNP_to_wild_type = dict(zip(df_wild['SNP'].values, df_wild['wild_type'].values))
+        variance = utils.genotype_count_matrix(df, SNPs, SNP_to_wild_type).var(axis=0)
+        keep &= (variance >= args.screen_min_variance)
+        logger.info('%d of %d loci have allele count variance >= %g' % (
+            np.sum(variance >= args.screen_min_variance), len(SNPs),
+            args.screen_min_variance))
+
+    kept_SNPs = [SNP for (SNP, k) in zip(SNPs, keep) if k]
+    if len(kept_SNPs) == 0:
+        logger.info('No loci pass the screening filters!')
+        raise Exception
+    logger.info('Screening kept %d of %d loci (%.1f%%) and %d subjects; the classifier '
+                'will see %d features instead of %d' % (
+                    len(kept_SNPs), len(SNPs), 100.0 * len(kept_SNPs) / len(SNPs), len(df),
+                    2 * len(kept_SNPs), 2 * len(SNPs)))
+    run_report.add_counts(loci=len(SNPs), screened_loci=len(kept_SNPs), subjects=len(df))
+
+    df[kept_SNPs + label_fields].to_csv(
+        utils.knockoff_input_file(args, 'experiment.csv'), index=False)
+    if args.streaming:
+        ensembl_store = genotype_store.Store(os.path.join(
+            args.working_dir, 'pruned_ensembl_store'))
+        ensembl_store.copy_columns(utils.knockoff_input_file(args, 'ensembl_store'),
+                                   kept_SNPs, args.memory_budget_mb)
+    else:
+        df_ensembl = pd.read_csv(os.path.join(args.working_dir, 'pruned_ensembl.csv'))
+        df_ensembl[kept_SNPs].to_csv(utils.knockoff_input_file(args, 'ensembl.csv'),
+                                     index=False)
+    df_SNP = pd.read_csv(os.path.join(args.working_dir, 'pruned_SNP_facts.csv'))
+    df_SNP[df_SNP['SNP'].isin(kept_SNPs)].to_csv(
+        utils.knockoff_input_file(args, 'SNP_facts.csv'), index=False)
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    utils.initialize_logger(args)
+    screen(args)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# The classifier's per-trial selections, stored as a table with one row per
+# (knockoff trial, label, FDR type, SNP): the SNP's W statistic in that trial
+# and whether it was selected at the target FDR.  The table is kept column by
+# column in a .npz file; labels, FDR types and SNPs are stored as indices
+# into arrays of their names.  sig_results reads it directly, and the
+# human-readable knockoff_trials.txt is only written on request.
+#
+# The W statistics are also saved on their own as a float32 array of shape
+# (labels, trials, SNPs), so that selections at another target FDR can be
+# recomputed without refitting the classifier (see sig_results.rethreshold()).
+
+import datetime
+import numpy as np
+import pandas as pd
+
+FILENAME = 'knockoff_selections.npz'
+REPORT_FILENAME = 'knockoff_trials.txt'
+W_FILENAME = 'W_statistics.npy'
+FDR_TYPES = ['mFDR', 'cFDR']
+
+
+def knockoff_thresholds(W, fdr):
+    '''
+    Thresholds (tau_mFDR, tau_cFDR) on the W statistics for the target fdr,
+    per Equation 3.11 of Candes et al 2017: the classical FDR adds 1 to the
+    count of negative W statistics, the modified FDR does not.  A SNP is
+    selected if its W is at least the threshold (np.inf selects none).
+    '''
+    W = np.asarray(W, dtype=float)
+    sorted_W = np.sort(W)
+    # For each W, the number of statistics <= -W and >= W.
+    num_below = np.searchsorted(sorted_W, -W, side='right')
+    num_above = len(W) - np.searchsorted(sorted_W, W, side='left')
+
+    tau_mFDR = np.inf  # Modified FDR
+    tau_cFDR = np.inf  # Classical FDR
+    for k in np.flatnonzero(W > 0):
+        if W[k] >= tau_mFDR and W[k] >= tau_cFDR:
+            continue
+        if 1.0 * num_below[k] / num_above[k] < fdr:
+            tau_mFDR = W[k]
+        if 1.0 * (1 + num_below[k]) / num_above[k] < fdr:
+            tau_cFDR = W[k]
+    return(tau_mFDR, tau_cFDR)
+
+
+def saved_W(W):
+    '''
+    W statistics rounded to float32, as write_W_statistics() saves them (but
+    as float64).  Thresholding these rather than the raw statistics means the
+    selections recomputed from the saved array at the same FDR are exactly
+    the stored ones.
+    '''
+    return(np.asarray(W, dtype=np.float32).astype(float))
+
+
+def rethreshold(table, W_all, fdr):
+    '''
+    The results (as for write()) of thresholding, at the target fdr, the W
+    statistics W_all saved by write_W_statistics() with the labels of table.
+    '''
+    results = []
+    trials = np.unique(table['trial'])
+    for (i, one_label_field) in enumerate(table['label_names']):
+        for (t, trial) in enumerate(trials):
+            W = np.asarray(W_all[i, t], dtype=float)
+            (tau_mFDR, tau_cFDR) = knockoff_thresholds(W, fdr)
+            results.append((one_label_field, trial, W, W >= tau_mFDR, W >= tau_cFDR))
+    return(results)
+
+
+def make_table(results, label_fields, SNPs, fdr, num_trials):
+    '''
+    The table (as returned by read()) of single_FDR() results, each (label,
+    trial, W, selected_mFDR, selected_cFDR) with W and the selections given
+    for every SNP in SNPs.
+    '''
+    label_index = dict((label, i) for (i, label) in enumerate(label_fields))
+    num_SNPs = len(SNPs)
+    columns = {'trial': [], 'label': [], 'fdr_type': [], 'SNP': [], 'W': [],
+               'selected': []}
+    for (one_label_field, trial, W, selected_mFDR, selected_cFDR) in results:
+        for (fdr_index, selected) in enumerate([selected_mFDR, selected_cFDR]):
+            columns['trial'].append(np.full(num_SNPs, trial, dtype=np.int32))
+            columns['label'].append(np.full(num_SNPs, label_index[one_label_field],
+                                            dtype=np.int16))
+            columns['fdr_type'].append(np.full(num_SNPs, fdr_index, dtype=np.int8))
+            columns['SNP'].append(np.arange(num_SNPs, dtype=np.int32))
+            columns['W'].append(np.asarray(W, dtype=float))
+            columns['selected'].append(np.asarray(selected, dtype=bool))
+    table = dict((name, np.concatenate(values)) for (name, values) in columns.items())
+    table.update(label_names=np.array(label_fields, dtype='U'),
+                 SNP_names=np.array(SNPs, dtype='U'),
+                 fdr_type_names=np.array(FDR_TYPES, dtype='U'),
+                 fdr=float(fdr), num_trials=int(num_trials))
+    return(table)
+
+
+def write(path, results, label_fields, SNPs, fdr, num_trials):
+    '''
+    Write the table of single_FDR() results (see make_table()).
+    '''
+    table = make_table(results, label_fields, SNPs, fdr, num_trials)
+    table['fdr'] = np.float64(table['fdr'])
+    table['num_trials'] = np.int64(table['num_trials'])
+    # Write through a file object, so that numpy does not append '.npz'.
+    with open(path, 'wb') as fp:
+        np.savez(fp, **table)
+
+
+def write_W_statistics(path, results, label_fields):
+    '''
+    Save the W statistics of single_FDR() results (as for write()) as a
+    float32 array of shape (labels, trials, SNPs), with the labels in the
+    order of label_fields and the trials in increasing order.
+    '''
+    trials = sorted(set(trial for (_, trial, _, _, _) in results))
+    trial_index = dict((trial, t) for (t, trial) in enumerate(trials))
+    label_index = dict((label, i) for (i, label) in enumerate(label_fields))
+    W_all = np.zeros((len(label_fields), len(trials), len(results[0][2])),
+                     dtype=np.float32)
+    for (one_label_field, trial, W, _, _) in results:
+        W_all[label_index[one_label_field], trial_index[trial]] = W
+    np.save(path, W_all)
+
+
+def read_W_statistics(path):
+    '''
+    The array saved by write_W_statistics(), memory-mapped.
+    '''
+    return(np.load(path, mmap_mode='r'))
+
+
+def read(path):
+    '''
+    The table written by write(), as a dict of arrays: the columns trial,
+    label, fdr_type, SNP, W and selected, plus label_names, SNP_names,
+    fdr_type_names, fdr and num_trials.
+    '''
+    with np.load(path) as npz:
+        table = dict((name, npz[name]) for name in npz.files)
+    table['fdr'] = float(table['fdr'])
+    table['num_trials'] = int(table['num_trials'])
+    return(table)
+
+
+def obs_freq(table):
+    '''
+    For every (label, FDR type, SNP) selected in at least one trial, the
+    number of trials that selected it and the fraction obs_freq.  Rows are
+    ordered by label and FDR type, then by decreasing count.
+    '''
+    selected = table['selected']
+    df = pd.DataFrame({'label_index': table['label'][selected],
+                       'fdr_index': table['fdr_type'][selected],
+                       'SNP_index': table['SNP'][selected]})
+    df = df.groupby(['label_index', 'fdr_index', 'SNP_index']).size().reset_index(
+        name='count')
+    df = df.sort_values(by=['label_index', 'fdr_index', 'count', 'SNP_index'],
+                        ascending=[True, True, False, True], kind='mergesort')
+    return(pd.DataFrame({
+        'label': table['label_names'][df.label_index.values],
+        'fdr_type': table['fdr_type_names'][df.fdr_index.values],
+        'SNP': table['SNP_names'][df.SNP_index.values],
+        'count': df['count'].values,
+        'obs_freq': df['count'].values / float(max(1, table['num_trials']))},
+        columns=['label', 'fdr_type', 'SNP', 'count', 'obs_freq']))
+
+
+def write_report(table, path):
+    '''
+    Human-readable summary of the table, with how often each SNP was
+    selected as a (rounded) percentage of trials.
+    '''
+    df = obs_freq(table)
+    with open(path, 'w') as out_fp:
+        out_fp.write(
+            'Using the HMM knockoff framework, and applying the method %d times\n'
+            'with independent knockoff samples, determine which SNPs are significant\n'
+            'predictors of which data labels (i.e., dependent variables).\n\n'
+            'We examine both a classical FDR (cFDR) and a modified FDR (mFDR),\n'
+            'per Candes 2017, Equations 3.10 and 3.11.\n\n' % (
+                table['num_trials']))
+        out_fp.write('Target FDR: %.1f%%\n\n' % (100.0 * table['fdr']))
+        out_fp.write(str(datetime.datetime.now()))
+        out_fp.write('\n')
+        for one_label_field in table['label_names']:
+            out_fp.write('Label: %s\n' % one_label_field)
+            for fdr_type in table['fdr_type_names']:
+                out_fp.write('Type of FDR: %s\n' % fdr_type)
+                rows = df.iloc[(df.label.values == one_label_field) &
+                               (df.fdr_type.values == fdr_type)]
+                if len(rows) == 0:
+                    out_fp.write('  No significant SNPs.\n')
+                for (SNP, percentage) in zip(rows.SNP.values, 100.0 * rows.obs_freq.values):
+                    out_fp.write("   %s : %d%%\n" % (SNP, np.round(percentage)))
@@ -1,59 +1,59 @@
 #!/usr/bin/env python
 
-import numpy as np
 import pandas as pd
 import os
+import copy
+import shutil
 import utils_snpko as utils
+import selection_table
 
 logger = utils.logger
 
 
+def selections(args):
+    '''
+    The classifier's selection table (see selection_table.py) at the target
+    --fdr.  The classifier stores its selections at the --fdr it was run
+    with; for any other target they are recomputed from the stored W
+    statistics, so that changing --fdr only re-runs the summary.
+    '''
+    table = selection_table.read(os.path.join(args.results_dir, selection_table.FILENAME))
+    if table['fdr'] == args.fdr:
+        return(table)
+    W_file = os.path.join(args.results_dir, selection_table.W_FILENAME)
+    if not os.path.exists(W_file):
+        logger.info('Selections are for FDR %g, and there are no W statistics (%s) to '
+                    're-threshold at FDR %g; re-run the classifier.' % (
+                        table['fdr'], W_file, args.fdr))
+        raise Exception
+    logger.info('Re-thresholding the W statistics of FDR %g at FDR %g' % (
+        table['fdr'], args.fdr))
+    results = selection_table.rethreshold(
+        table, selection_table.read_W_statistics(W_file), args.fdr)
+    return(selection_table.make_table(results, table['label_names'], table['SNP_names'],
+                                      args.fdr, table['num_trials']))
+
+
 def parse_knockoff_results(args, df_uncorrected=None):
     if df_uncorrected is None:
         df_uncorrected = pd.read_csv(os.path.join(
             args.results_dir, 'uncorrected.csv'))
 
-    grouped_uncorrected = df_uncorrected.groupby(['SNP', 'label'])
-
-    label = None
-    fdr_type = None
-    SNP = None
-    result_table = []
-    with open(os.path.join(args.results_dir, 'knockoff_trials.txt')) as fp:
-        for line in fp:
-            # chomp:
-            line = line[:-1]
-            if line.startswith('Target FDR: '):
-                # The observed FDR takes precedence over args.fdr
-                fdr = float(line[12:-1]) / 100.0
-            elif line.startswith('Label: '):
-                label = line[7:]
-            elif line.startswith('Type of FDR: '):
-                fdr_type = line[13:]
-            elif line.startswith('   rs'):
-                (SNP, obs_freq) = line[3:].split(' : ')
-                obs_freq = float(obs_freq[:-1]) / 100.0
-
-                index = grouped_uncorrected.groups[(SNP, label)][0]
-                uncorrected_p_value = df_uncorrected[
-                    'uncorrected_p_value'].values[index]
-                uncorrected_odds_ratio = df_uncorrected[
-                    'uncorrected_odds_ratio'].values[index]
-
-                results = (label, fdr_type, SNP, obs_freq,
-                           uncorrected_p_value, uncorrected_odds_ratio, fdr)
-                result_table.append(results)
-
-    # Produce simpler summary output
-    (label_list, fdr_type_list, SNP_list, obs_freq_list,
-        uncorrected_p_value_list, uncorrected_odds_ratio_list, fdr_list) = zip(*result_table)
-    df_results = pd.DataFrame(
-        {'label': label_list, 'fdr_type': fdr_type_list,
-         'SNP': SNP_list, 'obs_freq': obs_freq_list,
-         'uncorrected_p_value': uncorrected_p_value_list,
-         'uncorrected_odds_ratio': uncorrected_odds_ratio_list,
-         'fdr': fdr_list
-         })
+    table = selections(args)
+    if args.knockoff_report:
+        selection_table.write_report(
+            table, os.path.join(args.results_dir, selection_table.REPORT_FILENAME))
+    fdr = table['fdr']
+
+    # Look up the uncorrected statistics of every selected <SNP, label> with
+    # one merge, keeping the first row of uncorrected.csv for each.
+    df_results = selection_table.obs_freq(table).merge(
+        df_uncorrected.drop_duplicates(['SNP', 'label'])[
+            ['SNP', 'label', 'uncorrected_p_value', 'uncorrected_odds_ratio']],
+        on=['SNP', 'label'], how='left')
+    df_results['fdr'] = fdr
+    df_results = df_results[['SNP', 'fdr', 'fdr_type', 'label', 'obs_freq',
+                             'uncorrected_odds_ratio', 'uncorrected_p_value']]
 
     df_results.to_csv(os.path.join(args.results_dir, 'all_results.csv'),
                       index=False)
@@ -85,20 +85,15 @@ def summarize(args):
                             index=False)
 
     # Alternately, extract the single most-frequently occuring SNP of each type
-    grouped = df_results.groupby(['fdr_type', 'label'])
-    max_index = []
-    for _, df_fdr_label in grouped:
-        local_index_of_biggest = np.argmax(df_fdr_label.obs_freq.values)
-        max_index.append(df_fdr_label.index[local_index_of_biggest])
-    df_sig_max = df_results.iloc[max_index]
+    max_index = df_results.groupby(['fdr_type', 'label']).obs_freq.idxmax()
+    df_sig_max = df_results.loc[max_index.values]
     df_sig_max = df_sig_max.sort_values(by='obs_freq', ascending=False)
     df_sig_max.to_csv(os.path.join(args.results_dir, 'sig_max.csv'),
                       index=False)
 
     # Add the probabilities across all trials (gives something like the expected number
     # of times that a particular SNP shows up in *any* trial)
-    df_expected = df_results[['SNP', 'fdr_type', 'label', 'obs_freq']]
-    df_expected = df_expected.groupby(['SNP', 'fdr_type']).sum().reset_index()
+    df_expected = df_results.groupby(['SNP', 'fdr_type']).obs_freq.sum().reset_index()
     df_expected['fdr'] = fdr
     df_expected.rename(columns={'obs_freq': 'expected_obs_freq'}, inplace=True)
     df_expected = df_expected.sort_values(
@@ -107,8 +102,39 @@ def summarize(args):
                        index=False)
 
 
+def rethreshold(args):
+    '''
+    Recompute the selections at each target FDR in --rethreshold_fdr from
+    the stored W statistics, without refitting the classifier, and
+    summarize them as summarize() does.  The results for FDR f are written
+    to <results_dir>/fdr_<f>/.
+    '''
+    logger.info("####################################")
+    logger.info("Re-thresholding knockoff W statistics")
+
+    table = selection_table.read(os.path.join(args.results_dir, selection_table.FILENAME))
+    W_all = selection_table.read_W_statistics(
+        os.path.join(args.results_dir, selection_table.W_FILENAME))
+    for fdr in args.rethreshold_fdr:
+        results = selection_table.rethreshold(table, W_all, fdr)
+        fdr_args = copy.copy(args)
+        fdr_args.results_dir = os.path.join(args.results_dir, 'fdr_%g' % fdr)
+        fdr_args.fdr = fdr
+        utils.safe_mkdir(fdr_args.results_dir)
+        selection_table.write(os.path.join(fdr_args.results_dir, selection_table.FILENAME),
+                              results, table['label_names'], table['SNP_names'], fdr,
+                              table['num_trials'])
+        shutil.copyfile(os.path.join(args.results_dir, 'uncorrected.csv'),
+                        os.path.join(fdr_args.results_dir, 'uncorrected.csv'))
+        logger.info('Target FDR %g: results in %s' % (fdr, fdr_args.results_dir))
+        summarize(fdr_args)
+
+
 if __name__ == '__main__':
     args = utils.parse_arguments()
     utils.safe_mkdir(args.working_dir)
     utils.initialize_logger(args)
-    summarize(args)
+    if args.rethreshold_fdr:
+        rethreshold(args)
+    else:
+        summarize(args)
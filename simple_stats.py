@@ -2,14 +2,140 @@
 
 import numpy as np
 import os
+import shutil
+import tempfile
 import pandas as pd
 import utils_snpko as utils
+import run_report
+import packed_genotypes
+from joblib import Parallel, delayed
 
-from scipy.stats import fisher_exact
+from scipy.stats import fisher_exact, chi2
 
 
 logger = utils.logger
 
+# SNPs per parallel task of association_tests().
+ASSOCIATION_BLOCK_SNPS = 256
+
+# Columns of association.csv (besides SNP and label), in order: the number
+# of people with label 0 ("controls") and 1 ("cases") with each allele
+# count, and the tests.
+GENOTYPE_COUNTS = ['controls_0', 'controls_1', 'controls_2', 'cases_0', 'cases_1', 'cases_2']
+ASSOCIATION_TESTS = ['fisher_p_value', 'fisher_odds_ratio', 'allelic_chi2', 'allelic_p_value',
+                     'trend_chi2', 'trend_p_value', 'genotypic_chi2', 'genotypic_p_value']
+
+
+def pearson_chi2(tables):
+    '''
+    Pearson's chi-square statistic and its degrees of freedom for each of an
+    array of contingency tables (the last two axes), ignoring empty rows and
+    columns.
+    '''
+    rows = tables.sum(axis=-1)
+    columns = tables.sum(axis=-2)
+    total = rows.sum(axis=-1)
+    expected = rows[..., :, np.newaxis] * columns[..., np.newaxis, :]
+    expected = expected / np.maximum(total, 1)[..., np.newaxis, np.newaxis]
+    terms = np.where(expected > 0, (tables - expected) ** 2 / np.where(expected > 0, expected, 1), 0)
+    dof = ((rows > 0).sum(axis=-1) - 1) * ((columns > 0).sum(axis=-1) - 1)
+    return(terms.sum(axis=(-2, -1)), np.maximum(dof, 0))
+
+
+def chi2_p_value(statistic, dof):
+    '''
+    Upper tail probability of chi-square statistics; 1 where there are no
+    degrees of freedom.
+    '''
+    return(np.where(dof > 0, chi2.sf(statistic, np.maximum(dof, 1)), 1.0))
+
+
+def association_block(packed, label_array):
+    '''
+    Univariate tests of every label (columns of label_array; 0, 1 or NaN)
+    against each SNP of a block of a packed genotype matrix (see
+    packed_genotypes.py).  All tests come from one pass of contingency counts,
+    the number of people with each label state (0 or 1) and each allele count
+    (0, 1 or 2).  Returns a dict of arrays (labels x SNPs), one per column in
+    GENOTYPE_COUNTS and ASSOCIATION_TESTS.
+    '''
+    num_labels = label_array.shape[1]
+    tables = np.zeros((num_labels, packed.shape[0], 2, 3))
+    for label_index in xrange(num_labels):
+        for label_state in [0, 1]:
+            tables[label_index, :, label_state, :] = packed_genotypes.genotype_counts(
+                packed, label_array[:, label_index] == label_state)
+    results = dict((test, np.zeros(tables.shape[:2])) for test in ASSOCIATION_TESTS)
+    for (k, name) in enumerate(GENOTYPE_COUNTS):
+        results[name] = tables[:, :, k // 3, k % 3].astype(int)
+
+    # Fisher's exact test on a 2x2 contingency table, with allele counts 1 and 2
+    # combined into a single state, so we either have "diploid wild type" or
+    # not.  The table is indexed [feature_state, label_state].
+    carrier_tables = np.stack([tables[..., 0], tables[..., 1] + tables[..., 2]], axis=-2)
+    for label_index in xrange(num_labels):
+        for SNP_index in xrange(tables.shape[1]):
+            (oddsratio, pvalue) = fisher_exact(carrier_tables[label_index, SNP_index])
+            results['fisher_odds_ratio'][label_index, SNP_index] = oddsratio
+            results['fisher_p_value'][label_index, SNP_index] = pvalue
+
+    # Allelic test: chi-square on the 2x2 table of label state by allele
+    # (wild type or not), counting each person's two alleles.
+    allele_tables = np.stack([2 * tables[..., 0] + tables[..., 1],
+                              tables[..., 1] + 2 * tables[..., 2]], axis=-1)
+    (statistic, dof) = pearson_chi2(allele_tables)
+    results['allelic_chi2'] = statistic
+    results['allelic_p_value'] = chi2_p_value(statistic, dof)
+
+    # Cochran-Armitage trend test on the allele counts (weights 0, 1, 2).
+    # This is also the score test of a logistic regression of the label on
+    # the allele count.
+    weights = np.arange(3)
+    (controls, cases) = (tables[..., 0, :].sum(axis=-1), tables[..., 1, :].sum(axis=-1))
+    columns = tables.sum(axis=-2)
+    total = controls + cases
+    trend = (tables[..., 1, :] * controls[..., np.newaxis] -
+             tables[..., 0, :] * cases[..., np.newaxis]).dot(weights)
+    variance = (cases * controls / np.maximum(total, 1) *
+                (total * columns.dot(weights ** 2) - columns.dot(weights) ** 2))
+    statistic = np.where(variance > 0, trend ** 2 / np.where(variance > 0, variance, 1), 0)
+    results['trend_chi2'] = statistic
+    results['trend_p_value'] = chi2_p_value(statistic, (variance > 0).astype(int))
+
+    # Genotypic test: chi-square on the 2x3 table of label state by allele
+    # count, i.e., the score test of a logistic regression on the allele
+    # count as a categorical variable (2 degrees of freedom).
+    (statistic, dof) = pearson_chi2(tables)
+    results['genotypic_chi2'] = statistic
+    results['genotypic_p_value'] = chi2_p_value(statistic, dof)
+    return(results)
+
+
+def association_tests(args, packed, label_array):
+    '''
+    association_block() for every SNP of a packed genotype matrix, in
+    parallel over blocks of ASSOCIATION_BLOCK_SNPS SNPs.  The packed matrix
+    is shared with the workers through a memory-mapped file.
+    '''
+    starts = range(0, packed.shape[0], ASSOCIATION_BLOCK_SNPS)
+    # A single block is not worth starting worker processes for.
+    num_workers = args.num_workers if len(starts) > 1 else 1
+    shared_dir = tempfile.mkdtemp(prefix='shared_', dir=args.working_dir)
+    try:
+        packed = utils.shared_array(packed, os.path.join(shared_dir, 'packed.npy'))
+        timed_results = Parallel(n_jobs=num_workers)(
+            delayed(run_report.timed_call)(
+                association_block, packed[start:start + ASSOCIATION_BLOCK_SNPS], label_array)
+            for start in starts)
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    blocks = run_report.record_tasks('association_block', timed_results)
+    if len(blocks) == 0:
+        return(dict((name, np.zeros((label_array.shape[1], 0)))
+                    for name in GENOTYPE_COUNTS + ASSOCIATION_TESTS))
+    return(dict((name, np.concatenate([block[name] for block in blocks], axis=1))
+                for name in GENOTYPE_COUNTS + ASSOCIATION_TESTS))
+
 
 def stats(args):
     '''
@@ -17,6 +143,8 @@ def stats(args):
     * Univariate (uncorrected) p-value
     * (Uncorrected) likelihood ratio
     * Bonferroni corrected p-value
+    and, in association.csv, the allelic, trend and genotypic tests of each
+    SNP and label.
     '''
 
     df = pd.read_csv(os.path.join(args.working_dir, 'cleaned_input.csv'))
@@ -33,20 +161,16 @@ def stats(args):
         field for field in df.columns if field.startswith(args.data_prefix)]
     N = len(df)
 
-    feature_array = np.zeros((N, len(feature_list)))
-    for i, feature in enumerate(feature_list):
-        feature_array[:, i] = utils.genotype_to_nonwild_type_count(
-            df[feature].values, SNP_to_wild_type[feature])
-
-    label_array = np.zeros((N, len(label_list)))
-    for i, label in enumerate(label_list):
-        label_array[:, i] = df[label].values[:]
+    # Number of non-wild-type haplotypes (0, 1 or 2), packed 2 bits per
+    # genotype (see packed_genotypes.py).
+    feature_array = packed_genotypes.pack(
+        utils.genotype_count_matrix(df, feature_list, SNP_to_wild_type))
+    label_array = np.array(df[label_list], dtype=float).reshape(N, len(label_list))
 
-    # The above counts the number of non-wild-type haplotypes, so the values are
-    # 0 (wild type diploid), 1, or 2.  To analyze with 2x2 contingency table, we
-    # will combine 1 and 2 into a single state, so we either have "diploid wild type"
-    # or not.
-    feature_array[feature_array == 2] = 1
+    logger.info('Bonferroni correction: (%d labels x %d SNPs = %d' % (
+        len(label_list), len(feature_list), len(label_list) * len(feature_list)))
+    run_report.add_counts(tests=len(label_list) * len(feature_list), subjects=N)
+    results = association_tests(args, feature_array, label_array)
 
     # Uncorrected p-value
     with open(os.path.join(args.working_dir, 'results', 'uncorrected.csv'), 'w') as f:
@@ -54,37 +178,37 @@ def stats(args):
                 'bonferroni_corrected_p_value,empirical_ratio_with_imaging_feature,'
                 'empirical_ratio_without_imaging_feature\n')
 
-        contingency_table = np.zeros((2, 2))
-        p_raw_array = np.zeros((len(label_list), len(feature_list)))
-
-        logger.info('Bonferroni correction: (%d labels x %d SNPs = %d' % (
-            len(label_list), len(feature_list), len(label_list) * len(feature_list)))
-
         for label_index, label in enumerate(label_list):
             for feature_index, feature in enumerate(feature_list):
-                for label_state in [0, 1]:
-                    for feature_state in [0, 1]:
-                        contingency_table[feature_state, label_state] = (
-                            np.sum(np.logical_and(
-                                feature_array[
-                                    :, feature_index] == feature_state,
-                                df[label].values == label_state)))
-                oddsratio, pvalue = fisher_exact(contingency_table)
-                p_raw_array[label_index, feature_index] = pvalue
+                pvalue = results['fisher_p_value'][label_index, feature_index]
+                oddsratio = results['fisher_odds_ratio'][label_index, feature_index]
                 bonferroni = pvalue * len(feature_list) * len(label_list)
                 if bonferroni > 1.0:
                     bonferroni = 1.0
 
                 # Unfortunately, an "imaging feature" is what we call a "label" in the
                 # contingency table, not a "feature".
-                empirical_ratio_with_feature = '%d/%d' % (contingency_table[1, 1],
-                                                          contingency_table[1, 1] + contingency_table[0, 1])
-                empirical_ratio_without_feature = '%d/%d' % (contingency_table[1, 0],
-                                                             contingency_table[1, 0] + contingency_table[0, 0])
+                counts = dict((name, results[name][label_index, feature_index])
+                              for name in GENOTYPE_COUNTS)
+                empirical_ratio_with_feature = '%d/%d' % (
+                    counts['cases_1'] + counts['cases_2'],
+                    counts['cases_0'] + counts['cases_1'] + counts['cases_2'])
+                empirical_ratio_without_feature = '%d/%d' % (
+                    counts['controls_1'] + counts['controls_2'],
+                    counts['controls_0'] + counts['controls_1'] + counts['controls_2'])
                 f.write('%s,%s,%f,%f,%f,%s,%s\n' %
                         (feature, label, pvalue, oddsratio, bonferroni,
                             empirical_ratio_with_feature, empirical_ratio_without_feature))
 
+    # All of the tests, one row per SNP and label.
+    df_association = pd.DataFrame({
+        'SNP': np.tile(feature_list, len(label_list)),
+        'label': np.repeat(label_list, len(feature_list))})
+    for name in GENOTYPE_COUNTS + ASSOCIATION_TESTS:
+        df_association[name] = results[name].ravel()
+    df_association.to_csv(os.path.join(args.working_dir, 'results', 'association.csv'),
+                          index=False)
+
 
 if __name__ == '__main__':
     args = utils.parse_arguments()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# Content-addressed cache of pipeline stages.
+#
+# Each stage declares the files it reads, the command-line arguments it
+# depends on, and the files it writes.  Before running a stage, we hash its
+# inputs (file contents, argument values, and the source code of the stage)
+# into a fingerprint.  If the fingerprint matches the one recorded in the
+# manifest the last time the stage ran, and the recorded outputs are still
+# present and unchanged, the stage is skipped.
+#
+# Because fingerprints are built from file contents (not timestamps), a stage
+# that is re-run but produces identical output does not invalidate the
+# stages after it.
+
+import hashlib
+import inspect
+import json
+import os
+import utils_snpko as utils
+import run_report
+
+logger = utils.logger
+
+MANIFEST_NAME = 'stage_manifest.json'
+
+
+class Stage(object):
+    '''
+    A pipeline stage.  Paths may refer to command-line arguments with
+    str.format() fields, e.g. "{working_dir}/cleaned_input.csv"; a path may
+    name a directory, in which case all of the files in it are hashed.
+    Inputs that do not exist are hashed as "missing" (so, e.g., an optional
+    input appearing later invalidates the stage).
+    '''
+
+    def __init__(self, name, function, input_files=(), arg_fields=(),
+                 output_files=(), code_modules=()):
+        self.name = name
+        self.function = function
+        self.input_files = list(input_files)
+        self.arg_fields = list(arg_fields)
+        self.output_files = list(output_files)
+        # Modules (besides the one defining "function") whose code the stage
+        # runs.
+        self.code_modules = list(code_modules)
+
+    def paths(self, args, path_list):
+        return([p.format(**vars(args)) for p in path_list])
+
+
+def hash_path(path):
+    '''
+    SHA-256 of a file's contents, or of all files (and their relative names)
+    in a directory; None if the path does not exist.
+    '''
+    if os.path.isfile(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                sha.update(chunk)
+        return(sha.hexdigest())
+    if os.path.isdir(path):
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                full_name = os.path.join(root, f)
+                sha.update(os.path.relpath(full_name, path).encode('utf-8'))
+                sha.update(hash_path(full_name).encode('utf-8'))
+        return(sha.hexdigest())
+    return(None)
+
+
+def source_file(obj):
+    return(inspect.getsourcefile(obj) or inspect.getfile(obj))
+
+
+def fingerprint(stage, args):
+    '''
+    Hash of everything that determines a stage's outputs.
+    '''
+    sha = hashlib.sha256()
+    sha.update(stage.name.encode('utf-8'))
+    # Changing the code of a stage (or the shared helpers) invalidates it.
+    code_files = [source_file(stage.function), source_file(utils)]
+    code_files += [source_file(m) for m in stage.code_modules]
+    for path in code_files:
+        sha.update(('code:%s' % hash_path(path)).encode('utf-8'))
+    for field in stage.arg_fields:
+        sha.update(('arg:%s=%r' % (field, getattr(args, field))).encode('utf-8'))
+    for path in stage.paths(args, stage.input_files):
+        sha.update(('input:%s=%s' % (path, hash_path(path))).encode('utf-8'))
+    return(sha.hexdigest())
+
+
+def manifest_path(args):
+    return(os.path.join(args.working_dir, MANIFEST_NAME))
+
+
+def load_manifest(args):
+    try:
+        with open(manifest_path(args)) as fp:
+            return(json.load(fp))
+    except (IOError, OSError, ValueError):
+        return({})
+
+
+def save_manifest(args, manifest):
+    # Write-then-rename, so an interrupted run never leaves a corrupt
+    # manifest.
+    tmp_name = manifest_path(args) + '.tmp'
+    with open(tmp_name, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.rename(tmp_name, manifest_path(args))
+
+
+def is_cached(stage, args, manifest, stage_fingerprint):
+    record = manifest.get(stage.name)
+    if record is None or record.get('fingerprint') != stage_fingerprint:
+        return(False)
+    for path, recorded_hash in record.get('outputs', {}).items():
+        if hash_path(path) != recorded_hash:
+            return(False)
+    return(True)
+
+
+def stage_selected(args, stage_names, name):
+    '''
+    Is stage "name" within --from_stage ... --to_stage?
+    '''
+    index = stage_names.index(name)
+    if args.from_stage is not None and index < stage_names.index(args.from_stage):
+        return(False)
+    if args.to_stage is not None and index > stage_names.index(args.to_stage):
+        return(False)
+    return(True)
+
+
+def run_stages(args, stages, stage_names):
+    '''
+    Run each stage in order, skipping those outside --from_stage ...
+    --to_stage and (unless --no_stage_cache) those whose fingerprint matches
+    the manifest.  stage_names is the full, ordered list of stage names (which
+    may include stages not in "stages").
+    '''
+    manifest = load_manifest(args)
+    for stage in stages:
+        if not stage_selected(args, stage_names, stage.name):
+            logger.info('Stage %s: not selected; skipping' % stage.name)
+            continue
+        stage_fingerprint = fingerprint(stage, args)
+        if not args.no_stage_cache and is_cached(stage, args, manifest,
+                                                 stage_fingerprint):
+            logger.info('Stage %s: inputs unchanged; using cached outputs' %
+                        stage.name)
+            with run_report.stage(stage.name, cached=1):
+                pass
+            continue
+
+        with run_report.stage(stage.name):
+            stage.function(args)
+
+        outputs = {}
+        for path in stage.paths(args, stage.output_files):
+            output_hash = hash_path(path)
+            if output_hash is not None:
+                outputs[path] = output_hash
+        manifest[stage.name] = {'fingerprint': stage_fingerprint,
+                                'outputs': outputs}
+        save_manifest(args, manifest)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+# Benchmark the pipeline on synthetic cohorts of increasing size.
+#
+# For each point on a grid of (subjects, SNPs, chromosomes, labels), we
+# generate a synthetic cohort in the same spirit as make_test_data() in
+# test_snpko.py, together with a matching synthetic reference panel.  The
+# reference panel is written into ensembl_cache/ in the format that
+# ensembl_miner caches ENSEMBL replies, so no network access is needed.  Each
+# stage is then run and timed on its own, and the timings are appended to a
+# CSV file (tagged with the git commit), so that runs can be compared across
+# commits.
+#
+# Example:
+#     python tests/benchmark_snpko.py --subjects 500,2000 --SNPs 100,1000 \
+#         --chromosomes 1,22 --labels 2 --stages check_input,stats,refine,prune
+
+import argparse
+import cPickle as pickle
+import datetime
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import master_snpko
+import cache_entry
+import run_report
+import utils_snpko as utils
+
+logger = utils.logger
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASES = np.array(list('ACGT'))
+
+# Synthetic haplotypes are mosaics of a few founder haplotypes; this sets the
+# amount of linkage disequilibrium.
+NUM_FOUNDERS = 8
+SWITCH_PROBABILITY = 0.05
+MUTATION_PROBABILITY = 0.01
+
+# Number of SNPs per label that truly influence it, and their effect (log
+# odds per non-wild-type haplotype).
+CAUSAL_SNPS_PER_LABEL = 2
+CAUSAL_LOG_ODDS = 1.0
+
+
+def parse_benchmark_arguments():
+    '''
+    Benchmark options; everything else on the command line is passed on to
+    utils_snpko.parse_arguments().
+    '''
+    parser = argparse.ArgumentParser(description='SNPKO benchmark')
+    parser.add_argument('--subjects', type=str, default='500,2000',
+                        help='Comma-separated list of cohort sizes.')
+    parser.add_argument('--SNPs', type=str, default='100,1000',
+                        help='Comma-separated list of SNP panel sizes.')
+    parser.add_argument('--chromosomes', type=str, default='1,22',
+                        help='Comma-separated list of numbers of chromosomes.')
+    parser.add_argument('--labels', type=str, default='2',
+                        help='Comma-separated list of numbers of labels.')
+    parser.add_argument('--reference_size', type=int, default=2504,
+                        help='Number of people in the synthetic reference panel.')
+    parser.add_argument('--stages', type=str, default=','.join(utils.STAGE_NAMES),
+                        help='Comma-separated list of stages to time.')
+    parser.add_argument('--benchmark_file', type=str, default=None,
+                        help='CSV file to which timings are appended (default: '
+                        'benchmarks.csv in the working directory).')
+    parser.add_argument('--keep_data', action='store_true', default=False,
+                        help='Keep the working directory of each grid point.')
+    (bench_args, remaining) = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+    return(bench_args)
+
+
+def int_list(s):
+    return([int(x) for x in s.split(',')])
+
+
+def git_commit():
+    try:
+        return(subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=package_dir,
+            stderr=subprocess.STDOUT).strip())
+    except Exception:
+        return('unknown')
+
+
+def sample_haplotypes(num_haplotypes, founders, rng):
+    '''
+    Sample haplotypes (0 = wild type, 1 = other) along one chromosome as
+    mosaics of the founder haplotypes.  founders has shape
+    (NUM_FOUNDERS, num_SNPs).
+    '''
+    num_SNPs = founders.shape[1]
+    haplotypes = np.zeros((num_haplotypes, num_SNPs), dtype=np.int8)
+    founder = rng.randint(NUM_FOUNDERS, size=num_haplotypes)
+    for j in xrange(num_SNPs):
+        switch = rng.rand(num_haplotypes) < SWITCH_PROBABILITY
+        founder[switch] = rng.randint(NUM_FOUNDERS, size=switch.sum())
+        haplotypes[:, j] = founders[founder, j]
+    mutate = rng.rand(num_haplotypes, num_SNPs) < MUTATION_PROBABILITY
+    haplotypes[mutate] = 1 - haplotypes[mutate]
+    return(haplotypes)
+
+
+def genotype_strings(haplotypes_1, haplotypes_2, wild_type, other):
+    '''
+    Turn pairs of haplotypes into genotype strings like 'G|T'.
+    '''
+    allele_1 = np.where(haplotypes_1 == 0, wild_type, other)
+    allele_2 = np.where(haplotypes_2 == 0, wild_type, other)
+    return(np.char.add(np.char.add(allele_1, '|'), allele_2))
+
+
+def make_benchmark_data(args, num_subjects, num_SNPs, num_chromosomes,
+                        num_labels, reference_size):
+    '''
+    Write a synthetic input file to args.input_file, and a matching reference
+    panel to the ENSEMBL cache.
+    '''
+    logger.info("####################################")
+    logger.info("Making synthetic benchmark data: %d subjects, %d SNPs, "
+                "%d chromosomes, %d labels" % (
+                    num_subjects, num_SNPs, num_chromosomes, num_labels))
+    rng = np.random.RandomState(args.random_seed)
+
+    cache_dir = utils.cache_subdir(args, 'ensembl_cache')
+
+    reference_names = ['SYNTHETIC:phase_3:HG%05d' % i for i in xrange(reference_size)]
+    chromosome_of_SNP = np.sort(np.arange(num_SNPs) % num_chromosomes) + 1
+    wild_type = BASES[rng.randint(4, size=num_SNPs)]
+    other = BASES[(np.searchsorted(BASES, wild_type) + 1 +
+                   rng.randint(3, size=num_SNPs)) % 4]
+    SNP_names = ['rs%d' % (1000000 + j) for j in xrange(num_SNPs)]
+
+    subject_counts = np.zeros((num_subjects, num_SNPs), dtype=np.int8)
+    columns = {}
+    for chromosome in xrange(1, num_chromosomes + 1):
+        index = np.where(chromosome_of_SNP == chromosome)[0]
+        if len(index) == 0:
+            continue
+        allele_frequency = rng.uniform(0.05, 0.5, size=len(index))
+        founders = (rng.rand(NUM_FOUNDERS, len(index)) <
+                    allele_frequency).astype(np.int8)
+        positions = 1000000 + np.cumsum(rng.randint(1000, 50000, size=len(index)))
+
+        subject_haplotypes = sample_haplotypes(2 * num_subjects, founders, rng)
+        reference_haplotypes = sample_haplotypes(2 * reference_size, founders, rng)
+        subject_counts[:, index] = (subject_haplotypes[:num_subjects] +
+                                    subject_haplotypes[num_subjects:])
+
+        for k, j in enumerate(index):
+            columns['%s_%s' % (SNP_names[j], wild_type[j])] = genotype_strings(
+                subject_haplotypes[:num_subjects, k],
+                subject_haplotypes[num_subjects:, k], wild_type[j], other[j])
+            reference = genotype_strings(
+                reference_haplotypes[:reference_size, k],
+                reference_haplotypes[reference_size:, k], wild_type[j], other[j])
+            # Same structure as an ENSEMBL "variation" reply.
+            decoded = {
+                'mappings': [{'assembly_name': 'GRCh38',
+                              'location': '%d:%d-%d' % (
+                                  chromosome, positions[k], positions[k]),
+                              'start': int(positions[k]),
+                              'allele_string': '%s/%s' % (wild_type[j], other[j])}],
+                'genotypes': [{'sample': person, 'genotype': genotype}
+                              for (person, genotype) in zip(reference_names,
+                                                            reference.tolist())]}
+            record_file = os.path.join(cache_dir, SNP_names[j])
+            cache_entry.atomic_write(
+                record_file, lambda fp: pickle.dump(decoded, fp, pickle.HIGHEST_PROTOCOL))
+            cache_entry.commit(record_file, [record_file])
+
+    # Each label depends on a few SNPs.
+    label_names = ['Label_%d' % i for i in xrange(num_labels)]
+    causal = {}
+    for label in label_names:
+        causal[label] = rng.choice(num_SNPs, size=min(CAUSAL_SNPS_PER_LABEL, num_SNPs),
+                                   replace=False)
+        log_odds = -1.0 + CAUSAL_LOG_ODDS * subject_counts[:, causal[label]].sum(axis=1)
+        prob = 1.0 / (1.0 + np.exp(-log_odds))
+        columns[label] = (rng.rand(num_subjects) < prob).astype(int)
+
+    df = pd.DataFrame(columns)
+    df = df[sorted(c for c in df.columns if c.startswith('rs')) + label_names]
+    logger.info("Writing benchmark data file %s" % (args.input_file))
+    df.to_csv(args.input_file, index=False)
+    return(dict((label, [SNP_names[j] for j in causal[label]])
+                for label in label_names))
+
+
+def run_benchmark(args, stage_list, config):
+    '''
+    Run each pipeline stage in stage_list on the data in args.working_dir,
+    timing each one separately.  Returns a list of rows for the benchmark
+    file.
+    '''
+    rows = []
+    stages = master_snpko.PREPARATION_STAGES + master_snpko.causal_stages(args)
+    failed = None
+    for stage in stages:
+        if stage.name not in stage_list:
+            continue
+        row = dict(config)
+        row['stage'] = stage.name
+        if failed is not None:
+            row['status'] = 'skipped (%s failed)' % failed
+            rows.append(row)
+            continue
+        try:
+            with run_report.stage(stage.name) as timer:
+                stage.function(args)
+            row['status'] = 'ok'
+        except Exception as e:
+            logger.info('Stage %s failed: %r' % (stage.name, e))
+            row['status'] = 'failed: %r' % e
+            failed = stage.name
+        for field in ['wall_seconds', 'cpu_seconds', 'worker_cpu_seconds',
+                      'peak_rss_mb', 'num_tasks']:
+            row[field] = timer.record.get(field)
+        for k, v in timer.record['counts'].items():
+            row['count_%s' % k] = v
+        rows.append(row)
+    return(rows)
+
+
+def append_rows(benchmark_file, rows):
+    df = pd.DataFrame(rows)
+    if os.path.exists(benchmark_file):
+        df = pd.concat([pd.read_csv(benchmark_file), df], sort=False)
+    df.to_csv(benchmark_file, index=False)
+
+
+def compare_commits(benchmark_file):
+    '''
+    Log the most recent wall time of each (grid point, stage) for every commit
+    in the benchmark file.
+    '''
+    df = pd.read_csv(benchmark_file)
+    df = df[df['status'] == 'ok']
+    if len(df) == 0:
+        return
+    keys = ['subjects', 'SNPs', 'chromosomes', 'labels', 'stage']
+    df = df.drop_duplicates(subset=keys + ['commit'], keep='last')
+    table = df.pivot_table(index=keys, columns='commit', values='wall_seconds')
+    logger.info('Wall time (seconds) by commit:\n%s' % table.to_string())
+
+
+if __name__ == '__main__':
+    bench_args = parse_benchmark_arguments()
+    args = utils.parse_arguments()
+
+    # If default working directory, redirect somewhere safer:
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/benchmark_snpko'
+    utils.safe_mkdir(args.working_dir)
+    args.data_prefix = 'Label_'
+    utils.initialize_logger(args)
+
+    base_dir = args.working_dir
+    benchmark_file = bench_args.benchmark_file or os.path.join(base_dir, 'benchmarks.csv')
+    stage_list = bench_args.stages.split(',')
+    commit = git_commit()
+
+    for num_subjects in int_list(bench_args.subjects):
+        for num_SNPs in int_list(bench_args.SNPs):
+            for num_chromosomes in int_list(bench_args.chromosomes):
+                for num_labels in int_list(bench_args.labels):
+                    config = {'commit': commit,
+                              'date': datetime.datetime.now().isoformat(),
+                              'host': socket.gethostname(),
+                              'num_workers': args.num_workers,
+                              'subjects': num_subjects,
+                              'SNPs': num_SNPs,
+                              'chromosomes': num_chromosomes,
+                              'labels': num_labels,
+                              'reference_size': bench_args.reference_size}
+                    args.working_dir = os.path.join(base_dir, 'bench_%d_%d_%d_%d' % (
+                        num_subjects, num_SNPs, num_chromosomes, num_labels))
+                    args.results_dir = os.path.join(args.working_dir, 'results')
+                    args.original_results_dir = args.results_dir
+                    args.input_file = os.path.join(args.working_dir, 'benchmark_input.csv')
+                    shutil.rmtree(args.working_dir, ignore_errors=True)
+                    utils.safe_mkdir(args.working_dir)
+
+                    make_benchmark_data(args, num_subjects, num_SNPs, num_chromosomes,
+                                        num_labels, bench_args.reference_size)
+                    rows = run_benchmark(args, stage_list, config)
+                    append_rows(benchmark_file, rows)
+                    if not bench_args.keep_data:
+                        shutil.rmtree(args.working_dir, ignore_errors=True)
+
+    compare_commits(benchmark_file)
+    logger.info('Benchmark results appended to %s' % benchmark_file)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Run the univariate association tests of simple_stats on random genotypes
+# and labels (with missing labels and a constant SNP), and confirm that the
+# allelic and genotypic tests match scipy's chi-square test of the same
+# contingency tables, and that the trend statistic is N r^2 (r being the
+# correlation of allele count and label).
+
+import sys
+import numpy as np
+from scipy.stats import chi2_contingency
+import packed_genotypes
+import simple_stats
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def test_association():
+    rng = np.random.RandomState(0)
+    (num_people, num_SNPs, num_labels) = (157, 30, 3)
+    X = rng.randint(3, size=(num_people, num_SNPs)).astype(np.int8)
+    X[:, 3] = 0
+    labels = rng.randint(2, size=(num_people, num_labels)).astype(float)
+    labels[:10, 1] = np.nan
+    results = simple_stats.association_block(packed_genotypes.pack(X), labels)
+
+    for label_index in range(num_labels):
+        y = labels[:, label_index]
+        x = X[~np.isnan(y), :]
+        y = y[~np.isnan(y)]
+        for j in range(num_SNPs):
+            table = np.array([[np.sum((y == state) & (x[:, j] == count)) for count in range(3)]
+                              for state in range(2)])
+            if j == 3:
+                if (results['genotypic_p_value'][label_index, j] != 1 or
+                        results['trend_p_value'][label_index, j] != 1):
+                    logger.info('Constant SNP is not p = 1!')
+                    raise Exception
+                continue
+            expected = {
+                'genotypic_chi2': chi2_contingency(table, correction=False)[0],
+                'genotypic_p_value': chi2_contingency(table, correction=False)[1],
+                'allelic_chi2': chi2_contingency(
+                    table.dot([[2, 0], [1, 1], [0, 2]]), correction=False)[0],
+                'trend_chi2': len(y) * np.corrcoef(x[:, j], y)[0, 1] ** 2,
+                'cases_2': table[1, 2]}
+            for (name, value) in expected.items():
+                if not np.isclose(results[name][label_index, j], value):
+                    logger.info('%s of label %d, SNP %d is %f, not %f!' % (
+                        name, label_index, j, results[name][label_index, j], value))
+                    raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_association'
+    utils.initialize_logger(args)
+    test_association()
+    sys.exit(0)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Several processes fill the same cache entry at once, one of them after a
+# "crashed" process left the entry half-written; confirm that the entry is
+# computed exactly once more, that everyone reads the complete entry, and
+# that a damaged entry is no longer trusted.
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import cache_entry
+import utils_snpko as utils
+
+logger = utils.logger
+
+num_workers = 6
+contents = b'x' * 100000
+
+
+def counter_file(cache_dir):
+    return(os.path.join(cache_dir, 'computations.txt'))
+
+
+def fill(entry_file):
+    '''
+    Slowly write the entry, so that the other workers try to fill it too.
+    '''
+    def write(fp):
+        for i in range(10):
+            fp.write(contents[i * 10000:(i + 1) * 10000])
+            time.sleep(0.05)
+    cache_entry.atomic_write(entry_file, write)
+
+
+def worker(cache_dir):
+    entry_file = os.path.join(cache_dir, 'entry')
+    with cache_entry.lock(entry_file):
+        if not cache_entry.is_complete(entry_file, [entry_file]):
+            cache_entry.discard(entry_file)
+            with open(counter_file(cache_dir), 'a') as fp:
+                fp.write('%d\n' % os.getpid())
+            fill(entry_file)
+            cache_entry.commit(entry_file, [entry_file])
+    with open(entry_file, 'rb') as fp:
+        if fp.read() != contents:
+            sys.exit(1)
+
+
+def check_cache_entry(cache_dir):
+    entry_file = os.path.join(cache_dir, 'entry')
+
+    # A process that died while filling the entry leaves a truncated file
+    # and no checksum.
+    with open(entry_file, 'wb') as fp:
+        fp.write(contents[:1000])
+    if cache_entry.is_complete(entry_file, [entry_file]):
+        logger.info('Truncated entry was trusted!')
+        raise Exception
+
+    processes = [multiprocessing.Process(target=worker, args=(cache_dir,))
+                 for i in range(num_workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    if any(p.exitcode != 0 for p in processes):
+        logger.info('A worker read an incomplete entry!')
+        raise Exception
+
+    with open(counter_file(cache_dir)) as fp:
+        num_computations = len(fp.readlines())
+    logger.info('%d workers, %d computations of the entry' % (
+        num_workers, num_computations))
+    if num_computations != 1:
+        logger.info('Entry was not computed exactly once!')
+        raise Exception
+    if not cache_entry.is_complete(entry_file, [entry_file]):
+        logger.info('Entry is not complete!')
+        raise Exception
+    if [f for f in os.listdir(cache_dir) if '.tmp.' in f]:
+        logger.info('Temporary files were left behind!')
+        raise Exception
+
+    # Damage the committed entry (same size, different contents).
+    with open(entry_file, 'r+b') as fp:
+        fp.seek(500)
+        fp.write(b'y')
+    if cache_entry.is_complete(entry_file, [entry_file]):
+        logger.info('Damaged entry was trusted!')
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_cache_entry'
+    utils.initialize_logger(args)
+
+    cache_dir = tempfile.mkdtemp(prefix='snpko_cache_')
+    try:
+        check_cache_entry(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Run the bulk transfers of cloud_transfer against an in-memory stand-in for
+# the S3 client, and confirm that identical files are skipped, that a
+# checksum mismatch is retried and then reported, and that downloads only
+# ever appear under their final name complete.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import cloud_transfer
+import utils_snpko as utils
+
+logger = utils.logger
+
+bucket_name = 'snpko-test'
+retries = 1
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3(object):
+    '''
+    The parts of a boto3 S3 client that cloud_transfer uses.  The next
+    "corrupt_uploads" uploads and "corrupt_downloads" downloads lose their
+    last byte.
+    '''
+    class exceptions(object):
+        ClientError = FakeClientError
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.downloads = []
+        self.corrupt_uploads = 0
+        self.corrupt_downloads = 0
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise FakeClientError('404')
+        contents = self.objects[Key]
+        return({'ContentLength': len(contents),
+                'ETag': '"%s"' % hashlib.md5(contents).hexdigest()})
+
+    def upload_file(self, source_name, bucket, key, ExtraArgs=None):
+        self.uploads.append(key)
+        with open(source_name, 'rb') as fp:
+            contents = fp.read()
+        if self.corrupt_uploads > 0:
+            self.corrupt_uploads -= 1
+            contents = contents[:-1]
+        self.objects[key] = contents
+
+    def download_file(self, bucket, key, destination_name):
+        self.downloads.append(destination_name)
+        contents = self.objects[key]
+        if self.corrupt_downloads > 0:
+            self.corrupt_downloads -= 1
+            contents = contents[:-1]
+        with open(destination_name, 'wb') as fp:
+            fp.write(contents)
+
+    def get_paginator(self, operation):
+        objects = self.objects
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix, Delimiter=None):
+                return([{'Contents': [{'Key': key} for key in sorted(objects)
+                                      if key.startswith(Prefix)]}])
+        return(Paginator())
+
+
+def expect_failure(fn, description):
+    try:
+        fn()
+    except IOError:
+        return
+    logger.info('%s did not fail!' % description)
+    raise Exception
+
+
+def check_cloud_transfer(data_dir):
+    s3 = FakeS3()
+    cloud_transfer.aws_client = lambda: s3
+
+    upload_dir = os.path.join(data_dir, 'upload')
+    utils.safe_mkdir(upload_dir)
+    pairs = []
+    for i in range(5):
+        name = os.path.join(upload_dir, 'file%d.txt' % i)
+        with open(name, 'wb') as fp:
+            fp.write(b'contents of file %d\n' % i * (i + 1))
+        pairs.append((name, 'results/file%d.txt' % i))
+
+    cloud_transfer.upload_files('aws', bucket_name, pairs, num_threads=3, retries=retries)
+    if sorted(s3.uploads) != sorted(key for (_, key) in pairs):
+        logger.info('Files were not each uploaded once: %s' % s3.uploads)
+        raise Exception
+    cloud_transfer.upload_files('aws', bucket_name, pairs, num_threads=3, retries=retries)
+    if len(s3.uploads) != len(pairs):
+        logger.info('Identical files were uploaded again!')
+        raise Exception
+
+    # A corrupted upload is retried; one that stays corrupted is an error.
+    with open(pairs[0][0], 'ab') as fp:
+        fp.write(b'changed\n')
+    s3.corrupt_uploads = 1
+    if not cloud_transfer.upload_file('aws', bucket_name, pairs[0][0], pairs[0][1],
+                                      retries=retries):
+        logger.info('Changed file was not uploaded!')
+        raise Exception
+    if len(s3.uploads) != len(pairs) + 2 or not cloud_transfer.same_contents(
+            pairs[0][0], cloud_transfer.remote_info('aws', bucket_name, pairs[0][1])):
+        logger.info('Corrupted upload was not retried!')
+        raise Exception
+    with open(pairs[0][0], 'ab') as fp:
+        fp.write(b'changed again\n')
+    s3.corrupt_uploads = retries + 1
+    expect_failure(lambda: cloud_transfer.upload_file(
+        'aws', bucket_name, pairs[0][0], pairs[0][1], retries=retries), 'Corrupted upload')
+
+    # Downloads go to a temporary name, and are only renamed when complete.
+    s3.objects['results/file0.txt'] = open(pairs[0][0], 'rb').read()
+    download_dir = os.path.join(data_dir, 'download')
+    cloud_transfer.download_prefix('aws', bucket_name, 'results/', download_dir,
+                                   num_threads=3, retries=retries)
+    for (name, key) in pairs:
+        with open(os.path.join(download_dir, os.path.basename(key)), 'rb') as fp:
+            if fp.read() != open(name, 'rb').read():
+                logger.info('Downloaded %s does not match!' % key)
+                raise Exception
+    if len(s3.downloads) != len(pairs) or any(
+            '.tmp.' not in os.path.basename(name) for name in s3.downloads):
+        logger.info('Downloads did not go through temporary files: %s' % s3.downloads)
+        raise Exception
+    cloud_transfer.download_prefix('aws', bucket_name, 'results/', download_dir,
+                                   num_threads=3, retries=retries)
+    if len(s3.downloads) != len(pairs):
+        logger.info('Identical files were downloaded again!')
+        raise Exception
+
+    s3.objects['results/new.txt'] = b'new contents\n'
+    new_file = os.path.join(download_dir, 'new.txt')
+    s3.corrupt_downloads = retries + 1
+    expect_failure(lambda: cloud_transfer.download_files(
+        'aws', bucket_name, [('results/new.txt', new_file)], retries=retries),
+        'Corrupted download')
+    if os.path.exists(new_file) or [f for f in os.listdir(download_dir) if '.tmp.' in f]:
+        logger.info('Corrupted download left a file behind!')
+        raise Exception
+    s3.corrupt_downloads = 1
+    cloud_transfer.download_files('aws', bucket_name, [('results/new.txt', new_file)],
+                                  retries=retries)
+    if open(new_file, 'rb').read() != s3.objects['results/new.txt']:
+        logger.info('Corrupted download was not retried!')
+        raise Exception
+    expect_failure(lambda: cloud_transfer.download_file(
+        'aws', bucket_name, 'results/missing.txt', new_file, retries=retries),
+        'Download of a missing object')
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_cloud_transfer'
+    utils.initialize_logger(args)
+
+    data_dir = tempfile.mkdtemp(prefix='snpko_transfer_')
+    try:
+        check_cloud_transfer(data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# Check the coordinate descent elastic-net logistic regression: every fit on
+# the path must satisfy the optimality (KKT) conditions of the objective,
+# including features that the screening rules set aside.
+
+import numpy as np
+import enet_logistic
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def test_enet_logistic():
+    rng = np.random.RandomState(0)
+    (n, d) = (150, 300)
+    X = rng.randint(3, size=(n, d)).astype(float)
+    y = ((X[:, 0] - X[:, 5] + 0.5 * X[:, 9] + rng.randn(n)) > 0.3).astype(float)
+    alphas = np.power(10.0, np.linspace(0, -3, 5))
+
+    for l1_ratio in [0.05, 0.5, 1.0]:
+        fits = enet_logistic.path(X, y, alphas, l1_ratio, tolerance=1e-10)
+        for (alpha, (w, b)) in zip(alphas, fits):
+            residual = y - 1.0 / (1.0 + np.exp(-(b + np.dot(X, w))))
+            gradient = np.dot(X.T, residual) / n
+            nonzero = (w != 0)
+            # At 0, |gradient| <= alpha * l1_ratio; elsewhere, the gradient
+            # balances the penalty.  The intercept is unpenalized.
+            violations = np.concatenate([
+                [np.abs(residual.mean())],
+                np.abs(gradient[~nonzero]) - alpha * l1_ratio,
+                np.abs(gradient[nonzero] - alpha * (
+                    l1_ratio * np.sign(w[nonzero]) + (1 - l1_ratio) * w[nonzero]))])
+            violation = violations.max()
+            logger.info('l1_ratio %.2f, alpha %.0e: %d nonzero, KKT violation %.1e' % (
+                l1_ratio, alpha, nonzero.sum(), violation))
+            if violation > 1e-5:
+                logger.info('Fit is not optimal!')
+                raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_enet_logistic'
+    utils.initialize_logger(args)
+    test_enet_logistic()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Write a genotype store in chunks that add people as they go, with a tiny
+# memory budget, and confirm that reading it back, copying some of its
+# columns and rows, and filling a shared array all give the original allele
+# counts.
+
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import genotype_store
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def check_genotype_store(store_dir):
+    rng = np.random.RandomState(0)
+    num_people = 50
+    num_SNPs = 23
+    people = ['person%d' % i for i in range(num_people)]
+    SNPs = ['rs%d' % j for j in range(num_SNPs)]
+    X = rng.randint(3, size=(num_people, num_SNPs)).astype(np.int8)
+    X[rng.rand(num_people, num_SNPs) < 0.1] = genotype_store.MISSING
+
+    # Each chunk only has rows for (a shuffled subset of) the people seen
+    # so far, so later chunks add people.
+    writer = genotype_store.StoreWriter(os.path.join(store_dir, 'all'))
+    for start in range(0, num_SNPs, 5):
+        columns = slice(start, start + 5)
+        rows = rng.permutation(min(num_people, 10 + 2 * start))
+        writer.add_chunk(SNPs[columns], X[rows, columns], people=[people[i] for i in rows])
+    writer.close()
+    store = genotype_store.Store(os.path.join(store_dir, 'all'))
+    if store.SNPs != SNPs or sorted(store.people) != sorted(people):
+        logger.info('Store has the wrong people or SNPs!')
+        raise Exception
+
+    # The chunks' missing rows read as missing.
+    order = [people.index(person) for person in store.people]
+    expected = X[order].copy()
+    for start in range(0, num_SNPs, 5):
+        known = set(range(min(num_people, 10 + 2 * start)))
+        for (i, j) in enumerate(order):
+            if j not in known:
+                expected[i, start:start + 5] = genotype_store.MISSING
+    if not np.array_equal(np.hstack([X_chunk for (_, X_chunk) in store.chunks()]), expected):
+        logger.info('Chunks do not match the data written!')
+        raise Exception
+
+    some_SNPs = SNPs[::3][::-1]
+    rows = np.arange(0, num_people, 2)
+    store.copy_columns(os.path.join(store_dir, 'some'), some_SNPs, 0.001, rows=rows)
+    copy = genotype_store.Store(os.path.join(store_dir, 'some'))
+    logger.info('Copied %d people and %d SNPs in %d chunks' % (
+        len(copy.people), len(copy.SNPs), len(copy.chunk_list)))
+    if (copy.SNPs != some_SNPs or
+            not np.array_equal(copy.read(some_SNPs),
+                               expected[np.ix_(rows, [SNPs.index(s) for s in some_SNPs])])):
+        logger.info('Copied columns do not match!')
+        raise Exception
+
+    X_shared = store.shared_array(SNPs, os.path.join(store_dir, 'X.npy'), 0.001)
+    if not np.array_equal(X_shared, expected):
+        logger.info('Shared array does not match!')
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_genotype_store'
+    utils.initialize_logger(args)
+
+    store_dir = tempfile.mkdtemp(prefix='snpko_store_')
+    try:
+        check_genotype_store(store_dir)
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+    sys.exit(0)
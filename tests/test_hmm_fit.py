@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Check the in-process HMM fitter: the likelihood computed by its
+# forward-backward pass must agree with a direct forward pass over the
+# assembled genotype HMM (pInit, Q, pEmit), and EM must never decrease the
+# likelihood or depend on how the people are split into chunks.
+
+import numpy as np
+import hmm_fit
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def genotype_log_likelihood(hmm, x):
+    '''
+    Log likelihood of genotype sequence x under the assembled HMM.
+    '''
+    f = hmm['pInit'] * hmm['pEmit'][0, x[0], :]
+    log_likelihood = 0.0
+    for j in xrange(1, len(x)):
+        log_likelihood += np.log(f.sum())
+        f = np.dot(f / f.sum(), hmm['Q'][j - 1]) * hmm['pEmit'][j, x[j], :]
+    return(log_likelihood + np.log(f.sum()))
+
+
+def test_hmm_fit():
+    rng = np.random.RandomState(0)
+    (n, p, K) = (20, 8, 4)
+
+    r = rng.rand(p)
+    alpha = rng.dirichlet(np.ones(K), size=p)
+    theta = rng.rand(p, K)
+    X = rng.randint(3, size=(n, p))
+    hmm = hmm_fit.assemble_hmm(r, alpha, theta)
+    direct = sum(genotype_log_likelihood(hmm, x) for x in X)
+    (vectorized, _, _, _) = hmm_fit._e_step(X, r, alpha, theta)
+    logger.info('Log likelihood: direct %.6f, vectorized %.6f' % (direct, vectorized))
+    if abs(direct - vectorized) > 1e-6 * abs(direct):
+        logger.info('Forward-backward likelihood is wrong!')
+        raise Exception
+
+    # Genotypes from a few founder haplotypes, so there is structure to learn.
+    founders = rng.randint(2, size=(3, p))
+    haplotypes = founders[rng.randint(3, size=2 * n * 10)]
+    X = haplotypes[:n * 10] + haplotypes[n * 10:]
+    fit = hmm_fit.em(X, K=K, max_iterations=50, tolerance=0.0)
+    steps = np.diff(fit['log_likelihoods'])
+    logger.info('EM log likelihood %.3f -> %.3f' % (
+        fit['log_likelihoods'][0], fit['log_likelihoods'][-1]))
+    if np.any(steps < -1e-6 * np.abs(fit['log_likelihoods'][1:])):
+        logger.info('EM decreased the log likelihood!')
+        raise Exception
+
+    # The E step's sufficient statistics add up over chunks of people.
+    chunked = hmm_fit.em(X, K=K, max_iterations=5, tolerance=0.0, chunk_size=7)
+    if not np.allclose(chunked['log_likelihoods'], fit['log_likelihoods'][:5]):
+        logger.info('EM depends on the chunk size!')
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_hmm_fit'
+    utils.initialize_logger(args)
+    test_hmm_fit()
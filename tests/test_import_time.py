@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Regression check on start-up cost: importing a pipeline module must not drag
+# in heavy libraries it does not need (cloud SDKs, sklearn, ...), since each
+# stage is often run as its own process.  Each module is imported in a fresh
+# interpreter; with Python >= 3.7 we use "-X importtime" to see every module
+# that was imported and how long the import took.
+
+import os
+import subprocess
+import sys
+import utils_snpko as utils
+
+logger = utils.logger
+
+# Libraries that are expensive to import and only needed by some stages.
+HEAVY_LIBRARIES = ['google', 'boto3', 'botocore', 'sklearn', 'scipy', 'SNPknock']
+
+# Module => heavy libraries it is allowed to import.
+ALLOWED = {
+    'utils_snpko': [],
+    'job_queue': [],
+    'hmm_fit': [],
+    'knockoff_sampler': [],
+    'run_report': [],
+    'cloud_transfer': [],
+    'check_input': [],
+    'population_refiner': [],
+    'ensembl_miner': [],
+    'sig_results': [],
+    'selection_table': [],
+    'p_values': [],
+    'multi_study': [],
+    'cache_entry': [],
+    'genotype_store': [],
+    'packed_genotypes': [],
+    'simple_stats': ['scipy'],
+    'find_loci': ['scipy'],
+    'screen_loci': ['scipy'],
+    'classifier': ['sklearn', 'scipy'],
+    'enet_logistic': ['sklearn', 'scipy'],
+}
+
+# Generous ceiling on the cumulative import time of any one module.
+MAX_IMPORT_SECONDS = 3.0
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def has_importtime():
+    return(sys.version_info >= (3, 7))
+
+
+def imported_modules(module):
+    '''
+    Import module in a fresh interpreter.  Returns (set of top-level packages
+    imported, cumulative import time of module in seconds).
+    '''
+    if has_importtime():
+        p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                              'import %s' % module],
+                             cwd=package_dir, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        (_, err) = p.communicate()
+        if p.returncode != 0:
+            logger.info(err)
+            raise Exception
+        # Lines look like "import time:  self [us] | cumulative | package"
+        packages = set()
+        seconds = None
+        for line in err.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = [f.strip() for f in line[len('import time:'):].split('|')]
+            if len(fields) != 3 or not fields[1].isdigit():
+                continue
+            name = fields[2]
+            packages.add(name.split('.')[0])
+            if name == module:
+                seconds = int(fields[1]) / 1e6
+        return(packages, seconds)
+    else:
+        code = ('import sys, time\n'
+                't = time.time()\n'
+                'import %s\n'
+                't = time.time() - t\n'
+                'print(t)\n'
+                'print(" ".join(set(m.split(".")[0] for m in sys.modules)))\n' % module)
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=package_dir, universal_newlines=True)
+        lines = out.splitlines()
+        return(set(lines[-1].split()), float(lines[-2]))
+
+
+def test_import_time(modules=None):
+    if modules is None:
+        modules = sorted(ALLOWED.keys())
+    failures = 0
+    for module in modules:
+        (packages, seconds) = imported_modules(module)
+        unexpected = [lib for lib in HEAVY_LIBRARIES
+                      if lib in packages and lib not in ALLOWED[module]]
+        logger.info('%-20s %6.3fs  heavy imports: %s' % (
+            module, seconds, sorted(set(HEAVY_LIBRARIES) & packages)))
+        if unexpected:
+            logger.info('   %s should not import %s' % (module, unexpected))
+            failures += 1
+        if seconds > MAX_IMPORT_SECONDS:
+            logger.info('   %s took %.3fs to import (limit %.1fs)' % (
+                module, seconds, MAX_IMPORT_SECONDS))
+            failures += 1
+    if failures > 0:
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_import_time'
+    utils.initialize_logger(args)
+    test_import_time()
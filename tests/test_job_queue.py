@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Exercise the filesystem-backed job queue with several local worker
+# processes while one job is held by a "preempted" worker, and confirm that
+# every job (including the abandoned one) is completed exactly once.
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import job_queue
+import utils_snpko as utils
+
+logger = utils.logger
+
+num_jobs = 20
+num_workers = 4
+heartbeat_timeout = 2
+
+
+def output_file(queue_dir, job_id):
+    return(os.path.join(queue_dir, 'output_%03d.txt' % job_id))
+
+
+def worker(queue_dir, worker_num):
+    queue = job_queue.FileJobQueue(queue_dir,
+                                   heartbeat_timeout=heartbeat_timeout)
+
+    def work(job_id):
+        with open(output_file(queue_dir, job_id), 'a') as fp:
+            fp.write('%d\n' % (job_id * job_id))
+
+    job_queue.run_worker(queue, work, worker_id='worker_%d' % worker_num,
+                         poll_interval=0.2)
+
+
+def check_job_queue(queue_dir):
+    queue = job_queue.FileJobQueue(queue_dir,
+                                   heartbeat_timeout=heartbeat_timeout)
+    queue.populate(range(num_jobs))
+
+    # Simulate a preempted machine: claim a job, then vanish without
+    # completing, releasing or heartbeating it.
+    abandoned_job = queue.claim('preempted_worker')
+
+    processes = [multiprocessing.Process(target=worker, args=(queue_dir, i))
+                 for i in range(num_workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    logger.info('Final queue state: %s' % queue.counts())
+    if queue.counts() != {'pending': 0, 'claimed': 0, 'done': num_jobs}:
+        logger.info('Queue did not drain!')
+        raise Exception
+    for job_id in range(num_jobs):
+        with open(output_file(queue_dir, job_id)) as fp:
+            lines = fp.readlines()
+        if lines != ['%d\n' % (job_id * job_id)]:
+            logger.info('Job %d output is wrong: %s' % (job_id, lines))
+            raise Exception
+
+    if not os.path.exists(output_file(queue_dir, abandoned_job)):
+        logger.info('Abandoned job %d was never re-queued!' % abandoned_job)
+        raise Exception
+
+    # Re-populating must not resurrect finished jobs.
+    queue.populate(range(num_jobs))
+    if queue.counts()['pending'] != 0:
+        logger.info('Re-populating re-queued finished jobs!')
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_job_queue'
+    utils.initialize_logger(args)
+
+    queue_dir = tempfile.mkdtemp(prefix='snpko_queue_')
+    try:
+        check_job_queue(queue_dir)
+    finally:
+        shutil.rmtree(queue_dir, ignore_errors=True)
+    sys.exit(0)
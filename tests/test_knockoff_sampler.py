@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Check the multi-trial knockoff sampler: knockoffs of genotypes drawn from
+# the HMM must themselves follow the HMM's genotype frequencies at each SNP,
+# and a trial's knockoffs must not depend on which other trials are sampled
+# with it, or on how the people are split into blocks.
+
+import numpy as np
+import hmm_fit
+import knockoff_sampler
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def draw_genotypes(hmm, n, rng):
+    '''
+    n genotype sequences drawn from the HMM.
+    '''
+    (p, _, S) = hmm['pEmit'].shape
+    X = np.empty((n, p), dtype=int)
+    H = np.array([rng.choice(S, p=hmm['pInit']) for i in xrange(n)])
+    for j in xrange(p):
+        if j > 0:
+            H = np.array([rng.choice(S, p=hmm['Q'][j - 1][h]) for h in H])
+        X[:, j] = [rng.choice(3, p=hmm['pEmit'][j, :, h]) for h in H]
+    return(X)
+
+
+def test_knockoff_sampler():
+    rng = np.random.RandomState(0)
+    (n, p, K) = (3000, 5, 3)
+    hmm = hmm_fit.assemble_hmm(rng.rand(p), rng.dirichlet(np.ones(K), size=p),
+                               rng.rand(p, K))
+
+    # Genotype frequencies at each SNP under the HMM.
+    state_probability = hmm['pInit']
+    expected = np.empty((p, 3))
+    for j in xrange(p):
+        if j > 0:
+            state_probability = np.dot(state_probability, hmm['Q'][j - 1])
+        expected[j] = np.dot(hmm['pEmit'][j], state_probability)
+
+    X = draw_genotypes(hmm, n, rng)
+    sampler = knockoff_sampler.MultiTrialSampler(hmm, X)
+    X_knockoffs = sampler.sample([7, 8])
+    observed = np.array([[np.mean(X_knockoffs[0][:, j] == g) for g in xrange(3)]
+                         for j in xrange(p)])
+    logger.info('Largest frequency difference: %.4f' % np.abs(observed - expected).max())
+    if np.abs(observed - expected).max() > 0.04:
+        logger.info('Knockoff genotype frequencies do not match the HMM!')
+        raise Exception
+
+    if not np.array_equal(sampler.sample([8])[0], X_knockoffs[1]):
+        logger.info('Knockoffs depend on the other trials sampled!')
+        raise Exception
+
+    # Nor on how the people are split into blocks for the backward pass.
+    knockoff_sampler.MAX_BACKWARD_CELLS = 7 * p * len(hmm['pInit'])
+    if not np.array_equal(sampler.sample([7, 8]), X_knockoffs):
+        logger.info('Knockoffs depend on the block size!')
+        raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_knockoff_sampler'
+    utils.initialize_logger(args)
+    test_knockoff_sampler()
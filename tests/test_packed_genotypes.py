@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Pack random allele counts (with missing genotypes, and numbers of people
+# that do and do not fill the last byte), and confirm that unpacking, allele
+# counts, carrier counts and genotype counts computed on the packed bytes
+# match the counts computed from the unpacked matrix.
+
+import sys
+import numpy as np
+import packed_genotypes
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def test_packed_genotypes():
+    rng = np.random.RandomState(0)
+    num_SNPs = 9
+    for num_people in [1, 3, 4, 5, 38, 401]:
+        X = rng.randint(-1, 3, size=(num_people, num_SNPs)).astype(np.int8)
+        packed = packed_genotypes.pack(X)
+        logger.info('%d people x %d SNPs: %d bytes packed, %d as int8' % (
+            num_people, num_SNPs, packed.nbytes, X.nbytes))
+        if packed.shape != (num_SNPs, packed_genotypes.packed_width(num_people)):
+            logger.info('Packed matrix has the wrong shape!')
+            raise Exception
+        if not np.array_equal(packed_genotypes.unpack(packed, num_people), X):
+            logger.info('Unpacked matrix does not match!')
+            raise Exception
+        block = packed_genotypes.unpack(packed[[1, 4, 8]], num_people, dtype=np.float32)
+        if block.dtype != np.float32 or not np.array_equal(block, X[:, [1, 4, 8]]):
+            logger.info('Unpacked block does not match!')
+            raise Exception
+
+        (alleles, called) = packed_genotypes.allele_counts(packed)
+        if (not np.array_equal(alleles, np.where(X == -1, 0, X).sum(axis=0)) or
+                not np.array_equal(called, (X != -1).sum(axis=0))):
+            logger.info('Allele counts do not match!')
+            raise Exception
+
+        group = rng.rand(num_people) < 0.5
+        (carriers, called) = packed_genotypes.carrier_counts(packed, group)
+        if (not np.array_equal(carriers, (X[group] >= 1).sum(axis=0)) or
+                not np.array_equal(called, (X[group] != -1).sum(axis=0))):
+            logger.info('Carrier counts do not match!')
+            raise Exception
+        counts = packed_genotypes.genotype_counts(packed, group)
+        if not np.array_equal(counts, np.array([(X[group] == g).sum(axis=0)
+                                                for g in range(3)]).T):
+            logger.info('Genotype counts do not match!')
+            raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_packed_genotypes'
+    utils.initialize_logger(args)
+    test_packed_genotypes()
+    sys.exit(0)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Write the same random genotypes (with missing genotypes, a SNP and a person
+# with too many of them, a SNP that is not an rsID and one that is an indel)
+# both as a PLINK binary fileset with a phenotype file and as a CSV input
+# file, and confirm that check_input produces the same cleaned_input.csv from
+# either, and writes wild_types.csv (the .bim file's second alleles) for the
+# PLINK input.
+
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import check_input
+import packed_genotypes
+import utils_snpko as utils
+
+logger = utils.logger
+
+num_people = 23
+num_SNPs = 12
+complement = {'A': 'G', 'C': 'T', 'G': 'A', 'T': 'C'}
+
+
+def write_inputs(data_dir):
+    rng = np.random.RandomState(0)
+    X = rng.randint(3, size=(num_people, num_SNPs)).astype(np.int8)
+    X[rng.rand(num_people, num_SNPs) < 0.15] = packed_genotypes.MISSING
+    X[:15, 4] = packed_genotypes.MISSING
+    X[7, :] = packed_genotypes.MISSING
+    allele_1 = [str(a) for a in rng.choice(list('ACGT'), num_SNPs)]
+    allele_2 = [complement[a] for a in allele_1]
+    SNPs = ['rs%d' % (100 + j) for j in range(num_SNPs)]
+    SNPs[2] = '1:555'
+    allele_1[9] = 'AT'
+    people = ['sample%d' % i for i in range(num_people)]
+
+    # PLINK fills the unused cells of each SNP's last byte with 0b00.
+    packed = packed_genotypes.pack(X)
+    packed[:, -1] &= (1 << (2 * (num_people % 4))) - 1
+    with open(os.path.join(data_dir, 'study.bed'), 'wb') as fp:
+        fp.write(check_input.BED_MAGIC + packed.tobytes())
+    with open(os.path.join(data_dir, 'study.bim'), 'w') as fp:
+        for j in range(num_SNPs):
+            fp.write('1\t%s\t0\t%d\t%s\t%s\n' % (SNPs[j], 1000 + j, allele_1[j], allele_2[j]))
+    with open(os.path.join(data_dir, 'study.fam'), 'w') as fp:
+        for person in people:
+            fp.write('family %s 0 0 1 -9\n' % person)
+
+    # Phenotypes in a different order, for one sample fewer and one extra.
+    # The sample IDs must be the first column.
+    df_pheno = pd.DataFrame({'sample': people[::-1] + ['other'],
+                             'dp_a': rng.randint(2, size=num_people + 1),
+                             'dp_b': rng.randint(2, size=num_people + 1)},
+                            columns=['sample', 'dp_a', 'dp_b'])
+    df_pheno = df_pheno[df_pheno['sample'] != 'sample5']
+    df_pheno.to_csv(os.path.join(data_dir, 'phenotypes.csv'), index=False)
+
+    rows = [i for i in range(num_people) if people[i] != 'sample5']
+    df = pd.DataFrame(index=np.arange(len(rows)))
+    for j in range(num_SNPs):
+        if j in [2, 9]:
+            continue
+        genotypes = [np.nan, allele_2[j] + allele_2[j], allele_1[j] + allele_2[j],
+                     allele_1[j] + allele_1[j]]
+        df[SNPs[j]] = [genotypes[x + 1] for x in X[rows, j]]
+    df_pheno = df_pheno.set_index('sample').loc[[people[i] for i in rows]]
+    for f in ['dp_a', 'dp_b']:
+        df[f] = df_pheno[f].values
+    df.to_csv(os.path.join(data_dir, 'study.csv'), index=False)
+
+
+def cleaned_input(args, data_dir, input_file, phenotype_file=None):
+    args.input_file = os.path.join(data_dir, input_file)
+    args.phenotype_file = phenotype_file and os.path.join(data_dir, phenotype_file)
+    check_input.check_and_convert_input(args)
+    return(pd.read_csv(os.path.join(args.working_dir, 'cleaned_input.csv')))
+
+
+def check_wild_types(args, data_dir, df_plink):
+    '''
+    Re-read the PLINK input, and confirm that its wild_types.csv gives the
+    second allele of each SNP kept in df_plink; the CSV input has no wild
+    types, so it must leave no wild_types.csv behind.
+    '''
+    wild_type_file = os.path.join(args.working_dir, 'wild_types.csv')
+    if os.path.exists(wild_type_file):
+        logger.info('CSV input without wild types left %s!' % wild_type_file)
+        raise Exception
+    cleaned_input(args, data_dir, 'study.bed', 'phenotypes.csv')
+    df_wild = pd.read_csv(wild_type_file)
+    df_bim = pd.read_csv(os.path.join(data_dir, 'study.bim'), sep='\t', header=None,
+                         names=['chromosome', 'SNP', 'cM', 'position', 'allele_1', 'allele_2'])
+    allele_1 = dict(zip(df_bim['SNP'].values, df_bim['allele_1'].values))
+    allele_2 = dict(zip(df_bim['SNP'].values, df_bim['allele_2'].values))
+    SNPs = [f for f in df_plink.columns if f.startswith('rs')]
+    if (list(df_wild['SNP'].values) != SNPs or
+            list(df_wild['wild_type'].values) != [allele_2[SNP] for SNP in SNPs]):
+        logger.info('Wild types %s do not match the .bim file!' % df_wild.values.tolist())
+        raise Exception
+
+    # Every called genotype has as many non-wild-type alleles as copies of
+    # the first allele.
+    X = utils.genotype_count_matrix(
+        df_plink, SNPs, dict(zip(df_wild['SNP'].values, df_wild['wild_type'].values)))
+    for (j, SNP) in enumerate(SNPs):
+        for (i, genotype) in enumerate(df_plink[SNP].values):
+            if pd.notnull(genotype) and X[i, j] != genotype.count(allele_1[SNP]):
+                logger.info('%s of %s is not %d copies of the first allele!' % (
+                    genotype, SNP, X[i, j]))
+                raise Exception
+
+
+def check_plink_input(args, data_dir):
+    write_inputs(data_dir)
+    args.data_prefix = 'dp_'
+    args.skip_rows = None
+    for na_threshold in [0.5, 0.3]:
+        args.na_threshold = na_threshold
+        df_plink = cleaned_input(args, data_dir, 'study.bed', 'phenotypes.csv')
+        df_csv = cleaned_input(args, data_dir, 'study.csv')
+        logger.info('--na_threshold %.1f: %d people x %d columns from PLINK, '
+                    '%d x %d from CSV' % (na_threshold, df_plink.shape[0], df_plink.shape[1],
+                                          df_csv.shape[0], df_csv.shape[1]))
+        if not df_plink.equals(df_csv):
+            logger.info('PLINK and CSV input do not match!')
+            raise Exception
+        check_wild_types(args, data_dir, df_plink)
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_plink_input'
+    utils.safe_mkdir(args.working_dir)
+    utils.initialize_logger(args)
+
+    data_dir = tempfile.mkdtemp(prefix='snpko_plink_')
+    try:
+        check_plink_input(args, data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Write random pruned loci (one associated with the label, one constant) and
+# an association.csv with chosen p-values, and confirm that the screening
+# stage keeps the loci that pass its p-value and variance filters; that with
+# --screen_split the screening subjects (the same ones for the same seed) are
+# left out of screened_experiment.csv; and that the knockoff stages read the
+# pruned loci when no filter is set.
+
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import screen_loci
+import utils_snpko as utils
+
+logger = utils.logger
+
+num_people = 60
+SNPs = ['rs%d' % (100 + j) for j in range(12)]
+# p-values of the trend test in association.csv.
+association_p_values = [0.001, 0.02] + [0.5] * 10
+
+
+def write_pruned_loci(working_dir):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(2, size=num_people)
+    X = rng.randint(3, size=(num_people, len(SNPs)))
+    X[:, 0] = 2 * labels
+    X[:, -1] = 1
+    genotypes = np.array(['A|A', 'A|G', 'G|G'], dtype=object)
+    df = pd.DataFrame(dict((SNP, genotypes[X[:, j]]) for (j, SNP) in enumerate(SNPs)),
+                      columns=SNPs)
+    df['dp_a'] = labels
+    df.to_csv(os.path.join(working_dir, 'pruned_experiment.csv'), index=False)
+    pd.DataFrame(dict((SNP, genotypes[rng.randint(3, size=20)]) for SNP in SNPs),
+                 columns=SNPs).to_csv(os.path.join(working_dir, 'pruned_ensembl.csv'),
+                                      index=False)
+    pd.DataFrame({'SNP': SNPs, 'chromosome': '1',
+                  'chromosome_position': 1000 + np.arange(len(SNPs)), 'wild_type': 'A'},
+                 columns=['SNP', 'chromosome', 'chromosome_position', 'wild_type']).to_csv(
+        os.path.join(working_dir, 'pruned_SNP_facts.csv'), index=False)
+    pd.DataFrame({'SNP': SNPs, 'wild_type': 'A'}, columns=['SNP', 'wild_type']).to_csv(
+        os.path.join(working_dir, 'wild_types.csv'), index=False)
+    utils.safe_mkdir(os.path.join(working_dir, 'results'))
+    pd.DataFrame({'SNP': SNPs, 'label': 'dp_a', 'trend_p_value': association_p_values},
+                 columns=['SNP', 'label', 'trend_p_value']).to_csv(
+        os.path.join(working_dir, 'results', 'association.csv'), index=False)
+
+
+def screened(args, screen_p_value=None, screen_min_variance=None, screen_split=0.0):
+    '''
+    Run the screening stage, and return the screened experiment and the
+    kept loci.
+    '''
+    args = copy.copy(args)
+    (args.screen_p_value, args.screen_min_variance, args.screen_split) = (
+        screen_p_value, screen_min_variance, screen_split)
+    args.knockoff_input_prefix = 'screened_'
+    screen_loci.screen(args)
+    df = pd.read_csv(os.path.join(args.working_dir, 'screened_experiment.csv'))
+    kept_SNPs = [SNP for SNP in df.columns if SNP.startswith('rs')]
+    df_ensembl = pd.read_csv(os.path.join(args.working_dir, 'screened_ensembl.csv'))
+    df_SNP = pd.read_csv(os.path.join(args.working_dir, 'screened_SNP_facts.csv'))
+    if list(df_ensembl.columns) != kept_SNPs or list(df_SNP['SNP'].values) != kept_SNPs:
+        logger.info('The screened ENSEMBL panel and SNP facts do not have the loci %s!' %
+                    kept_SNPs)
+        raise Exception
+    return(df, kept_SNPs)
+
+
+def expect_SNPs(kept_SNPs, expected, description):
+    logger.info('%s: kept %s' % (description, kept_SNPs))
+    if kept_SNPs != expected:
+        logger.info('%s should have kept %s!' % (description, expected))
+        raise Exception
+
+
+def check_filters(args):
+    df_pruned = pd.read_csv(os.path.join(args.working_dir, 'pruned_experiment.csv'))
+    (df, kept_SNPs) = screened(args, screen_p_value=0.05)
+    expect_SNPs(kept_SNPs, SNPs[:2], '--screen_p_value 0.05')
+    if not df.equals(df_pruned[kept_SNPs + ['dp_a']]):
+        logger.info('Screening without a split changed the subjects!')
+        raise Exception
+    (_, kept_SNPs) = screened(args, screen_min_variance=0.01)
+    expect_SNPs(kept_SNPs, SNPs[:-1], '--screen_min_variance 0.01')
+    (_, kept_SNPs) = screened(args, screen_p_value=0.01, screen_min_variance=0.01)
+    expect_SNPs(kept_SNPs, SNPs[:1], 'Both filters')
+
+
+def check_split(args):
+    '''
+    With --screen_split, the p-values come from the screening subjects (not
+    from association.csv), and those subjects are dropped.
+    '''
+    df_pruned = pd.read_csv(os.path.join(args.working_dir, 'pruned_experiment.csv'))
+    rows = set(tuple(row) for row in df_pruned.values)
+    if len(rows) != num_people:
+        logger.info('Subjects are not distinguishable by their genotypes!')
+        raise Exception
+
+    args.original_random_seed = 3
+    (_, kept_SNPs) = screened(args, screen_p_value=1e-3, screen_split=0.5)
+    expect_SNPs(kept_SNPs, SNPs[:1], '--screen_split 0.5')
+
+    # Keeping every locus, identify each remaining subject by its (unique)
+    # row of pruned_experiment.csv.
+    remaining = {}
+    for seed in [3, 3, 4]:
+        args.original_random_seed = seed
+        (df, kept_SNPs) = screened(args, screen_p_value=1.0, screen_split=0.5)
+        expect_SNPs(kept_SNPs, SNPs, '--screen_split 0.5 keeping every locus, seed %d' % seed)
+        df_subjects = pd.merge(df_pruned.reset_index(), df, on=list(df.columns))
+        if len(df_subjects) != len(df) or len(df) != num_people / 2:
+            logger.info('%d subjects remain, not %d of the pruned ones!' % (
+                len(df), num_people / 2))
+            raise Exception
+        subjects = set(df_subjects['index'].values)
+        if len(subjects) != len(df):
+            logger.info('Screened subjects are repeated!')
+            raise Exception
+        if seed in remaining and subjects != remaining[seed]:
+            logger.info('Seed %d gave a different split!' % seed)
+            raise Exception
+        remaining[seed] = subjects
+    if remaining[3] == remaining[4]:
+        logger.info('Seeds 3 and 4 gave the same split!')
+        raise Exception
+
+
+def check_knockoff_input_prefix():
+    argv = sys.argv
+    try:
+        for (flags, prefix) in [([], 'pruned_'),
+                                (['--screen_split', '0.5'], 'pruned_'),
+                                (['--screen_p_value', '0.01'], 'screened_'),
+                                (['--screen_min_variance', '0.1'], 'screened_')]:
+            sys.argv = [argv[0]] + flags
+            args = utils.parse_arguments()
+            if args.knockoff_input_prefix != prefix:
+                logger.info('Knockoff input with %s is %s, not %s!' % (
+                    flags, args.knockoff_input_prefix, prefix))
+                raise Exception
+    finally:
+        sys.argv = argv
+
+
+def check_screen_loci(args, working_dir):
+    args = copy.copy(args)
+    (args.working_dir, args.data_prefix, args.streaming) = (working_dir, 'dp_', False)
+    (args.screen_test, args.num_workers) = ('trend', 1)
+    write_pruned_loci(working_dir)
+    check_filters(args)
+    check_split(args)
+    check_knockoff_input_prefix()
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_screen_loci'
+    utils.initialize_logger(args)
+
+    working_dir = tempfile.mkdtemp(prefix='snpko_screen_')
+    try:
+        check_screen_loci(args, working_dir)
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Check the knockoff selection thresholds: knockoff_thresholds() must give
+# the same (tau_mFDR, tau_cFDR) as a direct loop over Equation 3.11 of
+# Candes et al 2017 (including ties, all-negative and all-zero W), and
+# re-thresholding the saved W statistics at the original FDR must
+# reproduce the stored selections.
+
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import selection_table
+import utils_snpko as utils
+
+logger = utils.logger
+
+
+def loop_thresholds(stat_list, fdr):
+    '''
+    The thresholds as the classifier originally computed them.
+    '''
+    tau_mFDR = np.inf  # Modified FDR
+    tau_cFDR = np.inf  # Classical FDR
+    for W in stat_list:
+        if W <= 0:
+            continue
+        if W >= tau_mFDR and W >= tau_cFDR:
+            continue
+
+        ratio_mFDR = 1.0 * (np.sum(stat_list <= -W)) / \
+            (np.sum(stat_list >= W))
+        ratio_cFDR = 1.0 * (1 + np.sum(stat_list <= -W)) / \
+            (np.sum(stat_list >= W))
+
+        if ratio_mFDR < fdr:
+            tau_mFDR = W
+        if ratio_cFDR < fdr:
+            tau_cFDR = W
+    return(tau_mFDR, tau_cFDR)
+
+
+def W_vectors(rng):
+    '''
+    Random W statistics of several kinds.
+    '''
+    yield np.zeros(10)
+    yield -rng.rand(10)
+    yield np.array([])
+    yield np.array([0.5])
+    for i in range(500):
+        p = rng.randint(1, 60)
+        # Mostly continuous; some with many ties (including W = -W' and 0);
+        # some mostly positive, so that something is selected.
+        yield rng.randn(p) * rng.rand(p)
+        yield rng.randint(-4, 5, size=p) / 4.0
+        yield rng.randn(p) + 2 * rng.rand()
+        yield np.where(rng.rand(p) < 0.5, 0.0, rng.randint(-2, 8, size=p) / 2.0)
+
+
+def check_selection_table(results_dir):
+    rng = np.random.RandomState(0)
+    num_checked = 0
+    num_selecting = 0
+    for W in W_vectors(rng):
+        for fdr in [0.05, 0.1, 0.2, 0.5]:
+            expected = loop_thresholds(W, fdr)
+            thresholds = selection_table.knockoff_thresholds(W, fdr)
+            if thresholds != expected:
+                logger.info('Thresholds %s at FDR %g are %s, not %s!' % (
+                    W, fdr, thresholds, expected))
+                raise Exception
+            num_checked += 1
+            num_selecting += np.isfinite(expected[0])
+    logger.info('%d thresholds match the loop (%d select something)' % (
+        num_checked, num_selecting))
+
+    # Selections as the classifier stores them, with W statistics differing
+    # only beyond float32 precision, then re-thresholded from the saved file.
+    (label_fields, SNPs, fdr) = (['dp_a', 'dp_b'], ['rs%d' % j for j in range(40)], 0.2)
+    results = []
+    for one_label_field in label_fields:
+        for trial in [0, 3, 5]:
+            W = rng.randn(len(SNPs)) + 1.5
+            W[::5] = -W[1::5] * (1 + 1e-9)
+            W = selection_table.saved_W(W)
+            (tau_mFDR, tau_cFDR) = selection_table.knockoff_thresholds(W, fdr)
+            results.append((one_label_field, trial, W, W >= tau_mFDR, W >= tau_cFDR))
+    table_file = os.path.join(results_dir, selection_table.FILENAME)
+    W_file = os.path.join(results_dir, selection_table.W_FILENAME)
+    selection_table.write(table_file, results, label_fields, SNPs, fdr, 3)
+    selection_table.write_W_statistics(W_file, results, label_fields)
+
+    table = selection_table.read(table_file)
+    rethreshold_file = os.path.join(results_dir, 'rethreshold.npz')
+    selection_table.write(
+        rethreshold_file,
+        selection_table.rethreshold(table, selection_table.read_W_statistics(W_file), fdr),
+        table['label_names'], table['SNP_names'], fdr, table['num_trials'])
+    rethresholded = selection_table.read(rethreshold_file)
+    logger.info('%d of %d stored selections' % (np.sum(table['selected']),
+                                                len(table['selected'])))
+    for column in ['trial', 'label', 'fdr_type', 'SNP', 'W', 'selected']:
+        if not np.array_equal(rethresholded[column], table[column]):
+            logger.info('Re-thresholding changed the %s column!' % column)
+            raise Exception
+    logger.info("Test passed successfully.")
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_selection_table'
+    utils.initialize_logger(args)
+
+    results_dir = tempfile.mkdtemp(prefix='snpko_selections_')
+    try:
+        check_selection_table(results_dir)
+    finally:
+        shutil.rmtree(results_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Run two toy stages (the second reading the first's output) through the
+# stage cache, and confirm which of them run: nothing when the inputs and
+# arguments are unchanged, the affected stages when an input, an argument or
+# an output changes, and only the selected ones with --from_stage,
+# --to_stage and --no_stage_cache.  Then run stand-ins for the pipeline's own
+# knockoff, classifier and summary stages (with their declared inputs,
+# arguments and outputs), and confirm that changing only --fdr re-runs just
+# the summary.
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import master_snpko
+import stage_cache
+import utils_snpko as utils
+
+logger = utils.logger
+
+stage_names = ['first', 'second']
+runs = []
+
+
+def first(args):
+    runs.append('first')
+    with open(os.path.join(args.working_dir, 'input.txt')) as fp:
+        contents = fp.read()
+    with open(os.path.join(args.working_dir, 'first.txt'), 'w') as fp:
+        fp.write('%s %d\n' % (contents.strip(), args.scale))
+
+
+def second(args):
+    runs.append('second')
+    with open(os.path.join(args.working_dir, 'first.txt')) as fp:
+        contents = fp.read()
+    with open(os.path.join(args.working_dir, 'second.txt'), 'w') as fp:
+        fp.write(contents * 2)
+
+
+stages = [
+    stage_cache.Stage('first', first,
+                      input_files=['{working_dir}/input.txt'],
+                      arg_fields=['scale'],
+                      output_files=['{working_dir}/first.txt']),
+    stage_cache.Stage('second', second,
+                      input_files=['{working_dir}/first.txt'],
+                      output_files=['{working_dir}/second.txt'])]
+
+
+def expect_runs(args, stage_list, stage_name_list, expected, description):
+    del runs[:]
+    stage_cache.run_stages(args, stage_list, stage_name_list)
+    logger.info('%s: ran %s' % (description, runs))
+    if runs != expected:
+        logger.info('%s should have run %s!' % (description, expected))
+        raise Exception
+
+
+def check_stage_cache(working_dir):
+    args = argparse.Namespace(working_dir=working_dir, scale=1, from_stage=None,
+                              to_stage=None, no_stage_cache=False)
+    input_file = os.path.join(working_dir, 'input.txt')
+    with open(input_file, 'w') as fp:
+        fp.write('abc\n')
+
+    def expect(expected, description):
+        expect_runs(args, stages, stage_names, expected, description)
+
+    expect(['first', 'second'], 'First run')
+    expect([], 'Unchanged inputs')
+
+    with open(input_file, 'w') as fp:
+        fp.write('xyz\n')
+    expect(['first', 'second'], 'Changed input')
+    args.scale = 2
+    expect(['first', 'second'], 'Changed argument')
+    expect([], 'Unchanged argument')
+
+    # A damaged output re-runs its stage; identical output does not
+    # invalidate the next stage.
+    with open(os.path.join(working_dir, 'first.txt'), 'w') as fp:
+        fp.write('damaged\n')
+    expect(['first'], 'Changed output of first stage')
+    os.unlink(os.path.join(working_dir, 'second.txt'))
+    expect(['second'], 'Missing output of second stage')
+
+    args.no_stage_cache = True
+    expect(['first', 'second'], '--no_stage_cache')
+    args.from_stage = 'second'
+    expect(['second'], '--from_stage second')
+    (args.from_stage, args.to_stage) = (None, 'first')
+    expect(['first'], '--to_stage first')
+
+    # Stages outside --from_stage ... --to_stage are not run even when
+    # their inputs change.
+    (args.no_stage_cache, args.from_stage, args.to_stage) = (False, 'second', None)
+    args.scale = 3
+    expect([], '--from_stage second with a changed argument of first')
+    args.from_stage = None
+    expect(['first', 'second'], 'All stages with a changed argument of first')
+
+
+def stand_in(stage):
+    '''
+    A stage with the declarations of "stage" whose function records that it
+    ran and writes each of its outputs.
+    '''
+    def run(args):
+        runs.append(stage.name)
+        for path in stage.paths(args, stage.output_files):
+            utils.safe_mkdir(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write('%s\n' % stage.name)
+    return(stage_cache.Stage(stage.name, run, input_files=stage.input_files,
+                             arg_fields=stage.arg_fields, output_files=stage.output_files))
+
+
+def check_fdr_change(args, working_dir):
+    args = copy.copy(args)
+    args.working_dir = working_dir
+    args.results_dir = os.path.join(working_dir, 'results')
+    (args.from_stage, args.to_stage, args.no_stage_cache) = (None, None, False)
+    pipeline_stages = [stand_in(stage) for stage in master_snpko.causal_stages(args)]
+
+    def expect(expected, description):
+        expect_runs(args, pipeline_stages, master_snpko.STAGE_NAMES, expected, description)
+
+    expect(['knockoffs', 'classifier', 'summarize'], 'Pipeline stages')
+    args.fdr /= 2
+    expect(['summarize'], 'Changed --fdr')
+    # (The stand-ins write the same outputs again, so the summary is not
+    # re-run.)
+    args.num_knockoff_trials += 1
+    expect(['knockoffs', 'classifier'], 'Changed --num_knockoff_trials')
+
+
+if __name__ == '__main__':
+    args = utils.parse_arguments()
+    if args.working_dir == 'data':
+        args.working_dir = '/tmp/test_stage_cache'
+    utils.initialize_logger(args)
+
+    working_dir = tempfile.mkdtemp(prefix='snpko_stages_')
+    try:
+        for name in ['toy', 'pipeline']:
+            utils.safe_mkdir(os.path.join(working_dir, name))
+        check_stage_cache(os.path.join(working_dir, 'toy'))
+        check_fdr_change(args, os.path.join(working_dir, 'pipeline'))
+        logger.info("Test passed successfully.")
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+    sys.exit(0)
@@ -6,11 +6,9 @@ import os
 import sys
 import logging
 import argparse
-import sklearn
-import scipy
-import google.cloud.storage
-import google.auth
-import boto3
+import contextlib
+import errno
+import fcntl
 from version_snpko import __version__
 
 
@@ -19,10 +17,66 @@ def safe_mkdir(directory):
         os.makedirs(directory)
 
 
+def cache_subdir(args, name):
+    '''
+    Directory of the cache "name" (e.g., 'ensembl_cache'): under --cache_dir
+    if given (a cache shared by several studies), otherwise under the
+    working directory.  Several studies may create it at once.
+    '''
+    if args.cache_dir is not None:
+        directory = os.path.join(args.cache_dir, name)
+    else:
+        directory = os.path.join(args.working_dir, name)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+    return(directory)
+
+
+def screening_loci(args):
+    '''
+    Are the pruned loci screened before the knockoff stages (see
+    screen_loci.py)?
+    '''
+    return(args.screen_p_value is not None or args.screen_min_variance is not None)
+
+
+def knockoff_input_file(args, name):
+    '''
+    Path of an input of the knockoff stages (e.g., 'experiment.csv'): the
+    screened loci if screening, otherwise the pruned loci.
+    '''
+    return(os.path.join(args.working_dir, args.knockoff_input_prefix + name))
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    '''
+    Hold an exclusive lock on the file "path" (created if needed), so that
+    only one process at a time, possibly of several studies sharing a cache,
+    runs the enclosed code.
+    '''
+    with open(path, 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
 logger = logging.getLogger('SNP Knockoff logger')
 
 logger_initialized = False
 
+# Pipeline stages, in order (see master_snpko.py).
+STAGE_NAMES = ['check_input', 'download_SNPs', 'stats', 'refine', 'prune',
+               'screen', 'knockoffs', 'classifier', 'summarize']
+
+LOGGED_LIBRARIES = ['sklearn', 'numpy', 'pandas', 'scipy', 'joblib',
+                    'SNPknock', 'google.cloud.storage', 'boto3']
+
 
 def check_permissions(args):
     if os.getuid() == 0:
@@ -73,86 +127,81 @@ def initialize_logger(args):
         if f.startswith('__'):
             continue
         logger.info("   %s  :  %s" % (f, args.__dict__[f]))
+    # Heavy libraries (cloud SDKs, sklearn, ...) are only imported by the
+    # modules that need them, so only report the ones this process loaded.
     logger.info("Library versions:")
-    for f in [sklearn, np, pd, scipy]:
-        logger.info("   %s  :  %s" % (f.__name__, f.__version__))
+    for name in LOGGED_LIBRARIES:
+        if name in sys.modules:
+            version = getattr(sys.modules[name], '__version__', 'unknown')
+        else:
+            version = '(not loaded)'
+        logger.info("   %s  :  %s" % (name, version))
+
 
+# The cloud helpers below are thin wrappers around cloud_transfer (imported
+# on use, since cloud_transfer itself uses this module).
 
 def upload_file_to_gcloud(bucket_name=None, source_name=None, destination_name=None):
-    credentials, project = google.auth.default()
-    storage_client = google.cloud.storage.Client(credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(destination_name)
-    try:
-        blob.upload_from_filename(source_name)
-    except Exception:
-        logger.info(
-            "Gcloud upload failure; check that instance has write access to 'Google storage'.")
-        raise
+    import cloud_transfer
+    cloud_transfer.upload_file('gcloud', bucket_name, source_name, destination_name)
 
 
 def download_file_from_gcloud(bucket_name=None, source_name=None, destination_name=None):
-    credentials, project = google.auth.default()
-    storage_client = google.cloud.storage.Client(credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(source_name)
-    blob.download_to_filename(destination_name)
+    import cloud_transfer
+    cloud_transfer.download_file('gcloud', bucket_name, source_name, destination_name)
 
 
 def list_files_in_gcloud(bucket_name=None, prefix=None, delimiter=None):
-    storage_client = google.cloud.storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-
-    blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
-    list_of_names = [blob.name for blob in blobs]
-    return(list_of_names)
+    import cloud_transfer
+    return(cloud_transfer.list_files('gcloud', bucket_name, prefix=prefix,
+                                     delimiter=delimiter))
 
 
-def download_prefix_from_gcloud(bucket_name=None, prefix=None, destination_dir=None):
-    safe_mkdir(destination_dir)
-    gcloud_file_list = list_files_in_gcloud(
-        bucket_name=bucket_name,
-        prefix=prefix)
-    for f in gcloud_file_list:
-        destination_name = os.path.join(destination_dir, os.path.basename(f))
-        download_file_from_gcloud(bucket_name=bucket_name,
-                                  source_name=f,
-                                  destination_name=destination_name)
+def download_prefix_from_gcloud(bucket_name=None, prefix=None, destination_dir=None,
+                                num_threads=8):
+    import cloud_transfer
+    cloud_transfer.download_prefix('gcloud', bucket_name, prefix, destination_dir,
+                                   num_threads=num_threads)
 
 
 def upload_file_to_aws(bucket_name=None, source_name=None, destination_name=None,
                        SSE=True):
-    s3 = boto3.client('s3')
-    if SSE:
-        s3.upload_file(source_name, bucket_name, destination_name,
-                       ExtraArgs={'ServerSideEncryption': "AES256"})
-    else:
-        s3.upload_file(source_name, bucket_name, destination_name)
+    import cloud_transfer
+    cloud_transfer.upload_file('aws', bucket_name, source_name, destination_name,
+                               SSE=SSE)
 
 
 def download_file_from_aws(bucket_name=None, source_name=None, destination_name=None,
                            SSE=True):
-    s3 = boto3.client('s3')
-    s3.download_file(bucket_name, source_name, destination_name)
+    import cloud_transfer
+    cloud_transfer.download_file('aws', bucket_name, source_name, destination_name)
+
+
+def download_prefix_from_aws(bucket_name=None, prefix=None, destination_dir=None,
+                             num_threads=8):
+    import cloud_transfer
+    cloud_transfer.download_prefix('aws', bucket_name, prefix, destination_dir,
+                                   num_threads=num_threads)
 
 
 def upload_results_dir(args):
     # Possibly upload to cloud
+    if not (args.upload_gcloud or args.upload_aws):
+        return
+    import cloud_transfer
+
     result_files = [f for f in os.listdir(args.results_dir) if os.path.isfile(
         os.path.join(args.results_dir, f))]
+    pairs = [(os.path.join(args.results_dir, f),
+              'causal_%d/%s' % (args.original_random_seed, f))
+             for f in result_files]
 
-    for f in result_files:
-        source_name = os.path.join(args.results_dir, f)
-        destination_name = os.path.join('causal_%d/%s' % (
-            args.original_random_seed, f))
-        if args.upload_gcloud:
-            upload_file_to_gcloud(bucket_name=args.bucket_name,
-                                  source_name=source_name,
-                                  destination_name=destination_name)
-        if args.upload_aws:
-            upload_file_to_aws(bucket_name=args.bucket_name,
-                               source_name=source_name,
-                               destination_name=destination_name)
+    if args.upload_gcloud:
+        cloud_transfer.upload_files('gcloud', args.bucket_name, pairs,
+                                    num_threads=args.transfer_threads)
+    if args.upload_aws:
+        cloud_transfer.upload_files('aws', args.bucket_name, pairs,
+                                    num_threads=args.transfer_threads)
 
 
 def parse_arguments():
@@ -160,12 +209,25 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='SNP Knockoffs',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--input_file', type=str,
-                        help='CSV file with SNPs and dependent variables.')
+                        help='CSV file with SNPs and dependent variables, or the .bed file of a '
+                        'PLINK binary fileset (with "--phenotype_file").')
+    parser.add_argument('--phenotype_file', type=str, default=None,
+                        help='With a PLINK .bed file as "--input_file": CSV file with the dependent '
+                        'variables, keyed by sample ID (as in the .fam file) in its first column.')
     parser.add_argument('--working_dir', type=str, default='data',
                         help='Directory for all working files and final output.')
     parser.add_argument('--results_dir', type=str, default=None,
                         help='Directory for final output (default = "results/" as a '
                         'subdirectory of the working_dir.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Keep the ENSEMBL and HMM caches here instead of in the working_dir, '
+                        'so that studies with overlapping SNP panels can share them.')
+    parser.add_argument('--study_manifest', type=str, default=None,
+                        help='With multi_study.py: CSV file listing the studies to run, one per '
+                        'row (see README.md).')
+    parser.add_argument('--concurrent_studies', type=int, default=2,
+                        help='With multi_study.py: number of studies to run at once; they split '
+                        'the "--num_workers" between them.')
     parser.add_argument('--skip_rows', type=str, default=None,
                         help='Skip rows of data file, 0-up indexing.')
     parser.add_argument('--na_threshold', type=float, default=0.5,
@@ -185,19 +247,86 @@ def parse_arguments():
                         help='Weight for Pareto-optimal tradeoff between population and SNP count.')
     parser.add_argument('--fastPHASE_path', type=str, default='.',
                         help='Path to "fastPHASE executable"')
+    parser.add_argument('--hmm_engine', type=str, default='fastphase',
+                        choices=['fastphase', 'numpy'],
+                        help='Fit the knockoff HMM with the external fastPHASE binary, or '
+                        'in-process with NumPy (see hmm_fit.py).')
+    parser.add_argument('--hmm_states', type=int, default=12,
+                        help='Number of haplotype clusters (K) in the knockoff HMM.')
+    parser.add_argument('--em_iterations', type=int, default=500,
+                        help='Maximum number of EM iterations when fitting the HMM.')
+    parser.add_argument('--em_tolerance', type=float, default=None,
+                        help='Stop EM when the relative improvement in log likelihood per '
+                        'iteration falls below this (0 = always run --em_iterations).  '
+                        'Defaults to 1e-6 with --hmm_engine=numpy and 0 with fastPHASE, '
+                        'which is rerun for 25, 50, 100, ... iterations to check '
+                        'convergence, so a chromosome that does not converge costs up to '
+                        'about 2.5 times --em_iterations.')
+    parser.add_argument('--em_restarts', type=int, default=1,
+                        help='With --hmm_engine=numpy, run EM from this many random starting '
+                        'points (in parallel) and keep the best fit.')
+    parser.add_argument('--knockoff_sampler', type=str, default='snpknock',
+                        choices=['snpknock', 'numpy'],
+                        help='Sample knockoffs one trial at a time with SNPknock, or all trials '
+                        'at once with NumPy (see knockoff_sampler.py).')
+    parser.add_argument('--segment_gap', type=int, default=0,
+                        help='Fit separate knockoff HMMs to the parts of a chromosome separated by '
+                        'gaps of more than this many base pairs between adjacent SNPs, so that '
+                        'they run in parallel.  (0 = do not split at gaps.)')
+    parser.add_argument('--segment_r2', type=float, default=0.0,
+                        help='Also split chromosomes where adjacent SNPs have squared correlation '
+                        'below this in the ENSEMBL data.  (0 = do not split on LD.)')
+    parser.add_argument('--min_segment_SNPs', type=int, default=50,
+                        help='Never split a chromosome into segments of fewer than this many SNPs.')
+    parser.add_argument('--streaming', action='store_true', default=False,
+                        help='Pass the ENSEMBL reference panel between stages as allele counts in '
+                        'chunked on-disk stores (see genotype_store.py), and process it a chunk '
+                        'at a time, for panels too large to hold in memory.')
+    parser.add_argument('--memory_budget_mb', type=float, default=1024,
+                        help='With --streaming, size chunks of the reference panel to use about '
+                        'this much memory.')
     parser.add_argument('--random_seed', type=int, default=123,
                         help='Random seed for (reproducible) PRNGs')
     parser.add_argument('--num_knockoff_trials', type=int, default=100,
                         help='Because the knockoff process draws random samples, it can be'
                         ' helpful to repeat it multiple times.')
+    parser.add_argument('--adaptive_trials', action='store_true', default=False,
+                        help='Run knockoff trials in batches and stop once every obs_freq is '
+                        'confidently above or below --obs_freq.  (--num_knockoff_trials '
+                        'becomes a maximum.)')
+    parser.add_argument('--trial_batch_size', type=int, default=10,
+                        help='Number of knockoff trials per batch with --adaptive_trials.')
+    parser.add_argument('--trial_confidence', type=float, default=0.95,
+                        help='Confidence level of the obs_freq intervals for --adaptive_trials.')
     parser.add_argument('--verbose', action='store_true', default=False,
                         help='Enable verbose logging (debug level)')
     parser.add_argument('--locus_threshold', type=float, default=0.5,
                         help='Correlation threshold for declaring two SNPs to be in the same locus.')
+    parser.add_argument('--screen_p_value', type=float, default=None,
+                        help='Before the knockoff stages, drop loci whose "--screen_test" p-value is '
+                        'above this for every label (see screen_loci.py).')
+    parser.add_argument('--screen_test', type=str, default='trend',
+                        choices=['fisher', 'allelic', 'trend', 'genotypic'],
+                        help='Univariate test (see results/association.csv) used by '
+                        '"--screen_p_value".')
+    parser.add_argument('--screen_min_variance', type=float, default=None,
+                        help='Before the knockoff stages, drop loci whose allele count variance '
+                        'among the subjects is below this.')
+    parser.add_argument('--screen_split', type=float, default=0.0,
+                        help='Compute the "--screen_p_value" p-values on this fraction of the '
+                        'subjects, and leave them out of the knockoff analysis (which keeps its '
+                        'FDR guarantee).  With 0, all subjects are used for both.')
     parser.add_argument('--fdr', type=float, default=0.1,
                         help='Target false discover rate (FDR).')
     parser.add_argument('--obs_freq', type=float, default=0.5,
                         help='Only trust SNPs that show up in >obs_freq of the knockoff trials.')
+    parser.add_argument('--rethreshold_fdr', type=float, nargs='+', default=None,
+                        help='With sig_results.py: instead of summarizing, recompute the '
+                        'selections at each of these target FDRs from the stored W statistics, '
+                        'without refitting, into results/fdr_<FDR>/.')
+    parser.add_argument('--knockoff_report', action='store_true', default=False,
+                        help='Also write the human-readable knockoff_trials.txt summary of the '
+                        'knockoff trials.')
     parser.add_argument('--p_samples', type=int, default=100,
                         help='Number of null-hypothesis samples to generate for estimating p-values.')
     parser.add_argument('--machine_num', type=int, default=0,
@@ -214,10 +343,23 @@ def parse_arguments():
                         help='If classifier does not improve for this many consecutive steps, then stop.')
     parser.add_argument('--SGD_max_iterations', type=int, default=500,
                         help='Maximum iterations until SGD classifier terminates.')
+    parser.add_argument('--classifier_engine', type=str, default='sgd',
+                        choices=['sgd', 'cd'],
+                        help='Fit the elastic-net logistic regression with SGDClassifier, or by '
+                        'coordinate descent with screening rules (see enet_logistic.py).')
+    parser.add_argument('--cd_tolerance', type=float, default=1e-6,
+                        help='Convergence tolerance for --classifier_engine=cd.')
     parser.add_argument('--p_values', action='store_true', default=False,
                         help='Compute p-values.  (Will make computation *much* slower.)')
     parser.add_argument('--p_thresh', type=float, default=0.05,
                         help='For convenience, summarize threshold for this p-value.')
+    parser.add_argument('--p_sequential', action='store_true', default=False,
+                        help='Stop generating p-value trials once every reported p-value is '
+                        'confidently above or below --p_thresh.  (--p_samples becomes a maximum.)')
+    parser.add_argument('--p_confidence', type=float, default=0.99,
+                        help='Confidence level for resolving p-values with --p_sequential.')
+    parser.add_argument('--p_min_samples', type=int, default=10,
+                        help='Minimum number of p-value trials before --p_sequential may stop.')
     parser.add_argument('--bucket_name', type=str, default='snpko',
                         help='Cloud bucket name')
     parser.add_argument('--upload_gcloud', action='store_true', default=False,
@@ -228,8 +370,30 @@ def parse_arguments():
                         help='Download p-value files from Google cloud storage.')
     parser.add_argument('--download_aws', action='store_true', default=False,
                         help='Download p-value files from S3 on AWS.')
+    parser.add_argument('--p_queue_dir', type=str, default=None,
+                        help='Directory (on storage shared by all workers) holding a job queue '
+                        'of p-value trials; replaces static "--machine_num" assignment.')
+    parser.add_argument('--p_coordinator', action='store_true', default=False,
+                        help='With --p_queue_dir: populate the queue, compute the causal '
+                        'knockoffs, and accumulate the final p-values.')
+    parser.add_argument('--heartbeat_timeout', type=float, default=600,
+                        help='With --p_queue_dir: re-queue a trial if its worker has not '
+                        'heartbeated for this many seconds.')
+    parser.add_argument('--worker_id', type=str, default=None,
+                        help='With --p_queue_dir: name of this worker in the logs (default = '
+                        'hostname and process ID).')
+    parser.add_argument('--transfer_threads', type=int, default=8,
+                        help='Number of parallel cloud uploads/downloads.')
     parser.add_argument('--skip_p_value_accumulation', action='store_true', default=False,
                         help='Do not collect final p_values (because of machine distribution)')
+    parser.add_argument('--from_stage', type=str, default=None, choices=STAGE_NAMES,
+                        help='Skip the pipeline stages before this one (trusting their '
+                        'existing output).')
+    parser.add_argument('--to_stage', type=str, default=None, choices=STAGE_NAMES,
+                        help='Stop after this pipeline stage (and skip p-values).')
+    parser.add_argument('--no_stage_cache', action='store_true', default=False,
+                        help='Re-run every stage, even if its inputs are unchanged since the '
+                        'last run.')
     parser.add_argument('--halt', action='store_true', default=False,
                         help='Halt machine at completion.')
 
@@ -238,8 +402,16 @@ def parse_arguments():
     # Fully qualify "~"s from path names
     if args.input_file is not None:
         args.input_file = os.path.expanduser(args.input_file)
+    if args.phenotype_file is not None:
+        args.phenotype_file = os.path.expanduser(args.phenotype_file)
+    # The rest of a PLINK fileset (e.g. "{input_prefix}.bim"); see check_input.py.
+    args.input_prefix = None
+    if args.input_file is not None:
+        args.input_prefix = os.path.splitext(args.input_file)[0]
     args.working_dir = os.path.expanduser(args.working_dir)
     args.fastPHASE_path = os.path.expanduser(args.fastPHASE_path)
+    if args.cache_dir is not None:
+        args.cache_dir = os.path.abspath(os.path.expanduser(args.cache_dir))
     if args.results_dir is None:
         args.results_dir = os.path.join(args.working_dir, 'results')
     else:
@@ -247,9 +419,12 @@ def parse_arguments():
     args.original_results_dir = args.results_dir
 
     args.original_random_seed = args.random_seed
+    args.knockoff_input_prefix = 'screened_' if screening_loci(args) else 'pruned_'
     args.random_seed += 10000000 * args.machine_num
 
     args.tol = float(args.tol)
+    if args.em_tolerance is None:
+        args.em_tolerance = 1e-6 if args.hmm_engine == 'numpy' else 0.0
 
     return(args)
 
@@ -276,3 +451,25 @@ def genotype_to_nonwild_type_count(x, wild_type, on_null=2):
         out[i] += (x[i][2] != wild_type)
 
     return(out)
+
+
+def genotype_count_matrix(df, SNPs, SNP_to_wild_type):
+    '''
+    Non-wild-type allele counts (see genotype_to_nonwild_type_count()) of the
+    people in df at each of SNPs, as an int8 array (people x SNPs).
+    '''
+    X = np.empty((len(df), len(SNPs)), dtype=np.int8)
+    for j, SNP in enumerate(SNPs):
+        X[:, j] = genotype_to_nonwild_type_count(df[SNP].values, SNP_to_wild_type[SNP])
+    return(X)
+
+
+def shared_array(array, path):
+    '''
+    Save array to path (a .npy file) and return it memory-mapped, read-only.
+    joblib passes a memory-mapped array to its workers as a reference to the
+    file, so all of the workers share a single copy of the data instead of
+    each receiving a pickled copy.
+    '''
+    np.save(path, array)
+    return(np.load(path, mmap_mode='r'))